@@ -1,21 +1,185 @@
 #!/usr/bin/env python
+import functools
 import logging
 
 import os
-from flask import Flask, render_template, send_from_directory
+import threading
+from typing import Any, Dict, List, Union
+
+from flask import Flask, render_template, send_from_directory, request, g, Response, url_for
 from flask_bootstrap import Bootstrap
-from psycopg2 import sql
+from psycopg2 import sql, extensions
 
+from database_design.rebuild_table_specs import ArchiveGeneration
 from database_design.sonata_table_specs import Composer, Piece, Sonata, Intro, Expo, Development, \
-    Recap, Coda, ColumnDisplay
+    Recap, Coda, ColumnDisplay, register_key_typecaster
 from directories import APP_DIR
-from general_utils.postgres_utils import LocalhostCursor
+from general_utils.page_cache import PageCache, DEFAULT_GENERATION_CHECK_SECONDS
+from general_utils.postgres_utils import LocalhostCursor, QueryResultCache, json_dumps
+from general_utils.query_metrics import QueryMetrics, current_route, format_prometheus_metric, \
+    format_upper_bound, NO_ROUTE, DEFAULT_SLOW_QUERY_SECONDS
+from general_utils.sql_utils import Field, select_fields_sql
 
 log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 bootstrap = Bootstrap(app)
 
+# The archive only changes with a rebuild, so the results of the app's queries are cached until the next one
+LocalhostCursor.result_cache = QueryResultCache(ArchiveGeneration.select_generation_sql())
+
+# The display names of the columns are loaded once and shared by every route until the next rebuild
+LocalhostCursor.result_cache.add_new_generation_listener(ColumnDisplay.refresh_display_name_catalog)
+
+# The pages of the archive are cached whole until the next rebuild, which the page cache notices within this many
+# seconds (or as soon as the result cache sees it), so that a repeat visit doesn't touch the database at all
+PAGE_CACHE_GENERATION_CHECK_SECONDS = float(os.environ.get("SONATA_PAGE_CACHE_GENERATION_CHECK_SECONDS",
+                                                           DEFAULT_GENERATION_CHECK_SECONDS))
+page_cache = PageCache(ArchiveGeneration.select_generation_and_bumped_at_sql(),
+                       generation_check_seconds=PAGE_CACHE_GENERATION_CHECK_SECONDS)
+LocalhostCursor.result_cache.add_new_generation_listener(page_cache.expire_generation)
+
+# Every query the app runs is recorded by route (see /metrics), and the ones that take longer than this many seconds
+# are logged on the slow_query logger
+SLOW_QUERY_SECONDS = float(os.environ.get("SONATA_SLOW_QUERY_SECONDS", DEFAULT_SLOW_QUERY_SECONDS))
+LocalhostCursor.query_metrics = QueryMetrics(slow_query_seconds=SLOW_QUERY_SECONDS)
+
+# How many requests checked out a connection and how many cursors used those connections in total (see /metrics)
+_request_connection_stats = {'requests': 0, 'uses': 0}
+_request_connection_stats_lock = threading.Lock()
+
+# What the surname of the composer is selected as next to the columns of the piece
+COMPOSER_SURNAME_ALIAS = "composer_surname"
+
+# How many rows a listing of the JSON API returns per page by default, and at most
+API_DEFAULT_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# The blocks of a sonata in the JSON API by the name they go by in its urls
+API_BLOCK_TABLE_SPECS = {block_table_spec.block_display_name().lower(): block_table_spec
+                         for block_table_spec in [Intro, Expo, Development, Recap, Coda]}
+
+# Whether the keys of the key enum type already come back as KeyStructs (see register_key_typecaster)
+_key_typecaster_registered = False
+_key_typecaster_lock = threading.Lock()
+
+
+def reset_key_typecaster(generation: int) -> None:
+    """
+    Makes the next request register the typecaster of the key enum type again, since a rebuild recreates the type
+    (with a new oid)
+
+    :param generation: the new generation of the archive
+    """
+    global _key_typecaster_registered
+    _key_typecaster_registered = False
+
+
+LocalhostCursor.result_cache.add_new_generation_listener(reset_key_typecaster)
+
+
+@app.before_request
+def set_current_route():
+    """
+    Records the queries of the request under its route (the rule it matched, like /composers/<composer_id>, so that
+    every composer counts towards the same route)
+    """
+    g.current_route_token = current_route.set(request.url_rule.rule if request.url_rule is not None else NO_ROUTE)
+
+
+@app.teardown_request
+def reset_current_route(exception=None):
+    token = g.pop('current_route_token', None)
+    if token is not None:
+        current_route.reset(token)
+
+
+def get_request_connection() -> extensions.connection:
+    """
+    Gets the connection of the current request, checking one out of the pool the first time a request asks for one
+    (every cursor of a request shares it, so a request never holds more than one connection of the pool at a time)
+
+    :return: the connection
+    """
+    if 'db_conn' not in g:
+        g.db_conn = LocalhostCursor.get_connection_manager().get_connection()
+        g.db_conn_route = current_route.get()
+        g.db_conn_uses = 0
+    g.db_conn_uses = g.db_conn_uses + 1
+    return g.db_conn
+
+
+def request_cursor(dict_cursor: bool = False, cache_results: bool = True) -> LocalhostCursor:
+    """
+    Makes a read only cursor on the connection of the current request for use in a with block
+
+    :param dict_cursor: whether the cursor should return dicts instead of tuples
+    :param cache_results: whether to answer the queries from the result cache (when it has them)
+    :return: the cursor
+    """
+    return LocalhostCursor(dict_cursor=dict_cursor, read_only=True, cache_results=cache_results,
+                           connection=get_request_connection())
+
+
+@app.teardown_appcontext
+def return_request_connection(exception=None):
+    """
+    Returns the connection of the request (if it used one) to the pool, and reports how many cursors used it
+    """
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
+    uses = g.pop('db_conn_uses', 0)
+    log.debug("Returning the connection of the request for {} after {} cursors used it".format(
+        g.pop('db_conn_route', None), uses))
+    with _request_connection_stats_lock:
+        _request_connection_stats['requests'] = _request_connection_stats['requests'] + 1
+        _request_connection_stats['uses'] = _request_connection_stats['uses'] + uses
+    LocalhostCursor.get_connection_manager().return_connection(conn)
+
+
+@app.before_request
+def ensure_key_typecaster():
+    """
+    Registers the typecaster of the key enum type before the first request (the type is only there once the database
+    is built, so until it is the keys simply come back as their names and we try again on the next request)
+    """
+    global _key_typecaster_registered
+    if _key_typecaster_registered:
+        return
+    with _key_typecaster_lock:
+        if not _key_typecaster_registered:
+            with request_cursor(cache_results=False) as cur:
+                _key_typecaster_registered = register_key_typecaster(cur)
+
+
+def cached_page(view):
+    """
+    Serves the page of a view from the page cache (keyed by the route and the arguments of the view) while the archive
+    stays at the same generation, rendering it only when it isn't cached yet. Every page is served with a strong ETag
+    and the time of the last rebuild as its Last-Modified, so conditional requests for a page that didn't change get a
+    304 without a body.
+
+    :param view: the view function, which must return the rendered page
+    :return: the view function serving from the cache
+    """
+    @functools.wraps(view)
+    def cached_view(**kwargs):
+        generation, last_modified = page_cache.current_generation(lambda: request_cursor(cache_results=False))
+        key = (request.url_rule.rule, tuple(sorted(kwargs.items())))
+
+        page = page_cache.get_page(generation, key)
+        if page is None:
+            page = page_cache.put_page(generation, last_modified, key, view(**kwargs).encode('utf-8'))
+
+        response = Response(page.body, mimetype='text/html')
+        response.set_etag(page.etag)
+        if page.last_modified is not None:
+            response.last_modified = page.last_modified
+        return response.make_conditional(request)
+
+    return cached_view
+
 
 @app.route('/')
 @app.route('/index')
@@ -24,8 +188,9 @@ def index():
 
 
 @app.route('/composers')
+@cached_page
 def composers():
-    with LocalhostCursor() as cur:
+    with request_cursor() as cur:
         select_comps_query = sql.SQL("""
                   SELECT {id},{full_name} 
                   FROM {composer_st};
@@ -47,6 +212,7 @@ def composers():
 
 
 @app.route('/pieces')
+@cached_page
 def pieces():
     # The main goal for this method is to render pieces.html with the following:
     #
@@ -57,7 +223,7 @@ def pieces():
     # a dict mapping piece id --> lists of the analyzed movement nums
     # Use a dict cursor to have fetchone return a dict instead of a tuple
 
-    with LocalhostCursor() as cur:
+    with request_cursor() as cur:
         select_pieces_query = sql.SQL("""
                   SELECT comp.{comp_id}, piece.{piece_id}, 
                          comp.{comp_surname} || ' ' || piece.{piece_full_name} AS cfn
@@ -96,6 +262,7 @@ def pieces():
 
 
 @app.route('/composers/<composer_id>')
+@cached_page
 def composer(composer_id: str):
     # The main goal for this method is to render composer.html with the following:
     #
@@ -115,7 +282,7 @@ def composer(composer_id: str):
     # a dict mapping piece id --> lists of the analyzed movement nums
 
     # Use a dict cursor to have fetchone return a dict instead of a tuple
-    with LocalhostCursor(dict_cursor=True) as cur:
+    with request_cursor(dict_cursor=True) as cur:
         select_comp_info_query = sql.SQL("""
                   SELECT *
                   FROM {composer_st}
@@ -133,7 +300,7 @@ def composer(composer_id: str):
         # Will use surname as separate field so need to keep it
         composer_surname = comp_info_dict.pop(Composer.SURNAME.string)
 
-    with LocalhostCursor() as cur:
+    with request_cursor() as cur:
         select_comp_pieces_query = sql.SQL("""
                   SELECT {id}, {full_name}
                   FROM {piece_st}
@@ -188,6 +355,7 @@ def composer(composer_id: str):
 
 
 @app.route('/composers/<composer_id>/<piece_id>')
+@cached_page
 def piece(composer_id: str, piece_id: str):
     # The main goal for this method is to render piece.html with the following:
     #
@@ -215,25 +383,40 @@ def piece(composer_id: str, piece_id: str):
     #
     # If sonata name = 'Itself' then this means the piece is a single-movement work that is the sonata
 
-    # Use a dict cursor to have each record return a dict instead of a tuple
-    with LocalhostCursor(dict_cursor=True) as cur:
+    # The blocks of a sonata in the order they are displayed, along with the sonata field linking to each of them
+    block_table_specs_and_id_fields = [(Intro, Sonata.INTRODUCTION_ID),
+                                       (Expo, Sonata.EXPOSITION_ID),
+                                       (Development, Sonata.DEVELOPMENT_ID),
+                                       (Recap, Sonata.RECAPITULATION_ID),
+                                       (Coda, Sonata.CODA_ID)]
 
-        ###################################
-        #  Piece Info Dict and Piece Name #
-        ###################################
+    # The whole page is fetched in two queries: the piece with its composer's surname, and every sonata of the piece
+    # with all its blocks joined in. The columns of the blocks are selected one by one (instead of aggregating each
+    # block row as JSON) so that every value still comes back as its own type (i.e. keys as KeyStructs)
+    with request_cursor() as cur:
+
+        ###################################################
+        #  Piece Info Dict, Piece Name and Composer Surname #
+        ###################################################
 
         select_piece_info_query = sql.SQL("""
-            SELECT *
-            FROM {piece_st}
-            WHERE {id} = {piece_id};
+            SELECT piece.*, comp.{surname} AS {composer_surname}
+            FROM {piece_st} AS piece
+            JOIN {composer_st} AS comp
+            ON (piece.{comp_id} = comp.{id})
+            WHERE piece.{id} = {piece_id};
         """).format(id=Piece.ID,
+                    comp_id=Piece.COMPOSER_ID,
+                    surname=Composer.SURNAME,
+                    composer_surname=sql.Identifier(COMPOSER_SURNAME_ALIAS),
                     piece_id=sql.Literal(piece_id),
-                    piece_st=Piece.schema_table())
+                    piece_st=Piece.schema_table(),
+                    composer_st=Composer.schema_table())
 
         cur.execute(select_piece_info_query)
-        piece_info_dict = dict(cur.fetchone())
+        piece_info_dict = dict(zip([x.name for x in cur.description], cur.fetchone()))
 
-        # Remove information that we don't want to display (grab the full name and composer_id while popping)
+        # Remove information that we don't want to display (grab the full name, composer_id and surname while popping)
         piece_info_dict.pop(Piece.ID.string)
         piece_info_dict.pop(Piece.NAME.string)
         piece_info_dict.pop(Piece.NICKNAME.string)
@@ -241,6 +424,7 @@ def piece(composer_id: str, piece_id: str):
 
         piece_name = piece_info_dict.pop(Piece.FULL_NAME.string)
         composer_id_of_piece = piece_info_dict.pop(Piece.COMPOSER_ID.string)
+        composer_surname = piece_info_dict.pop(COMPOSER_SURNAME_ALIAS)
 
         # Change info dict to have display name keys instead of raw field name keys
         piece_info_dict = ColumnDisplay.create_new_dict_with_display_name_keys(
@@ -252,52 +436,60 @@ def piece(composer_id: str, piece_id: str):
             raise Exception("Bad composer id \"{}\" in URL! Piece with id \"{}\" should have composer id \"{}\""
                             "".format(composer_id, piece_id, composer_id_of_piece))
 
-        ####################
-        # Composer Surname #
-        ####################
-        select_comp_surname_query = sql.SQL("""
-                        SELECT {surname}
-                        FROM {composer_st}
-                        WHERE {id} = {composer_id}
-        """).format(surname=Composer.SURNAME,
-                    id=Composer.ID,
-                    composer_id=sql.Literal(composer_id),
-                    composer_st=Composer.schema_table())
-        cur.execute(select_comp_surname_query)
-        composer_surname = cur.fetchone()[0]
+        ########################################
+        # Sonatas and Sonata Blocks Info Dicts #
+        ########################################
+
+        # The fields of the sonata and of each block in the order they are selected, to split each row back up with
+        table_specs = [Sonata] + [x[0] for x in block_table_specs_and_id_fields]
+        table_fields = [[x[0] for x in table_spec.field_sql_type_list()] for table_spec in table_specs]
+        table_aliases = [sql.Identifier("t{}".format(i)) for i in range(len(table_specs))]
 
-        ######################
-        # Sonatas Info Dicts #
-        ######################
         select_sonatas_query = sql.SQL("""
-                         SELECT *
-                         FROM {sonata_st}
-                         WHERE {p_id} = {piece_id}
-                         ORDER BY {movement_num};
-            """).format(p_id=Sonata.PIECE_ID,
-                        piece_id=sql.Literal(piece_id),
-                        movement_num=Sonata.MOVEMENT_NUM,
-                        sonata_st=Sonata.schema_table())
+                         SELECT {columns}
+                         FROM {sonata_st} AS {sonata_alias}
+                         {block_joins}
+                         WHERE {sonata_alias}.{p_id} = {piece_id}
+                         ORDER BY {sonata_alias}.{movement_num};
+            """).format(
+            columns=sql.SQL(", ").join(sql.SQL("{}.{}").format(alias, field)
+                                       for alias, fields in zip(table_aliases, table_fields) for field in fields),
+            sonata_st=Sonata.schema_table(),
+            sonata_alias=table_aliases[0],
+            block_joins=sql.SQL("\n").join(
+                sql.SQL("LEFT JOIN {block_st} AS {alias} ON ({alias}.{id} = {sonata_alias}.{block_id})").format(
+                    block_st=block_table_spec.schema_table(),
+                    alias=alias,
+                    id=block_table_spec.ID,
+                    sonata_alias=table_aliases[0],
+                    block_id=block_id_field)
+                for alias, (block_table_spec, block_id_field) in zip(table_aliases[1:],
+                                                                     block_table_specs_and_id_fields)),
+            p_id=Sonata.PIECE_ID,
+            piece_id=sql.Literal(piece_id),
+            movement_num=Sonata.MOVEMENT_NUM)
         cur.execute(select_sonatas_query)
 
         sonatas_info_dict = {}
         sonatas_blocks_info_dict = {}
         sonatas_lilypond_image_settings_dict = {}
 
-        sonatas_data = cur.fetchall()
+        for result in cur.fetchall():
+            # Split the row back up into a dict per table
+            row_dicts = []
+            column_index = 0
+            for fields in table_fields:
+                row_dicts.append({field.string: value
+                                  for field, value in zip(fields, result[column_index:column_index + len(fields)])})
+                column_index += len(fields)
+            sonata_info_dict = row_dicts[0]
 
-        for result in sonatas_data:
-            sonata_info_dict = dict(result)
             # Remove information that we don't want to display (grab various ids and info we need while popping)
             sonata_info_dict.pop(Sonata.PIECE_ID.string)
 
             sonata_id = sonata_info_dict.pop(Sonata.ID.string)
             movement_num = sonata_info_dict.pop(Sonata.MOVEMENT_NUM.string)
-            intro_id = sonata_info_dict.pop(Sonata.INTRODUCTION_ID.string)
-            expo_id = sonata_info_dict.pop(Sonata.EXPOSITION_ID.string)
-            dev_id = sonata_info_dict.pop(Sonata.DEVELOPMENT_ID.string)
-            recap_id = sonata_info_dict.pop(Sonata.RECAPITULATION_ID.string)
-            coda_id = sonata_info_dict.pop(Sonata.CODA_ID.string)
+            block_ids = [sonata_info_dict.pop(x[1].string) for x in block_table_specs_and_id_fields]
             lilypond_image_settings = sonata_info_dict.pop(Sonata.LILYPOND_IMAGE_SETTINGS.string)
 
             # Change info dict to have display name keys instead of raw field name keys
@@ -322,41 +514,25 @@ def piece(composer_id: str, piece_id: str):
 
             sonatas_blocks_info_dict[movement_num] = {}
 
-            block_ids = [intro_id, expo_id, dev_id, recap_id, coda_id]
-            block_table_specs = [Intro, Expo, Development, Recap, Coda]
+            for block_id, block_table_spec, sonata_block_info_dict in zip(block_ids, table_specs[1:], row_dicts[1:]):
+                # if there is no block id, that means the block is missing, so we can skip
+                if block_id is None:
+                    continue
 
-            #############################
-            # Sonatas Blocks Info Dicts #
-            #############################
-            for block_id, block_table_spec in zip(block_ids, block_table_specs):
+                # The name of the block is the same as the table spec class name
+                block_name = block_table_spec.block_display_name()
 
-                # if there is no block id, that means the block is missing, so we can skip
-                if block_id is not None:
-                    # The name of the block is the same as the table spec class name
-                    block_name = block_table_spec.block_display_name()
-
-                    with LocalhostCursor(dict_cursor=True) as cur2:
-                        select_sonata_block_info_query = sql.SQL("""
-                                                 SELECT *
-                                                 FROM {block_st}
-                                                 WHERE {id} = {block_id};
-                                    """).format(id=block_table_spec.ID,
-                                                block_id=sql.Literal(block_id),
-                                                block_st=block_table_spec.schema_table())
-                        cur2.execute(select_sonata_block_info_query)
-                        sonata_block_info_dict = dict(cur2.fetchone())
-
-                        # Remove information that we don't want to display
-                        sonata_block_info_dict.pop(block_table_spec.ID.string)
-                        sonata_block_info_dict.pop(block_table_spec.SONATA_ID.string)
-
-                        # Change info dict to have display name keys instead of raw field name keys
-                        sonata_block_info_dict = ColumnDisplay.create_new_dict_with_display_name_keys(
-                            cursor=cur,
-                            table_name=block_table_spec.schema_table().table.string,
-                            dict_with_column_name_keys=sonata_block_info_dict)
-
-                        sonatas_blocks_info_dict[movement_num][block_name] = sonata_block_info_dict
+                # Remove information that we don't want to display
+                sonata_block_info_dict.pop(block_table_spec.ID.string)
+                sonata_block_info_dict.pop(block_table_spec.SONATA_ID.string)
+
+                # Change info dict to have display name keys instead of raw field name keys
+                sonata_block_info_dict = ColumnDisplay.create_new_dict_with_display_name_keys(
+                    cursor=cur,
+                    table_name=block_table_spec.schema_table().table.string,
+                    dict_with_column_name_keys=sonata_block_info_dict)
+
+                sonatas_blocks_info_dict[movement_num][block_name] = sonata_block_info_dict
 
         log.debug('sonatas_lilypond_image_settings_dict: {}'.format(sonatas_lilypond_image_settings_dict))
 
@@ -372,6 +548,240 @@ def piece(composer_id: str, piece_id: str):
                            IMAGE_WIDTH=Sonata.IMAGE_WIDTH)
 
 
+class ApiError(Exception):
+    """
+    An exception for a request to the JSON API that can't be answered, which is returned as a JSON error
+    """
+
+    def __init__(self, message: str, status_code: int = 400):
+        """
+        :param message: what was wrong with the request
+        :param status_code: the HTTP status to return (defaults to 400)
+        """
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+@app.errorhandler(ApiError)
+def api_error(error: ApiError):
+    return json_response({'error': error.message}, status=error.status_code)
+
+
+def json_response(body: Any, status: int = 200) -> Response:
+    """
+    :param body: what to return as JSON (with any KeyStructs, MRs or dates in it as their strings)
+    :param status: the HTTP status
+    :return: the response
+    """
+    return Response(json_dumps(body), status=status, mimetype='application/json')
+
+
+def api_fields(table_spec) -> List[Field]:
+    """
+    Gets the fields that the request asks for with ?fields=a,b (every field of the table if it doesn't), always
+    starting with the id of the table since that's what the listings page by
+
+    :param table_spec: the table specification of the table
+    :return: the fields to select, in order
+    """
+    fields_arg = request.args.get('fields')
+    if fields_arg is None:
+        return [x[0] for x in table_spec.field_sql_type_list()]
+
+    fields_by_name = table_spec.fields_by_name()
+    field_names = [x.strip() for x in fields_arg.split(',') if x.strip()]
+    unknown_field_names = [x for x in field_names if x not in fields_by_name]
+    if len(unknown_field_names) > 0:
+        raise ApiError("Unknown fields of {}: {}".format(table_spec.schema_table().table.string,
+                                                         ", ".join(unknown_field_names)))
+
+    fields = [table_spec.ID]
+    for field_name in field_names:
+        if fields_by_name[field_name] not in fields:
+            fields.append(fields_by_name[field_name])
+    return fields
+
+
+def api_page_size() -> int:
+    """
+    :return: the number of rows the request asks for with ?limit=N (API_DEFAULT_PAGE_SIZE if it doesn't)
+    """
+    limit_arg = request.args.get('limit', str(API_DEFAULT_PAGE_SIZE))
+    if not limit_arg.isdigit() or not 1 <= int(limit_arg) <= API_MAX_PAGE_SIZE:
+        raise ApiError("The limit must be a number from 1 to {}, not \"{}\"".format(API_MAX_PAGE_SIZE, limit_arg))
+    return int(limit_arg)
+
+
+def api_select(table_spec, fields: List[Field], where_field_value_dict: Dict[Field, Any],
+               after: Union[str, None] = None, limit: Union[int, None] = None) -> List[Dict[str, Any]]:
+    """
+    Selects only the given fields of the rows of a table, ordered by their id
+
+    :param table_spec: the table specification of the table
+    :param fields: the fields to select
+    :param where_field_value_dict: a dict mapping fields to the values they must equal
+    :param after: only select the rows with an id after this one (None to start at the first row)
+    :param limit: the maximum number of rows to select (None for all of them)
+    :return: a dict of every row, mapping field name to value
+    """
+    select_query = select_fields_sql(table_spec.schema_table(), fields, where_field_value_dict,
+                                     keyset_field=table_spec.ID, after=after, limit=limit)
+    with request_cursor() as cur:
+        cur.execute(select_query)
+        field_names = [x.name for x in cur.description]
+        return [dict(zip(field_names, row)) for row in cur.fetchall()]
+
+
+def api_listing(table_spec, filter_fields: List[Field] = None) -> Response:
+    """
+    Lists the rows of a table one page at a time: each page is ordered by id and the next one starts after the id of
+    its last row (?after=id, which the "next" url of the page already has in it)
+
+    :param table_spec: the table specification of the table
+    :param filter_fields: the fields that the rows can be filtered on with ?field=value
+    :return: the page, with the url of the next page (None on the last one)
+    """
+    fields = api_fields(table_spec)
+    limit = api_page_size()
+    after = request.args.get('after')
+    where_field_value_dict = {x: request.args[x.name] for x in filter_fields or [] if x.name in request.args}
+
+    # Selecting one more row than the page tells whether there's another page without counting the rows
+    rows = api_select(table_spec, fields, where_field_value_dict, after=after, limit=limit + 1)
+    next_after = rows[limit - 1][table_spec.ID.name] if len(rows) > limit else None
+    next_url = None
+    if next_after is not None:
+        next_url_args = dict(request.view_args, **request.args.to_dict())
+        next_url_args['after'] = next_after
+        next_url = url_for(request.endpoint, **next_url_args)
+    return json_response({'data': rows[:limit], 'next_after': next_after, 'next': next_url})
+
+
+def api_item(table_spec, item_id: str) -> Response:
+    """
+    :param table_spec: the table specification of the table
+    :param item_id: the id of the row
+    :return: the row (or a 404 if there's no row with the id)
+    """
+    rows = api_select(table_spec, api_fields(table_spec), {table_spec.ID: item_id})
+    if len(rows) == 0:
+        raise ApiError("There is no row of {} with id \"{}\"".format(table_spec.schema_table().table.string, item_id),
+                       status_code=404)
+    return json_response(rows[0])
+
+
+def api_block_table_spec(block_name: str):
+    """
+    :param block_name: the name of a block in the urls of the JSON API (i.e. exposition)
+    :return: its table specification (or a 404 if there's no such block)
+    """
+    if block_name not in API_BLOCK_TABLE_SPECS:
+        raise ApiError("There is no block \"{}\", the blocks are {}".format(
+            block_name, ", ".join(API_BLOCK_TABLE_SPECS)), status_code=404)
+    return API_BLOCK_TABLE_SPECS[block_name]
+
+
+@app.route('/api/composers')
+def api_composers():
+    return api_listing(Composer)
+
+
+@app.route('/api/composers/<composer_id>')
+def api_composer(composer_id: str):
+    return api_item(Composer, composer_id)
+
+
+@app.route('/api/pieces')
+def api_pieces():
+    return api_listing(Piece, filter_fields=[Piece.COMPOSER_ID])
+
+
+@app.route('/api/pieces/<piece_id>')
+def api_piece(piece_id: str):
+    return api_item(Piece, piece_id)
+
+
+@app.route('/api/sonatas')
+def api_sonatas():
+    return api_listing(Sonata, filter_fields=[Sonata.PIECE_ID])
+
+
+@app.route('/api/sonatas/<sonata_id>')
+def api_sonata(sonata_id: str):
+    return api_item(Sonata, sonata_id)
+
+
+@app.route('/api/blocks/<block_name>')
+def api_blocks(block_name: str):
+    block_table_spec = api_block_table_spec(block_name)
+    return api_listing(block_table_spec, filter_fields=[block_table_spec.SONATA_ID])
+
+
+@app.route('/api/blocks/<block_name>/<block_id>')
+def api_block(block_name: str, block_id: str):
+    return api_item(api_block_table_spec(block_name), block_id)
+
+
+@app.route('/metrics')
+def metrics():
+    # The metrics of the queries, the connection pool and the result cache in the Prometheus text format
+    lines = LocalhostCursor.query_metrics.prometheus_lines()
+
+    pool_metrics = LocalhostCursor.get_connection_manager().metrics()
+    for name, metric_type, help_text, key in [
+            ("in_use", "gauge", "How many connections are in use", 'in_use'),
+            ("idle", "gauge", "How many open connections are waiting to be handed out", 'idle'),
+            ("max", "gauge", "The maximum number of connections", 'max_connections'),
+            ("waiters", "gauge", "How many threads are waiting for a connection", 'waiters'),
+            ("timeouts_total", "counter", "How many waits for a connection timed out", 'timeouts'),
+            ("rejected_total", "counter", "How many threads were turned away for too many waiters", 'rejected')]:
+        lines.extend(format_prometheus_metric("sonata_pool_connections_" + name, metric_type, help_text,
+                                              [("", {}, pool_metrics[key])]))
+    wait_time_samples = [("_bucket", {'le': format_upper_bound(upper_bound)}, count)
+                         for upper_bound, count in pool_metrics['wait_time_histogram']]
+    wait_time_samples.append(("_sum", {}, pool_metrics['wait_time_sum']))
+    wait_time_samples.append(("_count", {}, pool_metrics['wait_time_count']))
+    lines.extend(format_prometheus_metric("sonata_pool_wait_seconds", "histogram",
+                                          "How long getting a connection took", wait_time_samples))
+
+    with _request_connection_stats_lock:
+        request_connection_stats = dict(_request_connection_stats)
+    lines.extend(format_prometheus_metric("sonata_request_connections_total", "counter",
+                                          "How many requests checked out a connection",
+                                          [("", {}, request_connection_stats['requests'])]))
+    lines.extend(format_prometheus_metric("sonata_request_connection_uses_total", "counter",
+                                          "How many cursors used the connections of those requests",
+                                          [("", {}, request_connection_stats['uses'])]))
+
+    cache_metrics = LocalhostCursor.result_cache.metrics()
+    for name, metric_type, help_text, key in [
+            ("generation", "gauge", "The archive generation the cached results are from", 'generation'),
+            ("results", "gauge", "How many results are cached", 'results'),
+            ("bytes", "gauge", "How many bytes the cached results take up", 'bytes'),
+            ("hits_total", "counter", "How many queries were answered from the cache", 'hits'),
+            ("misses_total", "counter", "How many queries weren't in the cache", 'misses'),
+            ("evictions_total", "counter", "How many results were evicted to stay under the memory cap",
+             'evictions')]:
+        value = cache_metrics[key]
+        lines.extend(format_prometheus_metric("sonata_result_cache_" + name, metric_type, help_text,
+                                              [("", {}, value if value is not None else "NaN")]))
+
+    page_cache_metrics = page_cache.metrics()
+    for name, metric_type, help_text, key in [
+            ("generation", "gauge", "The archive generation the cached pages are from", 'generation'),
+            ("pages", "gauge", "How many pages are cached", 'results'),
+            ("bytes", "gauge", "How many bytes the cached pages take up", 'bytes'),
+            ("hits_total", "counter", "How many pages were served from the cache", 'hits'),
+            ("misses_total", "counter", "How many pages had to be rendered", 'misses'),
+            ("evictions_total", "counter", "How many pages were evicted to stay under the memory cap", 'evictions')]:
+        value = page_cache_metrics[key]
+        lines.extend(format_prometheus_metric("sonata_page_cache_" + name, metric_type, help_text,
+                                              [("", {}, value if value is not None else "NaN")]))
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(APP_DIR, 'static'),
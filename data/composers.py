@@ -2,8 +2,8 @@
 """
 The core module for all composer classes.
 
-Keep this as the only data file in the root directory to ensure it is upserted first since it is a precondition
-for all the other files since they link to the composers with FKs
+This module is always upserted before every other data file that imports its composers since they link to the
+composers with FKs (see get_data_module_names_in_upsert_order)
 """
 from datetime import date
 from typing import Dict, Any
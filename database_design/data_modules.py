@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""
+A module containing helpers to discover the python modules in the data directory, import them, grab the DataClasses
+defined in them and compute content hashes so that we can tell which of them changed since the last rebuild.
+
+What the DataClasses in every module are (and what they link to) is cached in the DataClassRegistry manifest so that
+only the modules that changed (or that are actually being upserted) ever need to be imported.
+"""
+import ast
+import glob
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+from typing import List, Dict, Tuple, Type, Set, Iterable, Union, Any
+
+from database_design.sonata_data_classes import DataClass, ComposerDataClass, PieceDataClass, SonataDataClass
+from database_design.sonata_table_specs import Composer, Piece, Sonata
+from database_design.table_spec import TableSpecification
+from directories import DATA_DIR, ROOT_DIR
+
+log = logging.getLogger(__name__)
+
+# Where the DataClassRegistry caches its manifest (not checked in since it is rebuilt from the data dir as needed)
+DATA_CLASS_REGISTRY_PATH = os.path.join(ROOT_DIR, '.data_class_registry.json')
+
+# The packages whose source determines the tables and the derived values we write, so if any file in them changes
+# the whole database has to be rebuilt
+DESIGN_DEPENDENCY_DIRS = [
+    os.path.join(ROOT_DIR, 'database_design'),
+    os.path.join(ROOT_DIR, 'enums'),
+    os.path.join(ROOT_DIR, 'general_utils'),
+]
+
+# The kinds of DataClass in the order they depend on each other (pieces link to composers and sonatas link to pieces)
+DATA_CLASS_KINDS_IN_DEPENDENCY_ORDER = [ComposerDataClass, PieceDataClass, SonataDataClass]
+
+# The table whose id each kind of DataClass owns (sonata blocks are owned through the cascading FKs to the sonata)
+DATA_CLASS_OWNED_TABLE_SPECS = [
+    (SonataDataClass, Sonata),
+    (PieceDataClass, Piece),
+    (ComposerDataClass, Composer),
+]
+
+
+def get_data_file_full_paths() -> List[str]:
+    """
+    Gets the full paths of all python files recursively under the data dir (skipping the __init__.py module specifier
+    files since they don't count) in a deterministic order.
+
+    Note that this order says nothing about dependencies between the files, use get_data_module_names_in_upsert_order
+    for the order they must be upserted in.
+
+    :return: a sorted list of the full paths of all data files
+    """
+    data_file_full_path_list = glob.glob(os.path.join(DATA_DIR, '**/*.py'), recursive=True)
+    return sorted(x for x in data_file_full_path_list if os.path.basename(x) != '__init__.py')
+
+
+def get_module_name_from_data_dirname(data_file_full_path: str) -> str:
+    """
+    Given a full path from a data file, this method will convert it into a module name by stripping it down to just the
+    elements beyond the root dir and then joining them with '.'
+
+    :param data_file_full_path: the string name of the full path
+    :return: the module name of the data file (i.e. data.beethoven.symphonies.beethoven5)
+    """
+    module_element_list = []
+
+    # Pop the last element off the full path until we reach the ROOT_DIR
+    path = data_file_full_path
+    while True:
+        # If path is ROOT_DIR, we have everything
+        if path == ROOT_DIR:
+            break
+        elif path == "" or path == os.path.dirname(path):
+            raise Exception(
+                "Error! Root directory {} not present at the base of path {}".format(ROOT_DIR, data_file_full_path))
+
+        # Pop off the last element and extension and insert it at the beginning of the list
+        path, last = os.path.split(path)
+        last = os.path.splitext(last)[0]   # remove extension
+
+        # insert at the beginning since last element popped is actually the earliest dir
+        module_element_list.insert(0, last)
+
+    return '.'.join(module_element_list)
+
+
+def get_data_file_full_path_from_module_name(module_name: str) -> str:
+    """
+    The inverse of get_module_name_from_data_dirname
+
+    :param module_name: the module name of a data file (i.e. data.composers)
+    :return: the full path of the python file for that module
+    """
+    return os.path.join(ROOT_DIR, *module_name.split('.')) + '.py'
+
+
+def import_data_module(module_name: str):
+    """
+    Imports a data module by its module name
+
+    :param module_name: the module name of a data file (i.e. data.composers)
+    :return: the imported module
+    """
+    return importlib.import_module(module_name)
+
+
+def get_data_classes(data_module) -> List[Tuple[str, Type[DataClass]]]:
+    """
+    Gets a list of all the DataClasses defined in the given data module (excluding any that are merely imported)
+
+    Will throw an error if a) a module contains no classes defined in it or b) the class defined in the data module
+    is not a subclass of DataClass.
+
+    :param data_module: the imported data module
+    :return: a list of tuples of (cls_name, cls) in the order inspect.getmembers returns them
+    """
+    # Get a list of all the classes defined in the given module (returns tuples of cls_name, and cls)
+    class_list_tuples = inspect.getmembers(data_module, lambda member:
+                                           inspect.isclass(member) and member.__module__ == data_module.__name__)
+    # Note: Checking member's module necessary to avoid imports
+
+    if len(class_list_tuples) == 0:
+        raise Exception("\"{}\" contained no classes! "
+                        "Every module in the data directory must contain at least 1 class"
+                        "".format(data_module))
+
+    for cls_name, cls in class_list_tuples:
+        if not issubclass(cls, DataClass):
+            raise Exception("\"{}\" contained the class \"{}\", which was not a subclass of \"DataClass\"!"
+                            "".format(data_module, cls_name))
+
+    return class_list_tuples
+
+
+def get_owned_ids(data_module) -> Dict[str, List[str]]:
+    """
+    Gets the ids of all rows that the DataClasses of a data module write, keyed by the table they live in.
+
+    Only the composer, piece and sonata ids are tracked since deleting a sonata cascades to all of its blocks.
+
+    :param data_module: the imported data module
+    :return: a dict mapping table name to a sorted list of ids owned by the module in that table
+    """
+    owned_ids = {}
+    for cls_name, cls in get_data_classes(data_module):
+        for data_class_type, table_spec in DATA_CLASS_OWNED_TABLE_SPECS:
+            if issubclass(cls, data_class_type):
+                owned_ids.setdefault(table_spec.schema_table().table.string, []).append(cls.id())
+                break
+    return {table_name: sorted(ids) for table_name, ids in owned_ids.items()}
+
+
+def get_owned_table_specs_in_delete_order() -> List[Type[TableSpecification]]:
+    """
+    The order we need to delete owned rows in so that no FK is violated (sonatas, then pieces, then composers)
+
+    :return: a list of table spec classes
+    """
+    return [table_spec for data_class_type, table_spec in DATA_CLASS_OWNED_TABLE_SPECS]
+
+
+def get_data_module_imports(data_file_full_path: str) -> Set[str]:
+    """
+    Parses (without importing) a data file to find all other data modules that it imports, like data.composers
+
+    :param data_file_full_path: the full path of the data file
+    :return: a set of the module names of the data modules it imports
+    """
+    with open(data_file_full_path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=data_file_full_path)
+
+    imported_module_names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module is not None:
+            imported_module_names.add(node.module)
+        elif isinstance(node, ast.Import):
+            imported_module_names.update(alias.name for alias in node.names)
+
+    return {x for x in imported_module_names
+            if x.startswith('data.') and os.path.exists(get_data_file_full_path_from_module_name(x))}
+
+
+def _hash_files(full_path_list: List[str]) -> str:
+    """
+    Computes a sha256 hex digest over the contents of the given files (in the order given)
+
+    :param full_path_list: the full paths of the files to hash
+    :return: the hex digest
+    """
+    sha = hashlib.sha256()
+    for full_path in full_path_list:
+        # Include the path relative to the root so that renaming a file changes the hash
+        sha.update(os.path.relpath(full_path, ROOT_DIR).encode('utf-8'))
+        with open(full_path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def compute_design_hash() -> str:
+    """
+    Computes a hash over all python files that the table and data class design depends on
+
+    :return: the hex digest
+    """
+    full_path_list = []
+    for design_dir in DESIGN_DEPENDENCY_DIRS:
+        full_path_list.extend(glob.glob(os.path.join(design_dir, '**/*.py'), recursive=True))
+    return _hash_files(sorted(full_path_list))
+
+
+def compute_data_module_hashes(registry: 'DataClassRegistry' = None) -> Dict[str, str]:
+    """
+    Computes a hash for every data module over its own source and the sources of every data module that it imports
+    (transitively), since i.e. a piece pulls its composer's id out of data.composers
+
+    :param registry: the DataClassRegistry to get the hashes from, loads it if not given
+    :return: a dict mapping module name to its hash, in the order of get_data_file_full_paths
+    """
+    registry = DataClassRegistry.load() if registry is None else registry
+    return registry.source_hashes()
+
+
+def describe_data_classes(data_module) -> List[Dict[str, Any]]:
+    """
+    Describes the DataClasses defined in the given data module the way the DataClassRegistry caches them: by name,
+    kind (see get_data_class_kind), id and the id of the row they link to (a piece's composer or a sonata's piece)
+
+    :param data_module: the imported data module
+    :return: a list of dicts with the keys name, kind, id and depends_on_id (the last three may be None)
+    """
+    descriptions = []
+    for cls_name, cls in get_data_classes(data_module):
+        kind = get_data_class_kind(cls)
+        if kind is PieceDataClass:
+            depends_on_id = cls.piece_attribute_dict().get(Piece.COMPOSER_ID)
+        elif kind is SonataDataClass:
+            depends_on_id = cls.sonata_attribute_dict().get(Sonata.PIECE_ID)
+        else:
+            depends_on_id = None
+        descriptions.append({
+            'name': cls_name,
+            'kind': kind.__name__ if kind is not None else None,
+            'id': cls.id() if kind is not None else None,
+            'depends_on_id': depends_on_id,
+        })
+    return descriptions
+
+
+def get_data_class_dependency_graph(module_names: Iterable[str], registry: 'DataClassRegistry' = None
+                                    ) -> Dict[Tuple[str, str], Set[Tuple[str, str]]]:
+    """
+    Builds an explicit dependency DAG between all DataClasses of the given data modules (from the DataClassRegistry,
+    so without importing them), where every piece depends on the composer it links to and every sonata (with its
+    blocks) depends on the piece it links to.
+
+    Links to ids that none of the given modules define are ignored (those rows either already exist in the database
+    or the FKs will complain just like they would in a serial upsert).
+
+    :param module_names: the module names of the data files to include
+    :param registry: the DataClassRegistry to build it from, loads it if not given
+    :return: a dict mapping each node, a tuple of (module_name, cls_name), to the set of nodes it depends on
+    """
+    registry = DataClassRegistry.load() if registry is None else registry
+    return registry.dependency_graph(module_names)
+
+
+def get_data_class_kind(cls: Type[DataClass]) -> Union[Type[DataClass], None]:
+    """
+    Gets which kind of DataClass (composer, piece or sonata) the given DataClass is
+
+    :param cls: the DataClass
+    :return: ComposerDataClass, PieceDataClass or SonataDataClass (or None if it's none of those)
+    """
+    for kind in DATA_CLASS_KINDS_IN_DEPENDENCY_ORDER:
+        if issubclass(cls, kind):
+            return kind
+    return None
+
+
+def topologically_sort(graph: Dict[Any, Set[Any]]) -> List[Any]:
+    """
+    Sorts the nodes of a dependency graph so that every node comes after all of the nodes it depends on. Ties are
+    broken by the order of the nodes in the graph so that the result is deterministic.
+
+    :param graph: a dict mapping each node to the set of nodes it depends on
+    :return: the list of sorted nodes
+    :raises Exception: if the graph contains a cycle
+    """
+    remaining = {node: set(x for x in dependencies if x in graph) for node, dependencies in graph.items()}
+    sorted_nodes = []
+    while len(remaining) > 0:
+        ready = [node for node, dependencies in remaining.items() if len(dependencies) == 0]
+        if len(ready) == 0:
+            raise Exception("Dependency cycle between {}".format(sorted(remaining)))
+        for node in ready:
+            sorted_nodes.append(node)
+            del remaining[node]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+    return sorted_nodes
+
+
+def get_data_module_names_in_upsert_order(module_names: Iterable[str] = None,
+                                          registry: 'DataClassRegistry' = None) -> List[str]:
+    """
+    Orders data modules so that every module is upserted after all the modules its DataClasses depend on
+    (i.e. data.composers always comes before the modules with the pieces of those composers).
+
+    :param module_names: the module names to order, defaults to all data modules
+    :param registry: the DataClassRegistry to get their dependencies from, loads it if not given
+    :return: the list of ordered module names
+    """
+    registry = DataClassRegistry.load() if registry is None else registry
+    module_names = registry.module_names() if module_names is None else list(module_names)
+
+    module_graph = {module_name: set() for module_name in module_names}
+    for (module_name, cls_name), dependencies in registry.dependency_graph(module_names).items():
+        module_graph[module_name].update(x[0] for x in dependencies if x[0] != module_name)
+
+    return topologically_sort(module_graph)
+
+
+class DataClassRegistry(object):
+    """
+    A persistent registry of every module in the data directory and the DataClasses defined in it, cached in a JSON
+    manifest (at DATA_CLASS_REGISTRY_PATH) so that the rebuild can order, schedule and keep track of the data modules
+    without importing and inspecting every one of them.
+
+    For every module the manifest stores its path, mtime, content hash and data imports, a source hash over it and
+    every data module it imports (transitively) and the name, kind, id and linked id of each DataClass defined in it.
+
+    The manifest invalidates itself: a file is only re-read if its mtime changed and a module is only re-imported if
+    its source hash changed (or the database_design changed, since that defines what ids the DataClasses have).
+    """
+
+    MANIFEST_VERSION = 1
+
+    def __init__(self, modules: Dict[str, Dict[str, Any]], design_hash: str):
+        """
+        Creates a registry from already up-to-date entries (use load to get one)
+
+        :param modules: a dict mapping module name to its manifest entry
+        :param design_hash: the design hash the DataClasses were described with
+        """
+        self._modules = modules
+        self.design_hash = design_hash
+
+    @classmethod
+    def load(cls, manifest_path: str = DATA_CLASS_REGISTRY_PATH) -> 'DataClassRegistry':
+        """
+        Loads the registry from its manifest, brings it up to date with the data dir (importing only modules that
+        changed since the manifest was written) and writes the manifest back if anything changed
+
+        :param manifest_path: the path of the manifest
+        :return: the up-to-date registry
+        """
+        manifest = cls._read_manifest(manifest_path)
+        cached_modules = manifest.get('modules', {})
+        design_hash = compute_design_hash()
+        design_changed = manifest.get('design_hash') != design_hash
+
+        modules = {}
+        for data_file_full_path in get_data_file_full_paths():
+            module_name = get_module_name_from_data_dirname(data_file_full_path)
+            mtime = os.path.getmtime(data_file_full_path)
+            cached_entry = cached_modules.get(module_name)
+
+            if cached_entry is not None and cached_entry['mtime'] == mtime:
+                modules[module_name] = dict(cached_entry)
+                continue
+
+            entry = {
+                'path': os.path.relpath(data_file_full_path, ROOT_DIR),
+                'mtime': mtime,
+                'hash': _hash_files([data_file_full_path]),
+                'imports': sorted(get_data_module_imports(data_file_full_path)),
+            }
+            if cached_entry is not None:
+                # Keep the classes around in case only the mtime changed (the source hash below decides)
+                entry['source_hash'] = cached_entry.get('source_hash')
+                entry['classes'] = cached_entry.get('classes')
+            modules[module_name] = entry
+
+        for module_name, entry in modules.items():
+            source_hash = cls._compute_source_hash(module_name, modules)
+            if design_changed or entry.get('source_hash') != source_hash or entry.get('classes') is None:
+                log.info("Registering the DataClasses of {}".format(module_name))
+                entry['source_hash'] = source_hash
+                entry['classes'] = describe_data_classes(import_data_module(module_name))
+
+        registry = cls(modules, design_hash)
+        if design_changed or modules != cached_modules:
+            registry.write_manifest(manifest_path)
+        return registry
+
+    @classmethod
+    def _read_manifest(cls, manifest_path: str) -> Dict[str, Any]:
+        """
+        Reads the manifest if it exists and is from this version of the registry
+
+        :param manifest_path: the path of the manifest
+        :return: the manifest (or an empty dict if there is no usable manifest)
+        """
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except ValueError:
+            log.warning("Could not parse {}, rebuilding it".format(manifest_path))
+            return {}
+        return manifest if manifest.get('version') == cls.MANIFEST_VERSION else {}
+
+    @staticmethod
+    def _compute_source_hash(module_name: str, modules: Dict[str, Dict[str, Any]]) -> str:
+        """
+        Computes the hash of a module over its own content hash and those of every data module it imports (transitively)
+
+        :param module_name: the module name
+        :param modules: a dict mapping module name to its manifest entry (with its hash and imports)
+        :return: the hex digest
+        """
+        dependencies = set()
+        to_visit = list(modules[module_name]['imports'])
+        while len(to_visit) > 0:
+            dependency = to_visit.pop()
+            if dependency not in dependencies and dependency != module_name and dependency in modules:
+                dependencies.add(dependency)
+                to_visit.extend(modules[dependency]['imports'])
+
+        sha = hashlib.sha256()
+        for x in [module_name] + sorted(dependencies):
+            sha.update(x.encode('utf-8'))
+            sha.update(modules[x]['hash'].encode('utf-8'))
+        return sha.hexdigest()
+
+    def write_manifest(self, manifest_path: str = DATA_CLASS_REGISTRY_PATH) -> None:
+        """
+        Writes the registry to its manifest (atomically, so a concurrent reader never sees half a manifest)
+
+        :param manifest_path: the path of the manifest
+        """
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.MANIFEST_VERSION, 'design_hash': self.design_hash, 'modules': self._modules},
+                      f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    def module_names(self) -> List[str]:
+        """
+        :return: the names of all data modules in the order of get_data_file_full_paths
+        """
+        return list(self._modules)
+
+    def source_hashes(self) -> Dict[str, str]:
+        """
+        :return: a dict mapping every data module name to its source hash (see compute_data_module_hashes)
+        """
+        return {module_name: entry['source_hash'] for module_name, entry in self._modules.items()}
+
+    def data_classes(self, module_name: str) -> List[Dict[str, Any]]:
+        """
+        :param module_name: the name of a data module
+        :return: the descriptions of the DataClasses defined in it (see describe_data_classes)
+        """
+        return self._modules[module_name]['classes']
+
+    def owned_ids(self, module_name: str) -> Dict[str, List[str]]:
+        """
+        The same as get_owned_ids but without importing the module
+
+        :param module_name: the name of a data module
+        :return: a dict mapping table name to a sorted list of ids owned by the module in that table
+        """
+        table_name_by_kind = {data_class_type.__name__: table_spec.schema_table().table.string
+                              for data_class_type, table_spec in DATA_CLASS_OWNED_TABLE_SPECS}
+        owned_ids = {}
+        for description in self.data_classes(module_name):
+            if description['kind'] in table_name_by_kind:
+                owned_ids.setdefault(table_name_by_kind[description['kind']], []).append(description['id'])
+        return {table_name: sorted(ids) for table_name, ids in owned_ids.items()}
+
+    def dependency_graph(self, module_names: Iterable[str]) -> Dict[Tuple[str, str], Set[Tuple[str, str]]]:
+        """
+        See get_data_class_dependency_graph
+
+        :param module_names: the module names of the data files to include
+        :return: a dict mapping each node, a tuple of (module_name, cls_name), to the set of nodes it depends on
+        """
+        descriptions = {}
+        for module_name in module_names:
+            for description in self.data_classes(module_name):
+                descriptions[(module_name, description['name'])] = description
+
+        # Map (kind, id) --> node so we can look up what every class links to
+        node_by_kind_id = {(x['kind'], x['id']): node for node, x in descriptions.items() if x['kind'] is not None}
+
+        graph = {}
+        for node, description in descriptions.items():
+            if description['kind'] == PieceDataClass.__name__:
+                dependency = node_by_kind_id.get((ComposerDataClass.__name__, description['depends_on_id']))
+            elif description['kind'] == SonataDataClass.__name__:
+                dependency = node_by_kind_id.get((PieceDataClass.__name__, description['depends_on_id']))
+            else:
+                dependency = None
+            graph[node] = {dependency} if dependency is not None else set()
+
+        return graph
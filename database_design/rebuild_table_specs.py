@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+A module containing the specification for the bookkeeping tables that rebuild_database.py uses to keep track of its
+own runs (these are not part of the sonata data and are never shown in the column display table)
+"""
+from typing import Tuple, List, Union
+
+from psycopg2 import sql
+
+from database_design.sonata_table_specs import sonata_archives_schema
+from database_design.table_spec import TableSpecification
+from general_utils.sql_utils import Field, SQLType, SchemaTable
+
+
+class DataModuleHash(TableSpecification):
+    """
+    The table that stores a content hash for every module in the data directory as of the last time it was upserted,
+    along with the ids of the rows it wrote, so that an incremental rebuild can skip unchanged modules and delete
+    the rows of modules that were removed
+    """
+
+    @classmethod
+    def schema_table(cls) -> SchemaTable:
+        return SchemaTable(sonata_archives_schema, "data_module_hash")
+
+    MODULE_NAME = Field("module_name")
+    SOURCE_HASH = Field("source_hash")  # Hash of the module and every data module it imports
+    DESIGN_HASH = Field("design_hash")  # Hash of the database_design (and its dependencies) it was upserted with
+    OWNED_IDS = Field("owned_ids")  # A JSON object mapping table name to the list of ids the module wrote
+    UPSERTED_AT = Field("upserted_at")
+
+    @classmethod
+    def field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
+        return [
+            (cls.MODULE_NAME, SQLType.TEXT_PRIMARY_KEY),
+            (cls.SOURCE_HASH, SQLType.TEXT),
+            (cls.DESIGN_HASH, SQLType.TEXT),
+            (cls.OWNED_IDS, SQLType.JSONB_DEFAULT_EMPTY_OBJ),
+            (cls.UPSERTED_AT, SQLType.TIMESTAMP),
+        ]
+
+    @classmethod
+    def create_constraints_sql(cls) -> Union[sql.Composable, None]:
+        return None
+
+
+class RebuildMetrics(TableSpecification):
+    """
+    The table that stores how long every span of every rebuild took (the rebuild itself, each of its phases, each data
+    module and each DataClass), along with how many statements it executed and how many rows it wrote.
+
+    Unlike the other tables this is never dropped by a rebuild, so it keeps the history of all rebuilds.
+    """
+
+    @classmethod
+    def schema_table(cls) -> SchemaTable:
+        return SchemaTable(sonata_archives_schema, "rebuild_metrics")
+
+    REBUILD_ID = Field("rebuild_id")  # When the rebuild started, shared by all spans of a rebuild
+    REBUILD_MODE = Field("rebuild_mode")
+    SPAN_KIND = Field("span_kind")  # rebuild, phase, data_module, data_class or table
+    SPAN_NAME = Field("span_name")
+    PARENT_SPAN_NAME = Field("parent_span_name")
+    DEPTH = Field("depth")
+    STARTED_AT = Field("started_at")
+    SECONDS = Field("seconds")
+    STATEMENT_COUNT = Field("statement_count")
+    ROW_COUNT = Field("row_count")
+
+    @classmethod
+    def field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
+        return [
+            (cls.REBUILD_ID, SQLType.TEXT),
+            (cls.REBUILD_MODE, SQLType.TEXT),
+            (cls.SPAN_KIND, SQLType.TEXT),
+            (cls.SPAN_NAME, SQLType.TEXT),
+            (cls.PARENT_SPAN_NAME, SQLType.TEXT),
+            (cls.DEPTH, SQLType.INTEGER),
+            (cls.STARTED_AT, SQLType.TIMESTAMP),
+            (cls.SECONDS, SQLType.DOUBLE_PRECISION),
+            (cls.STATEMENT_COUNT, SQLType.INTEGER),
+            (cls.ROW_COUNT, SQLType.INTEGER),
+        ]
+
+    @classmethod
+    def create_constraints_sql(cls) -> Union[sql.Composable, None]:
+        return None
+
+
+class ArchiveGeneration(TableSpecification):
+    """
+    The table that stores the generation of the archive in a single row: a number that every rebuild bumps once it's
+    done, so that caches of query results (see QueryResultCache) know when the data they were read from changed.
+
+    Like the rebuild metrics this is never dropped by a rebuild (a shadow rebuild carries it over), so the generation
+    only ever goes up.
+    """
+
+    @classmethod
+    def schema_table(cls) -> SchemaTable:
+        return SchemaTable(sonata_archives_schema, "archive_generation")
+
+    GENERATION = Field("generation")
+    BUMPED_AT = Field("bumped_at")
+
+    @classmethod
+    def field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
+        return [
+            (cls.GENERATION, SQLType.INTEGER),
+            (cls.BUMPED_AT, SQLType.TIMESTAMP),
+        ]
+
+    @classmethod
+    def create_constraints_sql(cls) -> Union[sql.Composable, None]:
+        return None
+
+    @classmethod
+    def select_generation_sql(cls) -> sql.Composable:
+        """
+        Returns the sql that selects the current generation (NULL if no rebuild bumped it yet)
+
+        :return: the sql as a Composable
+        """
+        return sql.SQL("SELECT max({g}) FROM {st};").format(g=cls.GENERATION, st=cls.schema_table())
+
+    @classmethod
+    def select_generation_and_bumped_at_sql(cls) -> sql.Composable:
+        """
+        Returns the sql that selects the current generation and when it was bumped (no row if no rebuild bumped it yet)
+
+        :return: the sql as a Composable
+        """
+        return sql.SQL("SELECT {g}, {ba} FROM {st} ORDER BY {g} DESC LIMIT 1;").format(
+            g=cls.GENERATION, ba=cls.BUMPED_AT, st=cls.schema_table())
@@ -4,21 +4,35 @@ A module containing the abstract base classes that all sonata_data classes will
 """
 import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Type, Union
+from typing import Dict, Any, Type, Union, List, Tuple
 
 from psycopg2 import sql, extensions
+from psycopg2.extras import execute_values
 
 from enums.key_enums import KeyStruct, validate_is_key_struct
 from database_design.sonata_table_specs import Composer, Piece, Sonata, Intro, Expo, Development, \
     Recap, Coda, SonataBlockTableSpecification
+from database_design.table_spec import TableSpecification
 from enums.measure_enums import validate_is_measure_range
 from enums.sonata_enums import MC
-from general_utils.sql_utils import Field, upsert_sql_from_field_value_dict
+from general_utils.sql_utils import Field, Table, execute_upsert, create_staging_table_sql, \
+    merge_staging_table_sql, update_from_staging_table_sql, strip_whitespace, DEFAULT, as_sql_string
+from general_utils.sql_trace import trace_sql
+from general_utils.time_helpers import profiled
 from general_utils.type_helpers import validate_is_list
 
 log = logging.getLogger(__name__)
 
 
+def table_fields(table_spec: Type[TableSpecification]) -> List[Field]:
+    """
+    :param table_spec: a table spec
+    :return: every field of its table, which upsert_data overwrites on an existing row (resetting the ones a DataClass
+    doesn't specify, so that a rebuild that only upserts some DataClasses ends up the same as a full rebuild)
+    """
+    return [x[0] for x in table_spec.field_sql_type_list()]
+
+
 class DataClass(ABC):
     """
     An abstract base class that all Data Classes will extend an implement its upsert_data method.
@@ -33,6 +47,16 @@ class DataClass(ABC):
         :param cur: the postgres cursor to use to upsert the data
         """
 
+    @classmethod
+    @abstractmethod
+    def table_rows(cls) -> List[Tuple[Type[TableSpecification], Dict[Field, Any]]]:
+        """
+        Gets every row (with all derived fields and ids added) that upsert_data writes, so that they can also be loaded
+        in bulk with a BulkLoader
+
+        :return: a list of tuples of (table spec, dict of fields to their values)
+        """
+
 
 class ComposerDataClass(DataClass, ABC):
     """
@@ -61,6 +85,10 @@ class ComposerDataClass(DataClass, ABC):
         :return: a dict of field to their values
         """
 
+    @classmethod
+    def table_rows(cls) -> List[Tuple[Type[TableSpecification], Dict[Field, Any]]]:
+        return [(Composer, cls.composer_attribute_dict())]
+
     @classmethod
     def upsert_data(cls, cur: extensions.cursor) -> None:
         """
@@ -74,10 +102,8 @@ class ComposerDataClass(DataClass, ABC):
         # EXCLUDED is the posgres name of the records that couldn't be inserted so we use update with those records
 
         # Upsert Composer
-        upsert_sql = upsert_sql_from_field_value_dict(Composer.schema_table(), cls.composer_attribute_dict(),
-                                                      conflict_field_list=[Composer.ID])
-        log.info("\n\n" + upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
+        execute_upsert(cur, Composer.schema_table(), cls.composer_attribute_dict(), conflict_field_list=[Composer.ID],
+                       overwrite_field_list=table_fields(Composer))
 
 
 class PieceDataClass(DataClass, ABC):
@@ -108,14 +134,12 @@ class PieceDataClass(DataClass, ABC):
         """
 
     @classmethod
-    def upsert_data(cls, cur) -> None:
+    def piece_row(cls) -> Dict[Field, Any]:
         """
-        The core upsert method that uses the attribute dict to insert (if the relevant id does not exist) or update (
-        if the id does exist).
-
-        If no full name was provided for the Piece, it will create it based on its name, catalogue_id and nickname.
+        Gets the row for the piece table, which is the attribute dict with the full name added if it was not provided
+        (created based on its name, catalogue_id and nickname)
 
-        :param cur: the postgres cursor to use to upsert the data
+        :return: a dict of fields to their values
         """
         piece_dict = cls.piece_attribute_dict()
 
@@ -125,15 +149,30 @@ class PieceDataClass(DataClass, ABC):
                                                                nickname=piece_dict.get(Piece.NICKNAME),
                                                                global_key=piece_dict.get(Piece.GLOBAL_KEY))
             # Note: using .get() instead of [] so no key error if not there
+        return piece_dict
+
+    @classmethod
+    def table_rows(cls) -> List[Tuple[Type[TableSpecification], Dict[Field, Any]]]:
+        return [(Piece, cls.piece_row())]
+
+    @classmethod
+    def upsert_data(cls, cur) -> None:
+        """
+        The core upsert method that uses the attribute dict to insert (if the relevant id does not exist) or update (
+        if the id does exist).
+
+        If no full name was provided for the Piece, it will create it based on its name, catalogue_id and nickname.
+
+        :param cur: the postgres cursor to use to upsert the data
+        """
+        piece_dict = cls.piece_row()
 
         # Use postgres's brand-new ON CONFLICT framework that allows for upserting
         # EXCLUDED is the posgres name of the records that couldn't be inserted so we use update with those records
 
         # Upsert Piece
-        upsert_sql = upsert_sql_from_field_value_dict(Piece.schema_table(), piece_dict,
-                                                      conflict_field_list=[Piece.ID])
-        log.info("\n\n" + upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
+        execute_upsert(cur, Piece.schema_table(), piece_dict, conflict_field_list=[Piece.ID],
+                       overwrite_field_list=table_fields(Piece))
 
     @classmethod
     def create_full_name(cls, name: str, catalogue_id: Union[str, None] = None, nickname: Union[str, None] = None,
@@ -408,6 +447,92 @@ class SonataDataClass(DataClass, ABC):
 
         return new_attribute_dict
 
+    @classmethod
+    def sonata_block_specs(cls) -> List[Tuple[Type[SonataBlockTableSpecification], Field, Union[Field, None], str]]:
+        """
+        Gets the 5 sonata blocks along with how the sonata links to each of them.
+
+        :return: a list of tuples of (block table spec, the sonata field linking to the block, the sonata boolean field
+        for whether the block is present (None for the 2 essential blocks all sonatas have), the suffix appended to
+        the sonata id to get the block id) in the order the blocks are upserted
+        """
+        return [
+            (Expo, Sonata.EXPOSITION_ID, None, 'e'),
+            (Recap, Sonata.RECAPITULATION_ID, None, 'r'),
+            (Intro, Sonata.INTRODUCTION_ID, Sonata.INTRODUCTION_PRESENT, 'i'),
+            (Development, Sonata.DEVELOPMENT_ID, Sonata.DEVELOPMENT_PRESENT, 'd'),
+            (Coda, Sonata.CODA_ID, Sonata.CODA_PRESENT, 'c'),
+        ]
+
+    @classmethod
+    def block_attribute_dict(cls, sonata_block_cls: Type[SonataBlockTableSpecification]) -> Dict[Field, Any]:
+        """
+        Gets the attribute dict for the given sonata block (i.e. exposition_attribute_dict for Expo)
+
+        :param sonata_block_cls: the class of the sonata block
+        :return: a dict of fields to their values
+        """
+        return {
+            Intro: cls.introduction_attribute_dict,
+            Expo: cls.exposition_attribute_dict,
+            Development: cls.development_attribute_dict,
+            Recap: cls.recapitulation_attribute_dict,
+            Coda: cls.coda_attribute_dict,
+        }[sonata_block_cls]()
+
+    @classmethod
+    def present_block_rows(cls) -> List[Tuple[Type[SonataBlockTableSpecification], Dict[Field, Any]]]:
+        """
+        Gets the rows for all blocks present in this sonata (the 2 essential ones and any optional ones whose boolean
+        is True), augmented with their derived fields and with their ids and the link back to the sonata added
+
+        :return: a list of tuples of (block table spec, block dict)
+        """
+        sonata_dict = cls.sonata_attribute_dict()
+        block_rows = []
+        for sonata_block_cls, link_field, present_field, suffix in cls.sonata_block_specs():
+            if present_field is None or sonata_dict[present_field]:
+                block_dict = cls.augment_with_derived_fields(cls.block_attribute_dict(sonata_block_cls),
+                                                             sonata_block_cls)
+                # Will auto-add ids for each of the sonata blocks by appending i/e/d/r/c
+                block_dict[SonataBlockTableSpecification.ID] = "{}_{}".format(cls.id(), suffix)
+                block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
+                block_rows.append((sonata_block_cls, block_dict))
+        return block_rows
+
+    @classmethod
+    def absent_block_ids(cls) -> List[Tuple[Type[SonataBlockTableSpecification], str]]:
+        """
+        Gets the ids of the optional blocks that are not present in this sonata (so they need to be deleted in case a
+        previous version of the sonata had them)
+
+        :return: a list of tuples of (block table spec, block id)
+        """
+        sonata_dict = cls.sonata_attribute_dict()
+        return [(sonata_block_cls, "{}_{}".format(cls.id(), suffix))
+                for sonata_block_cls, link_field, present_field, suffix in cls.sonata_block_specs()
+                if present_field is not None and not sonata_dict[present_field]]
+
+    @classmethod
+    def sonata_row(cls) -> Dict[Field, Any]:
+        """
+        Gets the row for the sonata table with its own id and the links to all of its present blocks added
+
+        :return: a dict of fields to their values
+        """
+        sonata_dict = cls.sonata_attribute_dict()
+        sonata_dict[Sonata.ID] = cls.id()
+
+        # Only the booleans decide which blocks are present, so there's no need to build the block rows here
+        for sonata_block_cls, link_field, present_field, suffix in cls.sonata_block_specs():
+            if present_field is None or sonata_dict[present_field]:
+                sonata_dict[link_field] = "{}_{}".format(cls.id(), suffix)
+        return sonata_dict
+
+    @classmethod
+    def table_rows(cls) -> List[Tuple[Type[TableSpecification], Dict[Field, Any]]]:
+        return [(Sonata, cls.sonata_row())] + cls.present_block_rows()
+
     @classmethod
     def upsert_data(cls, cur: extensions.cursor) -> None:
         """
@@ -420,6 +545,19 @@ class SonataDataClass(DataClass, ABC):
         :param cur: the postgres cursor to use to upsert the data
         """
 
+        ##########################
+        # DELETE ABSENT BLOCKS
+        ##########################
+
+        # Delete any optional block whose boolean is false (this will cascade delete the sonata and its other blocks
+        # as well if the sonata linked to it, which is why we do it first before upserting anything)
+        for sonata_block_cls, block_id in cls.absent_block_ids():
+            delete_sql = sql.SQL("DELETE FROM {schema_table} WHERE {id} = %s;").format(
+                schema_table=sonata_block_cls.schema_table(),
+                id=sonata_block_cls.ID)
+            trace_sql(delete_sql, (block_id,))
+            cur.execute(delete_sql, (block_id,))
+
         #########################
         # SONATA INITIAL INSERT #
         #########################
@@ -432,114 +570,145 @@ class SonataDataClass(DataClass, ABC):
         # Add the sonata's own id to the dict (since already added the rest)
         sonata_dict[Sonata.ID] = cls.id()
 
-        # Upsert Sonata (with only links to the blocks we upserted)
-        upsert_sql = upsert_sql_from_field_value_dict(Sonata.schema_table(), sonata_dict,
-                                                      conflict_field_list=[Sonata.ID])
-        log.info(upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
+        # (The links to the blocks are left as they are until the last upsert below sets them)
+        execute_upsert(cur, Sonata.schema_table(), sonata_dict, conflict_field_list=[Sonata.ID],
+                       overwrite_field_list=[x for x in table_fields(Sonata)
+                                             if x not in BulkLoader.DEFERRED_LINK_FIELDS[Sonata]])
 
         #################
         # SONATA BLOCKS
         #################
 
-        # Will auto-add ids for each of the 5 sonata blocks by appending i/e/d/r/c
-        intro_id = "{}_i".format(cls.id())
-        expo_id = "{}_e".format(cls.id())
-        devel_id = "{}_d".format(cls.id())
-        recap_id = "{}_r".format(cls.id())
-        coda_id = "{}_c".format(cls.id())
-
-        # Upsert the 2 essential sonata block tables that all sonatas have
-
-        # Upsert Exposition
-        block_dict = cls.augment_with_derived_fields(cls.exposition_attribute_dict(), Expo)
-        block_dict[SonataBlockTableSpecification.ID] = expo_id
-        block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
-        sonata_dict[Sonata.EXPOSITION_ID] = expo_id
-        upsert_sql = upsert_sql_from_field_value_dict(Expo.schema_table(), block_dict,
-                                                      conflict_field_list=[Expo.ID])
-        log.info(upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
-
-        # Upsert Recapitulation
-        block_dict = cls.augment_with_derived_fields(cls.recapitulation_attribute_dict(), Recap)
-        block_dict[SonataBlockTableSpecification.ID] = recap_id
-        block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
-        sonata_dict[Sonata.RECAPITULATION_ID] = recap_id
-        upsert_sql = upsert_sql_from_field_value_dict(Recap.schema_table(), block_dict,
-                                                      conflict_field_list=[Recap.ID])
-        log.info(upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
-
-        # Upsert the 3 optional sonata block tables that they will have depending on the booleans present
-
-        # Upsert Introduction if boolean True
-        if cls.sonata_attribute_dict()[Sonata.INTRODUCTION_PRESENT]:
-            block_dict = cls.augment_with_derived_fields(cls.introduction_attribute_dict(), Intro)
-            block_dict[SonataBlockTableSpecification.ID] = intro_id
-            block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
-            sonata_dict[Sonata.INTRODUCTION_ID] = intro_id
-            upsert_sql = upsert_sql_from_field_value_dict(Intro.schema_table(), block_dict,
-                                                          conflict_field_list=[Intro.ID])
-            log.info(upsert_sql.as_string(cur) + "\n")
-            cur.execute(upsert_sql)
-        else:
-            # Delete from Introduction if boolean false (this will cascade delete the sonata as well)
-            delete_sql = sql.SQL("DELETE FROM {schema_table} WHERE {id} = {id_val};").format(
-                schema_table=Intro.schema_table(),
-                id=Intro.ID, id_val=sql.Literal(intro_id))
-            log.info(delete_sql.as_string(cur) + "\n")
-            cur.execute(delete_sql)
-
-        # Upsert Development if boolean True
-        if cls.sonata_attribute_dict()[Sonata.DEVELOPMENT_PRESENT]:
-            block_dict = cls.augment_with_derived_fields(cls.development_attribute_dict(), Development)
-            block_dict[SonataBlockTableSpecification.ID] = devel_id
-            block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
-            sonata_dict[Sonata.DEVELOPMENT_ID] = devel_id
-            upsert_sql = upsert_sql_from_field_value_dict(Development.schema_table(), block_dict,
-                                                          conflict_field_list=[Development.ID])
-            log.info("\n\n" + upsert_sql.as_string(cur) + "\n")
-            cur.execute(upsert_sql)
-        else:
-            # Delete from Development if boolean false (this will cascade delete the sonata as well)
-            delete_sql = sql.SQL("DELETE FROM {schema_table} WHERE {id} = {id_val};").format(
-                schema_table=Development.schema_table(),
-                id=Development.ID, id_val=sql.Literal(devel_id))
-            log.info(delete_sql.as_string(cur) + "\n")
-            cur.execute(delete_sql)
-
-        # Upsert Coda if boolean True
-        if cls.sonata_attribute_dict()[Sonata.CODA_PRESENT]:
-            block_dict = cls.augment_with_derived_fields(cls.coda_attribute_dict(), Coda)
-            block_dict[SonataBlockTableSpecification.ID] = coda_id
-            block_dict[SonataBlockTableSpecification.SONATA_ID] = cls.id()
-            sonata_dict[Sonata.CODA_ID] = coda_id
-            upsert_sql = upsert_sql_from_field_value_dict(Coda.schema_table(), block_dict,
-                                                          conflict_field_list=[Coda.ID])
-            log.info(upsert_sql.as_string(cur) + "\n")
-            cur.execute(upsert_sql)
-        else:
-            # Delete from Coda if boolean false (this will cascade delete the sonata as well)
-            delete_sql = sql.SQL("DELETE FROM {schema_table} WHERE {id} = {id_val};").format(
-                schema_table=Coda.schema_table(),
-                id=Coda.ID, id_val=sql.Literal(coda_id))
-            log.info(delete_sql.as_string(cur) + "\n")
-            cur.execute(delete_sql)
+        # Upsert the 2 essential sonata block tables that all sonatas have and the optional ones that are present
+        for sonata_block_cls, block_dict in cls.present_block_rows():
+            execute_upsert(cur, sonata_block_cls.schema_table(), block_dict, conflict_field_list=[sonata_block_cls.ID],
+                           overwrite_field_list=table_fields(sonata_block_cls))
 
         #################################
         # SONATA UPDATE WITH BLOCK IDS
         ################################
 
         # Now that we have built the sonata blocks we can now update the sonata again with the id to the blocks
-        # (Notice above that we had been adding the ids to sonata_block so we can repeat the same insert)
-
-        # Upsert Sonata (with only links to the blocks we upserted)
-        upsert_sql = upsert_sql_from_field_value_dict(Sonata.schema_table(), sonata_dict,
-                                                      conflict_field_list=[Sonata.ID])
-
-        log.info(upsert_sql.as_string(cur) + "\n")
-        cur.execute(upsert_sql)
+        execute_upsert(cur, Sonata.schema_table(), cls.sonata_row(), conflict_field_list=[Sonata.ID],
+                       overwrite_field_list=table_fields(Sonata))
 
         # Note: because the FK constraints between sonata and the blocks are cascade deletes, deleting any block
         # or the sonata it links to sonata deletes everything relating to that sonata
+
+
+class BulkLoader(object):
+    """
+    A bulk alternative to running upsert_data on every DataClass: gathers the rows of any number of DataClasses into
+    per-table buffers and then loads each table with a few set-based statements (paged multi-row inserts into a
+    temporary staging table and a single merge into the real table) instead of one statement per row.
+
+    Just like upsert_data, the merge overwrites every column of an existing row (with its default if the DataClass
+    does not specify it), so the tables end up exactly matching the DataClasses.
+    """
+
+    # The order the tables have to be merged in to satisfy the FKs
+    TABLE_SPECS_IN_LOAD_ORDER = [Composer, Piece, Sonata, Intro, Expo, Development, Recap, Coda]
+
+    # The sonata links to its blocks and the blocks link back to the sonata, so the links are only set after the
+    # blocks have been merged
+    DEFERRED_LINK_FIELDS = {
+        Sonata: [Sonata.INTRODUCTION_ID, Sonata.EXPOSITION_ID, Sonata.DEVELOPMENT_ID, Sonata.RECAPITULATION_ID,
+                 Sonata.CODA_ID],
+    }
+
+    def __init__(self, page_size: int = 1000):
+        """
+        Creates an empty bulk loader
+
+        :param page_size: the max number of rows inserted into a staging table in a single statement
+        """
+        self.page_size = page_size
+        self._reset_buffers()
+
+    def _reset_buffers(self) -> None:
+        """
+        Empties the row and delete buffers of every table
+        """
+        self._row_buffers = {table_spec: {} for table_spec in self.TABLE_SPECS_IN_LOAD_ORDER}
+        self._delete_buffers = {table_spec: set() for table_spec in self.TABLE_SPECS_IN_LOAD_ORDER}
+
+    def add_data_class(self, data_cls: Type[DataClass]) -> None:
+        """
+        Adds all rows (and deletes) of the given DataClass to the buffers. If a row with the same id was already added,
+        the new row replaces it just like a later upsert_data would.
+
+        :param data_cls: the DataClass to add
+        """
+        for table_spec, row in data_cls.table_rows():
+            self._row_buffers[table_spec][row[table_spec.ID]] = row
+        if issubclass(data_cls, SonataDataClass):
+            for sonata_block_cls, block_id in data_cls.absent_block_ids():
+                self._delete_buffers[sonata_block_cls].add(block_id)
+
+    @property
+    def row_count(self) -> int:
+        """
+        The number of rows currently in the buffers
+        :return: the row count
+        """
+        return sum(len(x) for x in self._row_buffers.values())
+
+    def load(self, cur: extensions.cursor) -> None:
+        """
+        Loads everything in the buffers into the database (within the cursor's transaction) and clears them.
+
+        :param cur: the postgres cursor to use to load the data
+        """
+        # Delete absent blocks first, since that cascades to their sonatas and the sonatas' other blocks which will
+        # all be merged back in below
+        for table_spec, ids in self._delete_buffers.items():
+            if len(ids) > 0:
+                delete_sql = sql.SQL("DELETE FROM {st} WHERE {id} IN %s;").format(st=table_spec.schema_table(),
+                                                                                  id=table_spec.ID)
+                delete_params = (tuple(sorted(ids)),)
+                trace_sql(delete_sql, delete_params)
+                cur.execute(delete_sql, delete_params)
+
+        for table_spec in self.TABLE_SPECS_IN_LOAD_ORDER:
+            rows = list(self._row_buffers[table_spec].values())
+            if len(rows) == 0:
+                continue
+
+            with profiled("table", table_spec.schema_table().table.string):
+                field_list = [x[0] for x in table_spec.field_sql_type_list()]
+                unknown_fields = {field.name for row in rows for field in row} - {field.name for field in field_list}
+                if len(unknown_fields) > 0:
+                    raise Exception("Rows for {} contained fields not in its table spec: {}"
+                                    "".format(table_spec.schema_table().string, sorted(unknown_fields)))
+
+                staging_table = Table("bulk_load_{}".format(table_spec.schema_table().table.string))
+                staging_sql = create_staging_table_sql(staging_table, table_spec.schema_table())
+                trace_sql(staging_sql)
+                cur.execute(staging_sql)
+
+                # Fields a row does not specify get the column default just like they would with upsert_data
+                insert_sql = sql.SQL("INSERT INTO {staging} ({fields}) VALUES %s").format(
+                    staging=staging_table, fields=sql.SQL(", ").join(field_list))
+                trace_sql(insert_sql)
+                execute_values(cur, as_sql_string(insert_sql, cur),
+                               [tuple(strip_whitespace(row[field]) if field in row else DEFAULT for field in field_list)
+                                for row in rows],
+                               page_size=self.page_size)
+
+                deferred_fields = self.DEFERRED_LINK_FIELDS.get(table_spec, [])
+                merge_sql = merge_staging_table_sql(table_spec.schema_table(), staging_table,
+                                                    [x for x in field_list if x not in deferred_fields],
+                                                    conflict_field_list=[table_spec.ID])
+                trace_sql(merge_sql)
+                cur.execute(merge_sql)
+
+        # Now that all blocks exist, set the deferred links
+        for table_spec, deferred_fields in self.DEFERRED_LINK_FIELDS.items():
+            if len(self._row_buffers[table_spec]) > 0:
+                staging_table = Table("bulk_load_{}".format(table_spec.schema_table().table.string))
+                update_sql = update_from_staging_table_sql(table_spec.schema_table(), staging_table, deferred_fields,
+                                                           id_field=table_spec.ID)
+                trace_sql(update_sql)
+                cur.execute(update_sql)
+
+        self._reset_buffers()
@@ -2,15 +2,72 @@
 """
 A module containing the specification for the base SQL tables (and views, which act like tables)
 """
+import threading
 from abc import abstractmethod
 from typing import Tuple, List, Set, Any, Dict, Union
 
 from psycopg2 import sql, extensions
 
 from database_design.table_spec import TableSpecification
+from enums.key_enums import Key, KeyStruct
 from general_utils.sql_utils import Field, SQLType, SchemaTable, Schema
 
-sonata_archives_schema = Schema("sonata_archives")
+SONATA_ARCHIVES_SCHEMA_NAME = "sonata_archives"
+
+sonata_archives_schema = Schema(SONATA_ARCHIVES_SCHEMA_NAME)
+
+# The enum type of the columns that hold a single key (like the tables, it lives in the sonata archives schema, which
+# a SchemaTable names just the same)
+KEY_SQL_TYPE = SchemaTable(sonata_archives_schema, "musical_key")
+
+# Every key, in the order of the enum (by tonic pitch class and then major before minor, so keys sort by pitch)
+ALL_KEYS = sorted({x.key_name: x for x in vars(Key).values() if isinstance(x, KeyStruct)}.values(),
+                  key=lambda x: (x.tonic_pitch_class, x.is_minor))
+KEYS_BY_NAME = {x.key_name: x for x in ALL_KEYS}
+
+
+def create_key_type_sql(drop_if_exists: bool = True) -> sql.Composable:
+    """
+    Returns the sql to create the key enum type (the KeyStruct adapter gives the key name, which is its label). If
+    drop_if_exists is true we will replace the type by drop cascading it (which drops any column that uses it, so only
+    do this when recreating all tables anyway)
+
+    :param drop_if_exists: whether to drop cascade the type if it already exists, defaults to true
+    :return: the sql as a Composable
+    """
+    create_type_sql = sql.SQL("CREATE TYPE {key_type} AS ENUM ({key_names});").format(
+        key_type=KEY_SQL_TYPE, key_names=sql.SQL(", ").join(sql.Literal(x.key_name) for x in ALL_KEYS))
+
+    if drop_if_exists:
+        return sql.SQL("DROP TYPE IF EXISTS {key_type} CASCADE;\n").format(key_type=KEY_SQL_TYPE) + create_type_sql
+    else:
+        # Types have no IF NOT EXISTS
+        return sql.SQL("DO $$ BEGIN {create_type_sql} EXCEPTION WHEN duplicate_object THEN NULL; END $$;").format(
+            create_type_sql=create_type_sql)
+
+
+def register_key_typecaster(cursor: extensions.cursor) -> bool:
+    """
+    Registers a typecaster (for all connections) that turns the values of the key enum type back into KeyStructs.
+
+    The type's oid changes whenever the tables are rebuilt, so this has to be run again after a rebuild (until then the
+    keys simply come back as their names)
+
+    :param cursor: the cursor to look up the type with
+    :return: True if the type exists and the typecaster was registered
+    """
+    cursor.execute("SELECT to_regtype(%s)::oid, to_regtype(%s)::oid;",
+                   (KEY_SQL_TYPE.string, KEY_SQL_TYPE.string + "[]"))
+    key_oid, key_array_oid = cursor.fetchone()
+    if key_oid is None:
+        return False
+
+    key_type = extensions.new_type((key_oid,), "MUSICAL_KEY",
+                                   lambda value, cur: None if value is None else KEYS_BY_NAME.get(value, value))
+    extensions.register_type(key_type)
+    if key_array_oid is not None:
+        extensions.register_type(extensions.new_array_type((key_array_oid,), "MUSICAL_KEY[]", key_type))
+    return True
 
 
 class ColumnDisplay(TableSpecification):
@@ -41,32 +98,64 @@ class ColumnDisplay(TableSpecification):
                                                                                 tn=cls.TABLE_NAME,
                                                                                 cn=cls.COLUMN_NAME)
 
+    # The display name of every column of every table (by table name and then column name), loaded with a single
+    # read of the table the first time it's needed and kept until refresh_display_name_catalog is called
+    _display_name_catalog = None  # type: Union[Dict[str, Dict[str, str]], None]
+    _display_name_catalog_lock = threading.Lock()
+
+    @classmethod
+    def display_name_catalog(cls, cursor: extensions.cursor) -> Dict[str, Dict[str, str]]:
+        """
+        Gets the display names of the columns of all tables, loading them from the Column Display table if they
+        weren't loaded yet (or were refreshed since)
+
+        :param cursor: the cursor to load the display names with (if they have to be loaded)
+        :return: a dict mapping table name --> column raw name --> display name
+        """
+        with cls._display_name_catalog_lock:
+            if cls._display_name_catalog is None:
+                select_query = sql.SQL("""
+                      SELECT {tn}, {cn}, {dn}
+                      FROM {st};
+                """).format(st=cls.schema_table(),
+                            tn=cls.TABLE_NAME,
+                            cn=cls.COLUMN_NAME,
+                            dn=cls.DISPLAY_NAME)
+
+                cursor.execute(select_query)
+
+                display_name_catalog = {}
+                for table_name, raw, display in cursor.fetchall():
+                    display_name_catalog.setdefault(table_name, {})[raw] = display
+                cls._display_name_catalog = display_name_catalog
+            return cls._display_name_catalog
+
+    @classmethod
+    def refresh_display_name_catalog(cls, *args) -> None:
+        """
+        Throws out the loaded display names so that they are loaded again the next time they're needed (i.e. after a
+        rebuild refilled the Column Display table)
+
+        :param args: ignored (so that this can be used as a callback that's passed something, like the generation)
+        """
+        with cls._display_name_catalog_lock:
+            cls._display_name_catalog = None
+
     @classmethod
     def create_new_dict_with_display_name_keys(cls, cursor: extensions.cursor, table_name: str,
                                                dict_with_column_name_keys: Dict[str, Any]) -> Dict[str, Any]:
         """
-        Given a table_name and a dict with keys serving as raw column names, this method will query the Column
-        Display table to return a new dict with the the keys replaced with display names (values remain the same)
+        Given a table_name and a dict with keys serving as raw column names, this method will use the display names
+        of the Column Display table (see display_name_catalog) to return a new dict with the the keys replaced with
+        display names (values remain the same)
 
-        :param cursor: the cursor to use to execute this query
+        :param cursor: the cursor to use to load the display names (if they have to be loaded)
         :param table_name: the name of the table that these column name keys refer to
         :param dict_with_column_name_keys: a dict with column raw names as keys
         :return: a clone of the above dict with all keys replaced by the original key's corresponding display name
         """
 
-        select_query = sql.SQL("""
-              SELECT {cn}, {dn} 
-              FROM {st} 
-              WHERE {tn} = {tn_val};
-        """).format(st=cls.schema_table(),
-                    cn=cls.COLUMN_NAME,
-                    dn=cls.DISPLAY_NAME,
-                    tn=cls.TABLE_NAME,
-                    tn_val=sql.Literal(table_name))
-
-        cursor.execute(select_query)
-
-        raw_display_map = {raw: display for raw, display in cursor.fetchall()}
+        raw_display_map = cls.display_name_catalog(cursor).get(table_name, {})
         try:
             dict_with_display_name_keys = {raw_display_map[key]: value
                                            for key, value in dict_with_column_name_keys.items()}
@@ -151,7 +240,7 @@ class Piece(TableSpecification):
             (cls.YEAR_STARTED, SQLType.INTEGER),
             (cls.YEAR_COMPLETED, SQLType.INTEGER),
             (cls.PREMIER_DATE, SQLType.DATE),
-            (cls.GLOBAL_KEY, SQLType.TEXT),
+            (cls.GLOBAL_KEY, KEY_SQL_TYPE),
             (cls.NUM_MOVEMENTS, SQLType.INTEGER),
         ]
 
@@ -161,6 +250,10 @@ class Piece(TableSpecification):
             .format(st=cls.schema_table(), id=cls.ID, comp_id=cls.COMPOSER_ID,
                     c_st=Composer.schema_table(), c_id=Composer.ID)
 
+    @classmethod
+    def create_indexes_sql(cls) -> Union[sql.Composable, None]:
+        return sql.SQL("CREATE INDEX ON {st} ({comp_id});").format(st=cls.schema_table(), comp_id=cls.COMPOSER_ID)
+
 
 class Sonata(TableSpecification):
     """
@@ -203,7 +296,7 @@ class Sonata(TableSpecification):
             (cls.PIECE_ID, SQLType.TEXT),
             (cls.MOVEMENT_NUM, SQLType.INTEGER),
             (cls.SONATA_TYPE, SQLType.TEXT),
-            (cls.GLOBAL_KEY, SQLType.TEXT),
+            (cls.GLOBAL_KEY, KEY_SQL_TYPE),
             (cls.MEASURE_COUNT, SQLType.INTEGER),
             (cls.EXPOSITION_REPEAT, SQLType.BOOLEAN_DEFAULT_TRUE),
             (cls.DEVELOPMENT_RECAP_REPEAT, SQLType.BOOLEAN_DEFAULT_FALSE),
@@ -237,6 +330,14 @@ class Sonata(TableSpecification):
                                 recap_id=cls.RECAPITULATION_ID, r_st=Recap.schema_table(), r_id=Piece.ID,
                                 coda_id=cls.CODA_ID, c_st=Coda.schema_table(), c_id=Piece.ID)
 
+    @classmethod
+    def create_indexes_sql(cls) -> Union[sql.Composable, None]:
+        # Index the piece (to look up the sonatas of a piece) and every block link (which the cascading deletes of the
+        # blocks look up the sonata by)
+        return sql.SQL("\n").join(sql.SQL("CREATE INDEX ON {st} ({field});").format(st=cls.schema_table(), field=x)
+                                  for x in [cls.PIECE_ID, cls.INTRODUCTION_ID, cls.EXPOSITION_ID, cls.DEVELOPMENT_ID,
+                                            cls.RECAPITULATION_ID, cls.CODA_ID])
+
 
 class SonataBlockTableSpecification(TableSpecification):
     """
@@ -398,21 +499,23 @@ class SonataBlockTableSpecification(TableSpecification):
 
             # If necessary, add the relative key version of it right afterwards
             if field in cls.absolute_key_fields():
-                if sql_type != SQLType.TEXT and sql_type != SQLType.JSONB:
+                if sql_type != KEY_SQL_TYPE and sql_type != SQLType.TEXT and sql_type != SQLType.JSONB:
                     raise Exception("Field \"{}\" in class {} was marked as an absolute key field, which means it "
-                                    "should have a SQLType of TEXT OR JSONB instead of {}"
+                                    "should have a SQLType of KEY_SQL_TYPE, TEXT OR JSONB instead of {}"
                                     "".format(field.name, cls.__name__, sql_type))
                 relative_key_field = cls.get_relative_key_field_from_absolute_key_field(field)
-                new_list.append((relative_key_field, sql_type))
+                # A relative key is a roman numeral, not a key
+                new_list.append((relative_key_field, SQLType.TEXT if sql_type == KEY_SQL_TYPE else sql_type))
 
             # If necessary, compute the measure length right after it
             if field in cls.measure_range_fields_to_compute_measure_counts():
-                if sql_type != SQLType.TEXT and sql_type != SQLType.JSONB:
+                if sql_type != SQLType.INT4RANGE and sql_type != SQLType.TEXT and sql_type != SQLType.JSONB:
                     raise Exception("Field \"{}\" in class {} was marked as a measure range, which means it "
-                                    "should have a SQLType of TEXT OR JSONB instead of {}"
+                                    "should have a SQLType of INT4RANGE, TEXT OR JSONB instead of {}"
                                     "".format(field.name, cls.__name__, sql_type))
                 measure_count_field = cls.get_measure_count_field_from_measure_range_field(field)
-                new_list.append((measure_count_field, sql_type))
+                # The count of a single range is a number
+                new_list.append((measure_count_field, SQLType.INTEGER if sql_type == SQLType.INT4RANGE else sql_type))
 
         return new_list
 
@@ -422,6 +525,10 @@ class SonataBlockTableSpecification(TableSpecification):
                        ).format(st=cls.schema_table(), id=cls.ID, sonata_id=cls.SONATA_ID,
                                 s_st=Sonata.schema_table(), s_id=Sonata.ID)
 
+    @classmethod
+    def create_indexes_sql(cls) -> Union[sql.Composable, None]:
+        return sql.SQL("CREATE INDEX ON {st} ({sonata_id});").format(st=cls.schema_table(), sonata_id=cls.SONATA_ID)
+
 
 class Intro(SonataBlockTableSpecification):
     """
@@ -473,16 +580,16 @@ class Intro(SonataBlockTableSpecification):
         return [
             (cls.ID, SQLType.TEXT_PRIMARY_KEY),
             (cls.SONATA_ID, SQLType.TEXT),
-            (cls.MEASURES, SQLType.TEXT),
+            (cls.MEASURES, SQLType.INT4RANGE),
             (cls.NUM_CYCLES, SQLType.INTEGER),
             (cls.INTRODUCTION_TYPE, SQLType.TEXT),
             (cls.COMMENTS, SQLType.TEXT),
             (cls.OPENING_TEMPO, SQLType.TEXT),
-            (cls.OPENING_KEY, SQLType.TEXT),
+            (cls.OPENING_KEY, KEY_SQL_TYPE),
             (cls.OTHER_KEYS_LIST, SQLType.JSONB),
             (cls.EXPOSITION_WINDUP, SQLType.BOOLEAN_DEFAULT_FALSE),
-            (cls.EXPOSITION_WINDUP_MEASURE, SQLType.TEXT),
-            (cls.ENDING_KEY, SQLType.TEXT),
+            (cls.EXPOSITION_WINDUP_MEASURE, SQLType.INT4RANGE),
+            (cls.ENDING_KEY, KEY_SQL_TYPE),
             (cls.ENDING_CADENCE, SQLType.TEXT),
         ]
 
@@ -710,7 +817,7 @@ class Expo(SonataBlockTableSpecification):
         return [
             (cls.ID, SQLType.TEXT_PRIMARY_KEY),
             (cls.SONATA_ID, SQLType.TEXT),
-            (cls.MEASURES, SQLType.TEXT),
+            (cls.MEASURES, SQLType.INT4RANGE),
             (cls.NUM_CYCLES, SQLType.INTEGER),
             (cls.CONTINUOUS, SQLType.BOOLEAN_DEFAULT_FALSE),
             (cls.CONTINUOUS_SUBTYPE, SQLType.TEXT),
@@ -722,7 +829,7 @@ class Expo(SonataBlockTableSpecification):
     @classmethod
     def _p_field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
         return [
-            (cls.P_MEASURES, SQLType.TEXT),
+            (cls.P_MEASURES, SQLType.INT4RANGE),
             (cls.P_COMMENTS, SQLType.TEXT),
             (cls.P_TYPE, SQLType.TEXT),
             (cls.P_MODULE_MEASURES_DICT, SQLType.JSONB),
@@ -730,9 +837,9 @@ class Expo(SonataBlockTableSpecification):
             (cls.P_MODULE_PHRASE_DICT, SQLType.JSONB),
             (cls.P_MODULE_DYNAMICS_DICT, SQLType.JSONB),
             (cls.P_PAC_MEASURES_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
-            (cls.P_OPENING_KEY, SQLType.TEXT),
+            (cls.P_OPENING_KEY, KEY_SQL_TYPE),
             (cls.P_OTHER_KEYS_LIST, SQLType.JSONB),
-            (cls.P_ENDING_KEY, SQLType.TEXT),
+            (cls.P_ENDING_KEY, KEY_SQL_TYPE),
             (cls.P_ENDING_CADENCE, SQLType.TEXT),
         ]
 
@@ -740,7 +847,7 @@ class Expo(SonataBlockTableSpecification):
     def _tr_field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
         return [
             (cls.TR_PRESENT, SQLType.BOOLEAN_DEFAULT_TRUE),
-            (cls.TR_MEASURES, SQLType.TEXT),
+            (cls.TR_MEASURES, SQLType.INT4RANGE),
             (cls.TR_COMMENTS, SQLType.TEXT),
             (cls.TR_TYPE, SQLType.TEXT),
             (cls.TR_MODULE_MEASURES_DICT, SQLType.JSONB),
@@ -753,9 +860,9 @@ class Expo(SonataBlockTableSpecification):
             (cls.TR_HAMMER_COUNT, SQLType.INTEGER),
             (cls.TR_MC_EFFECT_MEASURES_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
             (cls.TR_PAC_MEASURES_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
-            (cls.TR_OPENING_KEY, SQLType.TEXT),
+            (cls.TR_OPENING_KEY, KEY_SQL_TYPE),
             (cls.TR_OTHER_KEYS_LIST, SQLType.TEXT),
-            (cls.TR_ENDING_KEY, SQLType.TEXT),
+            (cls.TR_ENDING_KEY, KEY_SQL_TYPE),
             (cls.TR_ENDING_CADENCE, SQLType.TEXT),
 
         ]
@@ -764,19 +871,19 @@ class Expo(SonataBlockTableSpecification):
     def _mc_field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
         return [
             (cls.MC_PRESENT, SQLType.BOOLEAN_DEFAULT_TRUE),
-            (cls.MC_MEASURES, SQLType.TEXT),
+            (cls.MC_MEASURES, SQLType.INT4RANGE),
             (cls.MC_DYNAMICS, SQLType.TEXT),
             (cls._MC_TYPE, SQLType.TEXT),  # Derived field so never specify it
             (cls.MC_COMMENTS, SQLType.TEXT),
             (cls.MC_STYLE, SQLType.TEXT),
-            (cls.MC_FILL_KEY, SQLType.TEXT),
+            (cls.MC_FILL_KEY, KEY_SQL_TYPE),
         ]
 
     @classmethod
     def _s_field_sql_type_list(cls) -> List[Tuple[Field, SQLType]]:
         return [
             (cls.S_PRESENT, SQLType.BOOLEAN_DEFAULT_TRUE),
-            (cls.S_MEASURES, SQLType.TEXT),
+            (cls.S_MEASURES, SQLType.INT4RANGE),
             (cls.S_COMMENTS, SQLType.TEXT),
             (cls.S_TYPE, SQLType.TEXT),
             (cls.S_MODULE_MEASURES_DICT, SQLType.JSONB),
@@ -786,12 +893,12 @@ class Expo(SonataBlockTableSpecification):
             (cls.S_STRONG_PAC_MEAS_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
             (cls.S_ATTEN_PAC_MEAS_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
             (cls.S_EVADED_PAC_MEAS_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
-            (cls.S_OPENING_KEY, SQLType.TEXT),
+            (cls.S_OPENING_KEY, KEY_SQL_TYPE),
             (cls.S_OTHER_KEYS_LIST, SQLType.JSONB),
-            (cls.S_ENDING_KEY, SQLType.TEXT),
+            (cls.S_ENDING_KEY, KEY_SQL_TYPE),
             (cls.S_ENDING_CADENCE, SQLType.TEXT),
             (cls.EEC_ESC_SECURED, SQLType.BOOLEAN_DEFAULT_TRUE),
-            (cls.EEC_ESC_MEASURE, SQLType.TEXT),
+            (cls.EEC_ESC_MEASURE, SQLType.INT4RANGE),
             (cls.EEC_ESC_COMMENTS, SQLType.TEXT),
             (cls.EEC_ESC_DYNAMICS, SQLType.TEXT),
         ]
@@ -801,7 +908,7 @@ class Expo(SonataBlockTableSpecification):
         return [
             (cls.C_PRESENT, SQLType.BOOLEAN_DEFAULT_TRUE),
             (cls.C_SC_PRE_EEC_ESC, SQLType.BOOLEAN_DEFAULT_FALSE),
-            (cls.C_MEASURES_INCL_C_RT, SQLType.TEXT),
+            (cls.C_MEASURES_INCL_C_RT, SQLType.INT4RANGE),
             (cls.C_COMMENTS, SQLType.TEXT),
             (cls.C_TYPE, SQLType.TEXT),
             (cls.C_MODULE_MEASURES_DICT, SQLType.JSONB),
@@ -809,12 +916,12 @@ class Expo(SonataBlockTableSpecification):
             (cls.C_MODULE_PHRASE_DICT, SQLType.JSONB),
             (cls.C_MODULE_DYNAMICS_DICT, SQLType.JSONB),
             (cls.C_PAC_MEASURES_LIST, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
-            (cls.C_OPENING_KEY, SQLType.TEXT),
+            (cls.C_OPENING_KEY, KEY_SQL_TYPE),
             (cls.C_OTHER_KEYS_LIST, SQLType.JSONB),
-            (cls.C_ENDING_KEY_BEFORE_C_RT, SQLType.TEXT),
+            (cls.C_ENDING_KEY_BEFORE_C_RT, KEY_SQL_TYPE),
             (cls.C_RT_PRESENT, SQLType.BOOLEAN_DEFAULT_FALSE),
-            (cls.C_RT_MEASURES, SQLType.TEXT),
-            (cls.C_RT_ENDING_KEY, SQLType.TEXT),
+            (cls.C_RT_MEASURES, SQLType.INT4RANGE),
+            (cls.C_RT_ENDING_KEY, KEY_SQL_TYPE),
             (cls.C_RT_DYNAMICS, SQLType.TEXT),
         ]
 
@@ -903,12 +1010,12 @@ class Development(SonataBlockTableSpecification):
         return [
             (cls.ID, SQLType.TEXT_PRIMARY_KEY),
             (cls.SONATA_ID, SQLType.TEXT),
-            (cls.MEASURES, SQLType.TEXT),
+            (cls.MEASURES, SQLType.INT4RANGE),
             (cls.NUM_CYCLES, SQLType.INTEGER),
             (cls.DEVELOPMENT_TYPE, SQLType.TEXT),
             (cls.COMMENTS, SQLType.TEXT),
             (cls.OPENING_TEMPO, SQLType.TEXT),
-            (cls.OPENING_KEY, SQLType.TEXT),
+            (cls.OPENING_KEY, KEY_SQL_TYPE),
 
             (cls.OTHER_KEYS_LIST, SQLType.JSONB),  # JSONArray
 
@@ -930,7 +1037,7 @@ class Development(SonataBlockTableSpecification):
             (cls.DEVELOPMENT_THEME_KEYS, SQLType.JSONB),
             (cls.DEVELOPMENT_THEME_COMMENTS, SQLType.TEXT),
 
-            (cls.ENDING_KEY, SQLType.TEXT),
+            (cls.ENDING_KEY, KEY_SQL_TYPE),
             (cls.ENDING_CADENCE, SQLType.TEXT),
         ]
 
@@ -1001,7 +1108,7 @@ class Recap(Expo):
             cls._general_field_sql_type_list(),
             [
                 (cls.FALSE_CRUX_MEASURES, SQLType.JSONB_DEFAULT_EMPTY_ARRAY),
-                (cls.CRUX_MEASURE, SQLType.TEXT),
+                (cls.CRUX_MEASURE, SQLType.INT4RANGE),
                 (cls.P_PRESENT, SQLType.BOOLEAN_DEFAULT_TRUE),
             ],
             cls._p_field_sql_type_list(),
@@ -1083,11 +1190,11 @@ class Coda(SonataBlockTableSpecification):
             (cls.ID, SQLType.TEXT_PRIMARY_KEY),
             (cls.SONATA_ID, SQLType.TEXT),
             (cls.NUM_CYCLES, SQLType.INTEGER),
-            (cls.MEASURES, SQLType.TEXT),
+            (cls.MEASURES, SQLType.INT4RANGE),
             (cls.CODA_TYPE, SQLType.TEXT),
             (cls.COMMENTS, SQLType.TEXT),
             (cls.OPENING_TEMPO, SQLType.TEXT),
-            (cls.OPENING_KEY, SQLType.TEXT),
+            (cls.OPENING_KEY, KEY_SQL_TYPE),
 
             (cls.OTHER_KEYS_LIST, SQLType.JSONB),  # JSONArray
             (cls.P_RECALLED, SQLType.BOOLEAN),
@@ -1097,6 +1204,6 @@ class Coda(SonataBlockTableSpecification):
             (cls.INTRODUCTION_THEME_RECALLED, SQLType.BOOLEAN),
             (cls.DEVELOPMENT_THEME_RECALLED, SQLType.BOOLEAN),
 
-            (cls.ENDING_KEY, SQLType.TEXT),
+            (cls.ENDING_KEY, KEY_SQL_TYPE),
             (cls.ENDING_CADENCE, SQLType.TEXT),
         ]
@@ -7,7 +7,7 @@ from psycopg2 import sql, extensions
 
 from database_design.sonata_table_specs import sonata_archives_schema, Expo, Recap
 from database_design.view_spec import ViewSpecification
-from general_utils.sql_utils import SchemaTable, Field, get_column_names
+from general_utils.sql_utils import SchemaTable
 
 
 class ExpositionRecapitulation(ViewSpecification):
@@ -24,8 +24,9 @@ class ExpositionRecapitulation(ViewSpecification):
     @classmethod
     def view_select_sql(cls, cur: extensions.cursor) -> sql.Composable:
 
-        # Grab all exposition fields and cast them as a field list
-        all_expo_fields_list = [Field(x) for x in get_column_names(Expo.schema_table(), cur)]
+        # Grab all exposition fields from the table spec (which has them in the same order as the table, and unlike
+        # the information schema doesn't need the table to exist so this also works with a RecordingCursor)
+        all_expo_fields_list = [x[0] for x in Expo.field_sql_type_list()]
 
         # Note: since the id of exposition is _e and recap is _r, ordering by id will give us expo before recap
         # for all sonatas (which is what we want)
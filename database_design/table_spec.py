@@ -3,7 +3,7 @@
 A module containing the abstract base class specification for SQL tables (and views, which act like tables)
 """
 from abc import ABC, abstractmethod
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Dict
 
 from psycopg2 import sql
 
@@ -37,15 +37,25 @@ class TableSpecification(ABC):
         """
 
     @classmethod
-    def create_table_sql(cls, drop_if_exists: bool = True) -> sql.Composable:
+    def fields_by_name(cls) -> Dict[str, Field]:
+        """
+        :return: a dict mapping the name of every field of the table to the field
+        """
+        return {field.name: field for field, sql_type in cls.field_sql_type_list()}
+
+    @classmethod
+    def create_table_sql(cls, drop_if_exists: bool = True, if_not_exists: bool = False) -> sql.Composable:
         """
         Returns a create table sql script for this table using the field_sql_type_list. If drop_if_exists is true
         we will replace the table by drop cascading it
 
         :param drop_if_exists: whether to drop cascade the table if it already exists, defaults to true.
+        :param if_not_exists: whether to leave the table alone if it already exists (only makes sense without
+        drop_if_exists), defaults to false.
         :return: the create table script as a SQL Composable
         """
-        create_table_sql = create_table_from_field_sql_type_tuples(cls.schema_table(), cls.field_sql_type_list())
+        create_table_sql = create_table_from_field_sql_type_tuples(cls.schema_table(), cls.field_sql_type_list(),
+                                                                   if_not_exists=if_not_exists)
 
         if drop_if_exists:
             return sql.SQL("DROP TABLE IF EXISTS {st} CASCADE;\n").format(st=cls.schema_table()) + create_table_sql
@@ -62,4 +72,14 @@ class TableSpecification(ABC):
         field_sql_type_list and then use this only for ALTER TABLE SQL to make the foreign keys.
 
         :return: the sql as a Composable
-        """
\ No newline at end of file
+        """
+
+    @classmethod
+    def create_indexes_sql(cls) -> Union[sql.Composable, None]:
+        """
+        Returns a sql script that creates the indexes on this table besides the ones its constraints come with (like
+        on the columns of FKs, which postgres doesn't index on its own). Defaults to no indexes.
+
+        :return: the sql as a Composable (or None if the table has no extra indexes)
+        """
+        return None
\ No newline at end of file
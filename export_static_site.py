@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Exports the whole archive as a static site: renders every page of the app (the composers, the pieces, every composer
+and every piece with all its movements) through its routes and writes them out as a tree of index.html files, along
+with main.css, the images and the lilypond PNGs of every movement, so that the archive can be served by any static file
+server without running the app or postgres.
+
+Pages are rendered in parallel, and only the files whose content changed since the last export are written (what was
+written is kept track of in a manifest in the export directory), so exporting again after a rebuild only touches the
+pages that actually changed and removes the pages of anything that no longer exists.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Tuple, Union
+
+from psycopg2 import sql
+
+from app.app import app
+from database_design.sonata_table_specs import Composer, Piece, Sonata
+from directories import ROOT_DIR, STATIC_DIR, LILYPOND_DIR
+from general_utils.postgres_utils import LocalhostCursor
+
+log = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_DIR = os.path.join(ROOT_DIR, "static_site")
+
+# The manifest of the export (in the export directory) maps the path of every file it wrote to the hash of its content
+EXPORT_MANIFEST_NAME = ".export_manifest.json"
+EXPORT_MANIFEST_VERSION = 1
+
+# The static files every page needs, relative to the static directory
+STATIC_FILES = ["main.css",
+                os.path.join("images", "sonata_form.png"),
+                os.path.join("images", "exposition_form.png")]
+
+
+def get_page_urls() -> List[str]:
+    """
+    Gets the url of every page of the archive
+
+    :return: the urls
+    """
+    page_urls = ['/', '/index', '/composers', '/pieces']
+    with LocalhostCursor(read_only=True) as cur:
+        cur.execute(sql.SQL("SELECT {id} FROM {composer_st} ORDER BY {id};").format(
+            id=Composer.ID, composer_st=Composer.schema_table()))
+        page_urls.extend('/composers/{}'.format(composer_id) for composer_id, in cur.fetchall())
+
+        cur.execute(sql.SQL("SELECT {comp_id}, {id} FROM {piece_st} ORDER BY {comp_id}, {id};").format(
+            id=Piece.ID, comp_id=Piece.COMPOSER_ID, piece_st=Piece.schema_table()))
+        page_urls.extend('/composers/{}/{}'.format(composer_id, piece_id) for composer_id, piece_id in cur.fetchall())
+    return page_urls
+
+
+def get_lilypond_image_filenames() -> List[str]:
+    """
+    Gets the filename of the lilypond image of every movement that has one (see the piece route)
+
+    :return: the filenames, relative to the lilypond directory
+    """
+    with LocalhostCursor(read_only=True) as cur:
+        cur.execute(sql.SQL("SELECT {id} FROM {sonata_st} WHERE {settings} IS NOT NULL ORDER BY {id};").format(
+            id=Sonata.ID, settings=Sonata.LILYPOND_IMAGE_SETTINGS, sonata_st=Sonata.schema_table()))
+        return ['{}.png'.format(sonata_id) for sonata_id, in cur.fetchall()]
+
+
+def get_page_path(url: str) -> str:
+    """
+    :param url: the url of a page
+    :return: the path of its file relative to the export directory (an index.html in the directory of the url, so that
+    the absolute links between the pages keep working)
+    """
+    return os.path.join(*[x for x in url.split('/') if x], 'index.html')
+
+
+def render_page(url: str) -> bytes:
+    """
+    Renders a page through its route (on its own test client, so it can be called from several threads at once)
+
+    :param url: the url of the page
+    :return: the rendered page
+    """
+    response = app.test_client().get(url)
+    if response.status_code != 200:
+        raise Exception("Rendering {} failed with status {}".format(url, response.status_code))
+    return response.get_data()
+
+
+def read_export_manifest(export_dir: str) -> Dict[str, str]:
+    """
+    Reads the manifest of the last export to the directory, if there was one
+
+    :param export_dir: the export directory
+    :return: a dict mapping the path of every file it wrote to the hash of its content (empty if there is none)
+    """
+    manifest_path = os.path.join(export_dir, EXPORT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except ValueError:
+        log.warning("Could not parse {}, writing every file again".format(manifest_path))
+        return {}
+    return manifest.get('files', {}) if manifest.get('version') == EXPORT_MANIFEST_VERSION else {}
+
+
+def write_export_manifest(export_dir: str, file_hashes: Dict[str, str]) -> None:
+    """
+    Writes the manifest of the export (atomically, so an export that is cut short never leaves half a manifest)
+
+    :param export_dir: the export directory
+    :param file_hashes: a dict mapping the path of every file of the export to the hash of its content
+    """
+    manifest_path = os.path.join(export_dir, EXPORT_MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': EXPORT_MANIFEST_VERSION, 'files': file_hashes}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def write_if_changed(export_dir: str, path: str, content: bytes, old_hash: Union[str, None]) -> Tuple[str, bool]:
+    """
+    Writes a file of the export unless the last export already wrote the same content to it
+
+    :param export_dir: the export directory
+    :param path: the path of the file relative to the export directory
+    :param content: the content of the file
+    :param old_hash: the hash of the content the last export wrote to it (None if it didn't)
+    :return: a tuple of the hash of the content and whether the file was written
+    """
+    content_hash = hashlib.sha256(content).hexdigest()
+    full_path = os.path.join(export_dir, path)
+    if content_hash == old_hash and os.path.exists(full_path):
+        return content_hash, False
+
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = full_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, full_path)
+    return content_hash, True
+
+
+def remove_stale_file(export_dir: str, path: str) -> None:
+    """
+    Removes a file the last export wrote that isn't part of the archive anymore, along with the directories that it
+    leaves empty
+
+    :param export_dir: the export directory
+    :param path: the path of the file relative to the export directory
+    """
+    full_path = os.path.join(export_dir, path)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+
+    dir_path = os.path.dirname(full_path)
+    while os.path.abspath(dir_path) != os.path.abspath(export_dir) and os.path.isdir(dir_path) \
+            and not os.listdir(dir_path):
+        os.rmdir(dir_path)
+        dir_path = os.path.dirname(dir_path)
+
+
+def export_static_site(export_dir: str = DEFAULT_EXPORT_DIR, num_workers: int = LocalhostCursor.MAX_CONNECTIONS,
+                       force: bool = False) -> None:
+    """
+    Exports every page of the archive along with the static files they need as a static site
+
+    :param export_dir: the directory to export to
+    :param num_workers: how many pages to render at once (each one holds a connection of the pool while it renders)
+    :param force: if True, writes every file even if the last export already wrote the same content to it
+    """
+    log.info('#' * 40)
+    log.info("EXPORTING THE STATIC SITE TO {}".format(export_dir))
+    log.info('#' * 40 + "\n")
+
+    os.makedirs(export_dir, exist_ok=True)
+    old_file_hashes = {} if force else read_export_manifest(export_dir)
+    file_hashes = {}
+    num_written = 0
+
+    # Static files first, so that the pages never link to anything that isn't there yet
+    static_paths = [(os.path.join(STATIC_DIR, x), os.path.join('static', x)) for x in STATIC_FILES]
+    for filename in get_lilypond_image_filenames():
+        image_full_path = os.path.join(LILYPOND_DIR, filename)
+        if not os.path.exists(image_full_path):
+            log.warning("Missing the lilypond image {} (see render_all_lilypond.py)".format(image_full_path))
+            continue
+        static_paths.append((image_full_path, os.path.join('static', 'lilypond', filename)))
+
+    for full_path, path in static_paths:
+        with open(full_path, 'rb') as f:
+            file_hashes[path], is_written = write_if_changed(export_dir, path, f.read(), old_file_hashes.get(path))
+        num_written += is_written
+
+    page_urls = get_page_urls()
+    log.info("Rendering {} pages with {} workers".format(len(page_urls), num_workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for url, page in zip(page_urls, executor.map(render_page, page_urls)):
+            path = get_page_path(url)
+            file_hashes[path], is_written = write_if_changed(export_dir, path, page, old_file_hashes.get(path))
+            num_written += is_written
+
+    stale_paths = sorted(set(old_file_hashes) - set(file_hashes))
+    for path in stale_paths:
+        remove_stale_file(export_dir, path)
+
+    write_export_manifest(export_dir, file_hashes)
+    log.info("Exported {} files: wrote {}, {} were unchanged and removed {} that no longer exist".format(
+        len(file_hashes), num_written, len(file_hashes) - num_written, len(stale_paths)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', metavar='EXPORT_DIR', default=DEFAULT_EXPORT_DIR,
+                        help="the directory to export the static site to (defaults to %(default)s)")
+    parser.add_argument('--workers', type=int, default=LocalhostCursor.MAX_CONNECTIONS, metavar='NUM_WORKERS',
+                        help="how many pages to render at once (defaults to %(default)s, the size of the connection "
+                             "pool)")
+    parser.add_argument('--force', action='store_true',
+                        help="write every file, even the ones that didn't change since the last export")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    export_static_site(args.output, num_workers=args.workers, force=args.force)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+The asyncio counterpart of postgres_utils: an "async with" cursor on a pool of psycopg2 asynchronous connections, so
+that independent queries can run concurrently (each on its own connection) instead of one after the other.
+
+Built on psycopg2's own asynchronous mode (driven with the event loop's add_reader/add_writer) so that the adapters
+registered in postgres_utils apply just the same. This needs an event loop with add_reader support, i.e. the default
+selector loop (not the proactor loop of windows).
+
+Note that the typecaster of the key enum type isn't registered here (it needs a sync cursor to look up the type, see
+register_key_typecaster in sonata_table_specs), so the rows of an async cursor carry keys as their raw enum text
+(i.e. 'C Major') unless that typecaster was already registered in the process, in which case it applies to the async
+connections too.
+"""
+import asyncio
+import collections
+import copy
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Any, Union, Sequence
+
+import psycopg2
+from psycopg2 import pool, extensions, extras
+
+# Importing postgres_utils registers our adapters (dicts, lists, KeyStructs, MRs) for the async connections too
+import general_utils.postgres_utils  # noqa: F401
+from credentials import pg_localhost
+
+log = logging.getLogger(__name__)
+
+
+async def wait_for_connection(conn: extensions.connection) -> None:
+    """
+    Waits (without blocking the event loop) until the asynchronous connection is done with whatever it was doing
+    (connecting or running a query)
+
+    :param conn: the asynchronous connection
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+
+        ready = loop.create_future()
+
+        def set_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        fd = conn.fileno()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fd, set_ready)
+            remove = loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fd, set_ready)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: {}".format(state))
+
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class AsyncPostgresConnectionManager(object):
+    """
+    A class that stores and manages a pool of psycopg2 asynchronous connections for a postgres database.
+
+    When all connections are in use, get_connection waits (for up to the timeout) for one to be returned. The pool
+    isn't tied to an event loop (waiters are woken up on their own loop), so it can be shared by the event loops of
+    different threads or by one asyncio.run after another.
+    """
+
+    def __init__(self, conn_name, maxconn=5, timeout=30.0, **kwargs):
+        """
+        Creates an empty pool (connections are opened as they are needed)
+
+        :param conn_name: What to name this connection
+        :param maxconn: The maximum number of connections possible
+        :param timeout: The number of seconds get_connection waits for a connection when all are in use
+        :param kwargs: A set of named parameters which should be passed in to open each connection (i.e.
+        user, password, host, port, database)
+        """
+        self._connect_kwargs = kwargs
+        self._lock = threading.Lock()
+        self._idle_conns = []  # type: List[extensions.connection]
+        self._waiters = collections.deque()
+        self.num_utilized_conns = 0
+        self.max_num_conns = maxconn
+        self.timeout = timeout
+        self.conn_name = conn_name
+
+    async def get_connection(self) -> extensions.connection:
+        """
+        Gets an available connection from the pool (opening a new one if none are idle), waiting for one to be
+        returned if all are in use
+
+        :return: the asynchronous connection
+        """
+        with self._lock:
+            if self.num_utilized_conns < self.max_num_conns:
+                self.num_utilized_conns = self.num_utilized_conns + 1
+                waiter = None
+            else:
+                waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+                self._waiters.append(waiter)
+
+        # A returned connection is handed over to the first waiter (see _release), keeping it counted as utilized
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter[1], self.timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                with self._lock:
+                    # If it was already handed over, _wake_waiter sees it was cancelled and passes it on
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise pool.PoolError("{}: timed out after {} seconds waiting for one of the {} connections"
+                                         "".format(self.conn_name, self.timeout, self.max_num_conns))
+                raise
+
+        try:
+            with self._lock:
+                conn = self._idle_conns.pop() if len(self._idle_conns) > 0 else None
+            if conn is None:
+                conn = psycopg2.connect(async_=True, **self._connect_kwargs)
+                await wait_for_connection(conn)
+            return conn
+        except BaseException:
+            self._release()
+            raise
+
+    def return_connection(self, conn: extensions.connection) -> None:
+        """
+        Returns a connection back to the pool (closed connections are thrown away)
+        :param conn: the connection to return
+        """
+        if not conn.closed:
+            with self._lock:
+                self._idle_conns.append(conn)
+        self._release()
+
+    def _release(self) -> None:
+        """
+        Frees up the slot of a connection that was in use by handing it over to the first waiter (on its own event
+        loop) or, if nobody is waiting, by no longer counting it as utilized
+        """
+        with self._lock:
+            while len(self._waiters) > 0:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._wake_waiter, future)
+                    return
+                except RuntimeError:
+                    # The waiter's event loop was closed, so nobody is waiting on it anymore
+                    continue
+            self.num_utilized_conns = self.num_utilized_conns - 1
+
+    def _wake_waiter(self, future: asyncio.Future) -> None:
+        """
+        Hands a freed slot over to a waiter (runs on the waiter's event loop)
+
+        :param future: the future the waiter is waiting on
+        """
+        if future.cancelled():
+            self._release()
+        else:
+            future.set_result(None)
+
+
+class AsyncCursor(object):
+    """
+    A thin wrapper around a cursor of an asynchronous connection whose execute has to be awaited. Everything else
+    (fetchone, fetchall, description, rowcount...) is the wrapped cursor's, since the results are already client side
+    by the time execute returns.
+    """
+
+    def __init__(self, cursor: extensions.cursor):
+        """
+        :param cursor: the cursor of an asynchronous connection
+        """
+        self._cursor = cursor
+
+    async def execute(self, query, vars: Union[Sequence, Dict[str, Any], None] = None) -> None:
+        """
+        Executes the query and waits (without blocking the event loop) for it to finish
+
+        :param query: the query as a string, bytes or Composable
+        :param vars: the parameters to merge into the query, if any
+        """
+        self._cursor.execute(query, vars)
+        await wait_for_connection(self._cursor.connection)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class AsyncPostgresCursor(object, metaclass=ABCMeta):
+    """
+    An abstract class for use in an "async with" construct to get a cursor that can be used to execute queries
+    concurrently with other coroutines, just like the PostgresCursor is for a "with" construct.
+
+    Asynchronous connections are always in autocommit mode, so each "async with" block is wrapped in an explicit
+    transaction that commits if there were no errors and rolls back if there were.
+
+    For example, with a subclass like AsyncLocalhostCursor():
+
+    async with AsyncLocalhostCursor() as cur:
+        await cur.execute("<SQL>")
+        cur.fetchall()
+
+    A connection can only run one query at a time, so queries meant to run concurrently each need their own cursor.
+    """
+
+    _global_conn_manager = None  # type: Union[AsyncPostgresConnectionManager, None]
+    _global_conn_manager_lock = threading.Lock()
+
+    # The size of the connection pool and how long to wait for a connection when all are in use (subclasses can
+    # override these)
+    MAX_CONNECTIONS = 5
+    CONNECTION_TIMEOUT = 30.0
+
+    @staticmethod
+    @abstractmethod
+    def credentials_dict() -> Dict[str, Any]:
+        """
+        Returns the credentials dict that this cursor is going to enable us to query
+        :return: a dictionary containing all named parameters we need to connect
+        (i.e. user, password, host, port, database)
+        """
+
+    @staticmethod
+    @abstractmethod
+    def pg_db_display_name() -> str:
+        """
+        Returns the name of this database (for use in logging)
+
+        :return: the string name of our database we are connecting to
+        """
+
+    @classmethod
+    def get_connection_manager(cls) -> AsyncPostgresConnectionManager:
+        """
+        Gets the connection_manager by either returning the class _global_conn_manager if it exists or creating it
+        based on the credentials_dict and returning it after caching it in _global_conn_manager.
+        """
+        with cls._global_conn_manager_lock:
+            if cls._global_conn_manager is None:
+                cls._global_conn_manager = AsyncPostgresConnectionManager(
+                    cls.pg_db_display_name(), maxconn=cls.MAX_CONNECTIONS, timeout=cls.CONNECTION_TIMEOUT,
+                    **cls.credentials_dict())
+
+                # Log the credentials but hide the password
+                credentials_dict_copy = copy.deepcopy(cls.credentials_dict())
+                credentials_dict_copy['password'] = "******"
+                log.info("Created the async connection pool for Postgres: {}".format(credentials_dict_copy))
+            return cls._global_conn_manager
+
+    def __init__(self, dict_cursor: bool = False):
+        """
+        Creates an instance with a connection manager (the connection and cursor are only gotten when entering the
+        async with block)
+
+        :param dict_cursor: defaults to False, but if True, will make the cursor be usable as a dict instead of
+        the usual tuple cursor
+        """
+        self.dict_cursor = dict_cursor
+        self.conn_manager = self.get_connection_manager()
+        self.conn = None  # type: Union[extensions.connection, None]
+        self._cursor = None  # type: Union[AsyncCursor, None]
+
+    @property
+    def cursor(self) -> AsyncCursor:
+        """
+        :return: the cursor (only available inside the async with block)
+        """
+        return self._cursor
+
+    async def __aenter__(self) -> AsyncCursor:
+        """
+        The code that will execute at the beginning of the "async with" clause.
+
+        :return: A cursor that will be assigned to whatever variable is used with "as"
+        """
+        self.conn = await self.conn_manager.get_connection()
+        try:
+            self._cursor = AsyncCursor(self.conn.cursor(cursor_factory=extras.DictCursor if self.dict_cursor
+                                                        else None))
+            await self._cursor.execute("BEGIN;")
+        except BaseException:
+            self.conn.close()
+            self.conn_manager.return_connection(self.conn)
+            raise
+        return self._cursor
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        """
+        The tear-down code that will execute at the end of the async with statement regardless of errors.
+
+        If there were no errors commit, if there were errors roll back, and return the connection either way (unless
+        it is stuck in the middle of a query, i.e. when the block was cancelled, in which case it's closed instead)
+
+        :param exception_type: the type of exception
+        :param exception_value: the value of the exception
+        :param exception_traceback: the exception traceback
+        """
+        try:
+            if exception_value is not None:
+                log.error(
+                    "Error of type {} with value \"{}\" occurred in an async with block involving the cursor, rolling "
+                    "back, and not committing anything.".format(exception_type, exception_value))
+                await self._cursor.execute("ROLLBACK;")
+            else:
+                await self._cursor.execute("COMMIT;")
+            self._cursor.close()
+        except BaseException:
+            self.conn.close()
+            if exception_value is None:
+                raise
+        finally:
+            self.conn_manager.return_connection(self.conn)
+
+
+class AsyncLocalhostCursor(AsyncPostgresCursor):
+    """
+    An AsyncPostgresCursor for connection to a localhost pg instance using the credentials.py file
+    """
+
+    @staticmethod
+    def pg_db_display_name() -> str:
+        return "postgres"
+
+    @staticmethod
+    def credentials_dict() -> Dict[str, Any]:
+        return pg_localhost
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+A micro-benchmark of the JSON adapter we register with psycopg2 for dicts, lists and sets: times how long adapting
+every JSON value of every data class takes with the current adapter compared to the old one, which first tried
+json.dumps and on a TypeError serialized the whole value again with str() on every element.
+
+Run it with: python -m general_utils.json_adapter_benchmark
+"""
+import argparse
+import json
+import logging
+import timeit
+from typing import Any, List
+
+import general_utils.postgres_utils as postgres_utils
+from database_design.data_modules import get_data_module_names_in_upsert_order, import_data_module, get_data_classes
+from database_design.sonata_data_classes import BulkLoader
+
+log = logging.getLogger(__name__)
+
+
+def legacy_dumps(obj: Any) -> str:
+    """
+    The old StringConverterJSON.dumps (kept here only to compare against)
+
+    :param obj: the object to convert
+    :return: the json representation
+    """
+    try:
+        return json.dumps(obj)
+    except TypeError:
+        if isinstance(obj, list):
+            return json.dumps([str(x) for x in obj])
+        elif isinstance(obj, dict):
+            return json.dumps({str(k): str(v) for k, v in obj.items()})
+
+
+def get_json_values() -> List[Any]:
+    """
+    Gathers every value of every row of every data class that psycopg2 would adapt as JSON
+
+    :return: the values
+    """
+    bulk_loader = BulkLoader()
+    for module_name in get_data_module_names_in_upsert_order():
+        for cls_name, cls in get_data_classes(import_data_module(module_name)):
+            bulk_loader.add_data_class(cls)
+
+    return [value for rows in bulk_loader._row_buffers.values() for row in rows.values() for value in row.values()
+            if isinstance(value, (dict, list, set))]
+
+
+def time_dumps(dumps, values: List[Any], number: int) -> float:
+    """
+    :param dumps: the function to serialize a value with
+    :param values: the values to serialize
+    :param number: how many times to serialize all of them
+    :return: the best time (in seconds) of serializing all values once
+    """
+    return min(timeit.repeat(lambda: [dumps(x) for x in values], number=number, repeat=5)) / number
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20, help="how many times to adapt all values per timing")
+    args = parser.parse_args()
+
+    json_values = get_json_values()
+    log.info("Adapting {} JSON values from the data modules".format(len(json_values)))
+
+    timings = [("legacy (json, retried with str)", time_dumps(legacy_dumps, json_values, args.number)),
+               ("json_dumps", time_dumps(postgres_utils.json_dumps, json_values, args.number))]
+
+    legacy_seconds = timings[0][1]
+    for name, seconds in timings:
+        log.info("{:<35} {:8.3f} ms ({:.1f}x)".format(name, seconds * 1000, legacy_seconds / seconds))
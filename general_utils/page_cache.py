@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+This module contains the cache of the rendered pages of the app: since a page is a pure function of the archive (and
+the route and arguments it's rendered for), the whole page is kept until the next rebuild, along with a strong ETag
+and the time the archive was last rebuilt to answer conditional requests with.
+
+Unlike the result cache (which asks the database for the generation whenever a cursor is made), the page cache only
+checks the generation every so often, so that serving a cached page doesn't touch the database at all.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from typing import Union, Any, Tuple, Callable, ContextManager
+
+from psycopg2 import extensions, errors, sql
+
+from general_utils.postgres_utils import QueryResultCache
+
+# How many bytes of rendered pages to keep at most by default
+DEFAULT_PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# How many seconds a checked generation is trusted for by default (i.e. how long after a rebuild a cached page of the
+# old generation can still be served)
+DEFAULT_GENERATION_CHECK_SECONDS = 5.0
+
+
+class CachedPage(object):
+    """
+    A rendered page with the validators it's served with (its length is the length of its body, which is what counts
+    towards the memory cap of the PageCache)
+    """
+
+    __slots__ = ['body', 'etag', 'last_modified']
+
+    def __init__(self, body: bytes, generation: int, last_modified: Union[datetime, None]):
+        """
+        :param body: the rendered page
+        :param generation: the generation of the archive it was rendered from
+        :param last_modified: when that generation was made (in UTC)
+        """
+        self.body = body
+        self.etag = "{}-{}".format(generation, hashlib.sha1(body).hexdigest()[:20])
+        self.last_modified = last_modified
+
+    def __len__(self) -> int:
+        return len(self.body)
+
+
+class PageCache(QueryResultCache):
+    """
+    A thread safe cache of rendered pages (keyed by their route and arguments) that is stamped with the generation of
+    the archive they were rendered from, evicting the least recently used pages to stay under its memory cap and
+    throwing out every page at once when a newer generation is seen (see QueryResultCache).
+    """
+
+    def __init__(self, generation_query: Union[str, sql.Composable], max_bytes: int = DEFAULT_PAGE_CACHE_MAX_BYTES,
+                 generation_check_seconds: float = DEFAULT_GENERATION_CHECK_SECONDS):
+        """
+        :param generation_query: a query that returns the current generation of the archive and when it was made
+        (as a naive local timestamp) as its single row
+        :param max_bytes: how many bytes of rendered pages to keep at most
+        :param generation_check_seconds: how many seconds to trust a checked generation for before checking it again
+        """
+        super().__init__(generation_query, max_bytes)
+        self.generation_check_seconds = generation_check_seconds
+
+        # The last checked generation, when it was made and when to check it again (in time.monotonic seconds), set
+        # all at once so that other threads never see half of it
+        self._checked_generation = (None, None, 0.0)  # type: Tuple[Union[int, None], Union[datetime, None], float]
+
+    def fetch_generation(self, cursor: extensions.cursor) -> Tuple[Union[int, None], Union[datetime, None]]:
+        """
+        Queries the current generation of the archive and when it was made (only use this with an autocommit cursor,
+        since if the generation doesn't exist yet the error would abort the transaction)
+
+        :param cursor: the cursor to query it with
+        :return: a tuple of the generation and when it was made in UTC (both None if there isn't one yet)
+        """
+        try:
+            cursor.execute(self.generation_query)
+        except errors.UndefinedTable:
+            return None, None
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None, None
+        generation, made_at = row
+        return generation, made_at.astimezone(timezone.utc).replace(microsecond=0) if made_at is not None else None
+
+    def current_generation(self, cursor_factory: Callable[[], ContextManager[extensions.cursor]]
+                           ) -> Tuple[Union[int, None], Union[datetime, None]]:
+        """
+        Gets the current generation of the archive, only querying it if it wasn't checked in the last
+        generation_check_seconds (two threads may both query it when it expires, which is harmless)
+
+        :param cursor_factory: makes the autocommit cursor to query it with, for use in a with block
+        :return: a tuple of the generation and when it was made in UTC (both None if there isn't one yet)
+        """
+        generation, last_modified, next_check = self._checked_generation
+        now = time.monotonic()
+        if now >= next_check:
+            with cursor_factory() as cur:
+                generation, last_modified = self.fetch_generation(cur)
+            self._checked_generation = (generation, last_modified, now + self.generation_check_seconds)
+        return generation, last_modified
+
+    def expire_generation(self, generation: Union[int, None] = None) -> None:
+        """
+        Makes the next request check the generation again (i.e. as soon as anything else sees a newer one)
+
+        :param generation: the new generation of the archive, if known (unused, so that this can be a new generation
+        listener of another cache)
+        """
+        checked_generation, last_modified, next_check = self._checked_generation
+        self._checked_generation = (checked_generation, last_modified, 0.0)
+
+    def get_page(self, generation: Union[int, None], key: Any) -> Union[CachedPage, None]:
+        """
+        :param generation: the current generation of the archive
+        :param key: the key of the page (its route and arguments)
+        :return: the cached page (or None if it isn't cached for this generation)
+        """
+        return self.get(generation, key)
+
+    def put_page(self, generation: Union[int, None], last_modified: Union[datetime, None], key: Any,
+                 body: bytes) -> CachedPage:
+        """
+        Caches a rendered page (unless there's no generation yet), evicting the least recently used ones to make room
+
+        :param generation: the generation of the archive it was rendered from
+        :param last_modified: when that generation was made (in UTC)
+        :param key: the key of the page (its route and arguments)
+        :param body: the rendered page
+        :return: the page with its validators
+        """
+        page = CachedPage(body, generation, last_modified)
+        self.put(generation, key, page)
+        return page
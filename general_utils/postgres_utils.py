@@ -1,38 +1,84 @@
 #!/usr/bin/env python
+import collections
 import copy
+import functools
+import itertools
 import json
 import logging
+import os
+import pickle
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, List, Sequence, Callable
 
-from psycopg2 import pool, extensions, extras
+from psycopg2 import pool, extensions, extras, errors, sql
 from psycopg2._psycopg import AsIs
 from psycopg2.extensions import register_adapter
 
 from credentials import pg_localhost
 from enums.key_enums import KeyStruct
 from enums.measure_enums import MR
+from general_utils.query_metrics import QueryMetrics
+from general_utils.time_helpers import count_statement
 
 log = logging.getLogger(__name__)
 
 
-# Create a new JSON class that will try to use __str__ to serialize all object as JSON
+def json_default(obj: Any) -> Any:
+    """
+    Converts the objects the JSON encoder doesn't know natively: KeyStructs and MRs (and anything else) become their
+    string and sets become sorted lists
+
+    :param obj: the object to convert
+    :return: a JSON serializable representation of it
+    """
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+
+def json_dumps(obj: Any) -> str:
+    """
+    Serializes an object (with any KeyStructs or MRs nested in it) as JSON in a single pass with the json module, in
+    exactly the format json.dumps always wrote to the database. Dict keys that JSON doesn't allow are turned into
+    strings as well.
+
+    :param obj: the object to serialize
+    :return: the JSON
+    """
+    try:
+        return json.dumps(obj, default=json_default)
+    except TypeError:
+        return json.dumps(_with_str_keys(obj), default=json_default)
+
+
+def _with_str_keys(obj: Any) -> Any:
+    """
+    Copies the object with every dict key (however deeply nested) turned into a string
+
+    :param obj: the object
+    :return: the copy
+    """
+    if isinstance(obj, dict):
+        return {str(k): _with_str_keys(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_with_str_keys(x) for x in obj]
+    return obj
+
+
+# Create a new JSON class that knows how to serialize our KeyStructs and MRs (and tries to use __str__ on any other
+# object the JSON encoder doesn't know)
 class StringConverterJSON(extras.Json):
     def dumps(self, obj):
         """
-        Overwrites the normal dumping of an object into a JSON for psycopg2 to try to use the str(x) to coaxe objects
-        to tbe JSON serializable instead of throwing a type error
+        Overwrites the normal dumping of an object into a JSON for psycopg2 to coaxe objects to be JSON serializable
+        with str(x) instead of throwing a type error (see json_dumps)
 
         :param obj: the object to convert
         :return: the json representation
         """
-        try:
-            return json.dumps(obj)
-        except TypeError:
-            if isinstance(obj, list):
-                return json.dumps([str(x) for x in obj])
-            elif isinstance(obj, dict):
-                return json.dumps({str(k): str(v) for k, v in obj.items()})
+        return json_dumps(obj)
 
 
 # This allows us to directly commit dict and list objects as JSONB with psycopg2
@@ -40,52 +86,534 @@ register_adapter(dict, StringConverterJSON)
 register_adapter(list, StringConverterJSON)
 register_adapter(set, StringConverterJSON)
 
-# We also want our KeyStruct to be adapted as a normal text string so we can insert it directly as text
+# We also want our KeyStruct to be adapted as its key name, which is a label of the key enum type (so an untyped
+# literal of it goes straight into a key column)
 register_adapter(KeyStruct, lambda x: AsIs("'{}'".format(str(x))))
-register_adapter(MR, lambda x: AsIs("'{}'".format(str(x))))
+
+# And our MR as an inclusive int4range (postgres stores it in its canonical form, [start, end + 1))
+register_adapter(MR, lambda x: AsIs("'[{},{}]'".format(x.start_measure_num, x.end_measure_num)))
+
+# The oids of int4range and int4range[] (built in types, so unlike the key enum these never change)
+INT4RANGE_OID = 3904
+INT4RANGE_ARRAY_OID = 3905
+
+
+def cast_int4range(value: Union[str, None], cursor: extensions.cursor) -> Union[MR, str, None]:
+    """
+    Turns an int4range value from postgres (always in its canonical form, i.e. "[12,15)") back into an MR
+
+    :param value: the int4range as a string
+    :param cursor: the cursor that fetched it
+    :return: the MR (or the string itself if it's empty or unbounded, which no MR can be)
+    """
+    if value is None:
+        return None
+    try:
+        start, end = value[1:-1].split(",")
+        return MR(int(start), int(end) - 1)
+    except ValueError:
+        return value
+
+
+INT4RANGE = extensions.new_type((INT4RANGE_OID,), "INT4RANGE", cast_int4range)
+extensions.register_type(INT4RANGE)
+extensions.register_type(extensions.new_array_type((INT4RANGE_ARRAY_OID,), "INT4RANGE[]", INT4RANGE))
+
+
+# How many rows a server side named cursor fetches per round trip by default (psycopg2's default itersize)
+DEFAULT_ITERSIZE = 2000
+
+_server_side_cursor_numbers = itertools.count()
+
+
+def new_server_side_cursor_name() -> str:
+    """
+    Returns a name for a server side named cursor that no other cursor of this process uses (the names of the cursors
+    on a connection have to be unique, and a connection can be shared by several threads or generators)
+
+    :return: the name
+    """
+    return "server_{}_{}".format(os.getpid(), next(_server_side_cursor_numbers))
+
+
+class CountingCursor(extensions.cursor):
+    """
+    A cursor that counts every statement it executes (and the rows written by it) towards the active
+    ExecutionProfiler (see time_helpers)
+    """
+
+    def execute(self, query, vars=None):
+        result = super().execute(query, vars)
+        # Only statements without a result set write rows (rowcount is -1 for statements like DDL)
+        count_statement(self.rowcount if self.description is None else 0)
+        return result
+
+
+class InstrumentedCursorMixin(object):
+    """
+    A mixin for a cursor class that records every statement it executes (how long it took and how many rows it
+    returned or wrote) to the QueryMetrics in its query_metrics attribute (see instrumented_cursor_class)
+    """
+
+    query_metrics: Union[QueryMetrics, None] = None
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        if self.query_metrics is not None:
+            self.query_metrics.record(self.query, time.perf_counter() - started, max(self.rowcount, 0))
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def instrumented_cursor_class(cursor_cls: type) -> type:
+    """
+    Returns a subclass of the given cursor class with the InstrumentedCursorMixin (so the cursor is still a real
+    psycopg2 cursor that works with everything that expects one)
+
+    :param cursor_cls: the cursor class (i.e. extensions.cursor, extras.DictCursor or CountingCursor)
+    :return: the instrumented cursor class
+    """
+    return type("Instrumented" + cursor_cls.__name__, (InstrumentedCursorMixin, cursor_cls), {})
 
 
 class PostgresConnectionManager(object):
     """
-    A class that stores and manages a psycopg2 connection pool for a postgres database.
+    A class that stores and manages a psycopg2 connection pool for a postgres database that is safe to share between
+    threads (i.e. the request threads of the web server).
 
-    Right now, the class just wraps the SimpleConnectionPool, but in the future could do something more complicated.
+    Wraps a SimpleConnectionPool (which on its own isn't thread safe) that is only touched while holding a lock, and
+    when all connections are in use makes get_connection wait (for up to the timeout) until one is returned instead of
+    failing right away. Only so many threads can wait at once, any more fail right away instead of piling up.
+
+    The live state of the pool and a histogram of how long connections were waited on are available with metrics().
     """
 
-    def __init__(self, conn_name, minconn=1, maxconn=5, **kwargs):
+    # The upper bounds (in seconds) of the buckets of the wait time histogram (the last bucket is everything longer)
+    WAIT_TIME_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+    def __init__(self, conn_name, minconn=1, maxconn=5, timeout=30.0, max_waiters=50, **kwargs):
         """
         Instantiates a Simple Connection Pool object with minconn and maxconn
 
         :param conn_name: What to name this connection
         :param minconn: The minimum number of connections created
         :param maxconn: The maximum number of connections possible
+        :param timeout: The default number of seconds get_connection waits for a connection when all are in use
+        :param max_waiters: The maximum number of threads that can wait for a connection at once
         :param kwargs: A set of named parameters which should be passed in to set up the connection pool (i.e.
         user, password, host, port, database)
         """
         self._conn_pool = pool.SimpleConnectionPool(minconn=minconn, maxconn=maxconn, **kwargs)
+        self._condition = threading.Condition(threading.Lock())
         self.num_utilized_conns = 0
+        self.num_waiters = 0
         self.max_num_conns = maxconn
+        self.max_num_waiters = max_waiters
+        self.timeout = timeout
         self.conn_name = conn_name
+        # The process the connections belong to (a forked child inherits them, see discard_inherited_connections)
+        self.pid = os.getpid()
+
+        # The wait time histogram (counts per bucket of WAIT_TIME_BUCKETS plus one for everything longer)
+        self._wait_time_counts = [0] * (len(self.WAIT_TIME_BUCKETS) + 1)
+        self._wait_time_sum = 0.0
+        self.num_timeouts = 0
+        self.num_rejected = 0
 
-    def get_connection(self) -> extensions.connection:
+    def get_connection(self, timeout: Union[float, None] = None) -> extensions.connection:
         """
-        Gets an available connection from the database
+        Gets an available connection from the database, waiting for one to be returned if all are in use
+
+        :param timeout: the number of seconds to wait for a connection, defaults to the timeout of the manager
         :return: the connection
         """
-        self.num_utilized_conns = self.num_utilized_conns + 1
-        # log.debug("{} Connection requested;  \t\tproposed num in use: {} / {}"
-        #           "".format(self.conn_name, self.num_utilized_conns, self.max_num_conns))
-        return self._conn_pool.getconn()
+        timeout = self.timeout if timeout is None else timeout
+        started_at = time.monotonic()
+
+        with self._condition:
+            if self.num_utilized_conns >= self.max_num_conns:
+                if self.num_waiters >= self.max_num_waiters:
+                    self.num_rejected += 1
+                    raise pool.PoolError("{}: all {} connections are in use and {} requests are already waiting for "
+                                         "one".format(self.conn_name, self.max_num_conns, self.num_waiters))
+
+                self.num_waiters += 1
+                try:
+                    got_connection = self._condition.wait_for(lambda: self.num_utilized_conns < self.max_num_conns,
+                                                              timeout)
+                finally:
+                    self.num_waiters -= 1
+
+                if not got_connection:
+                    self.num_timeouts += 1
+                    raise pool.PoolError("{}: timed out after {} seconds waiting for one of the {} connections"
+                                         "".format(self.conn_name, timeout, self.max_num_conns))
+
+            self._record_wait_time(time.monotonic() - started_at)
+            try:
+                conn = self._conn_pool.getconn()
+            except Exception:
+                # Let someone else try to connect instead
+                self._condition.notify()
+                raise
+            self.num_utilized_conns = self.num_utilized_conns + 1
+            return conn
 
     def return_connection(self, conn: extensions.connection) -> None:
         """
-        Returns a connection back to the pool
+        Returns a connection back to the pool (and wakes up a thread waiting for one)
         :param conn: the connection to return
         """
-        self._conn_pool.putconn(conn)
-        self.num_utilized_conns = self.num_utilized_conns - 1
-        # log.debug("{} Connection returned;  \t\tcurrent num in use: {} / {}"
-        #           "".format(self.conn_name, self.num_utilized_conns, self.max_num_conns))
+        with self._condition:
+            try:
+                self._conn_pool.putconn(conn)
+            finally:
+                self.num_utilized_conns = self.num_utilized_conns - 1
+                self._condition.notify()
+
+    def discard_inherited_connections(self) -> None:
+        """
+        Throws away every connection of this pool in a process forked from the one that opened them (which shares
+        their sockets with that parent), without disturbing the parent's sessions. The pool can't be used after this.
+
+        Closing a connection normally sends the server a terminate message over the shared socket, which would end
+        the parent's session, so the child's copy of each socket is first pointed at /dev/null and then closed.
+        """
+        devnull_fd = os.open(os.devnull, os.O_RDWR)
+        try:
+            for conn in list(self._conn_pool._pool) + list(self._conn_pool._used.values()):
+                if conn.closed:
+                    continue
+                os.dup2(devnull_fd, conn.fileno())
+                conn.close()
+        finally:
+            os.close(devnull_fd)
+
+        self._conn_pool._pool = []
+        self._conn_pool._used = {}
+        self._conn_pool._rused = {}
+        self._conn_pool.closed = True
+        log.info("{}: discarded the connections inherited from process {} in process {}"
+                 "".format(self.conn_name, self.pid, os.getpid()))
+
+    def _record_wait_time(self, seconds: float) -> None:
+        """
+        Adds how long a connection was waited on to the wait time histogram (must be called holding the lock)
+
+        :param seconds: the number of seconds waited
+        """
+        bucket = len(self.WAIT_TIME_BUCKETS)
+        for i, upper_bound in enumerate(self.WAIT_TIME_BUCKETS):
+            if seconds <= upper_bound:
+                bucket = i
+                break
+        self._wait_time_counts[bucket] += 1
+        self._wait_time_sum += seconds
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Returns a snapshot of the live state of the pool
+
+        :return: a dict with the number of connections in use, idle (opened but not in use) and allowed, the number of
+        threads waiting for one, how many requests timed out or were rejected, and the wait time histogram (the
+        cumulative count of waits of up to each number of seconds, like a prometheus histogram)
+        """
+        with self._condition:
+            cumulative_count = 0
+            wait_time_histogram = []
+            for upper_bound, count in zip(self.WAIT_TIME_BUCKETS + [float('inf')], self._wait_time_counts):
+                cumulative_count += count
+                wait_time_histogram.append((upper_bound, cumulative_count))
+
+            return {
+                'conn_name': self.conn_name,
+                'in_use': self.num_utilized_conns,
+                # The connections the pool opened that are waiting to be handed out again
+                'idle': len(self._conn_pool._pool),
+                'max_connections': self.max_num_conns,
+                'waiters': self.num_waiters,
+                'max_waiters': self.max_num_waiters,
+                'timeouts': self.num_timeouts,
+                'rejected': self.num_rejected,
+                'wait_time_histogram': wait_time_histogram,
+                'wait_time_count': cumulative_count,
+                'wait_time_sum': self._wait_time_sum,
+            }
+
+
+# How much memory (in bytes of pickled results) a QueryResultCache can take up by default
+DEFAULT_RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class QueryResultCache(object):
+    """
+    A thread safe cache of the results of queries (keyed by the rendered SQL, parameters and all, and the kind of
+    cursor) that is stamped with the generation of the data they were read from. Whenever a newer generation is seen
+    every result of an older one is thrown out at once, so the generation query should return a number that goes up
+    every time the data changes (or None if it doesn't know, in which case nothing is cached).
+
+    Results are stored pickled, which both gives their size for the memory cap (the least recently used results are
+    evicted to stay under it) and gives every hit its own copy that can be changed without touching the cache.
+    """
+
+    def __init__(self, generation_query: Union[str, sql.Composable], max_bytes: int = DEFAULT_RESULT_CACHE_MAX_BYTES):
+        """
+        :param generation_query: a query that returns the current generation of the data as its single value
+        :param max_bytes: how many bytes of pickled results to keep at most
+        """
+        self.generation_query = generation_query
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()  # type: collections.OrderedDict[Any, bytes]
+        self.generation = None  # type: Union[int, None]
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self._new_generation_listeners = []  # type: List[Callable[[int], None]]
+
+    def add_new_generation_listener(self, listener: Callable[[int], None]) -> None:
+        """
+        Adds a function to call (with the new generation) whenever the cache sees a newer generation of the data and
+        throws out its results, so that anything else kept per generation (i.e. catalogs loaded from the database)
+        can be refreshed at the same time
+
+        :param listener: the function
+        """
+        self._new_generation_listeners.append(listener)
+
+    def _adopt_generation(self, generation: int) -> bool:
+        """
+        Moves the cache on to the given generation if it's newer than the one its results are from, throwing them
+        out (the lock must already be held)
+
+        :param generation: the generation of the data a caller reads
+        :return: True if it was newer (so the listeners should be called once the lock is released)
+        """
+        if self.generation is not None and generation <= self.generation:
+            return False
+        self.clear_unlocked()
+        self.generation = generation
+        return True
+
+    def _notify_new_generation(self, generation: int) -> None:
+        """
+        Calls every new generation listener
+
+        :param generation: the new generation
+        """
+        for listener in self._new_generation_listeners:
+            listener(generation)
+
+    def fetch_generation(self, cursor: extensions.cursor) -> Union[int, None]:
+        """
+        Queries the current generation of the data (only use this with an autocommit cursor, since if the generation
+        doesn't exist yet the error would abort the transaction)
+
+        :param cursor: the cursor to query it with
+        :return: the generation (or None if there isn't one yet, i.e. before the first rebuild that records it)
+        """
+        try:
+            cursor.execute(self.generation_query)
+        except errors.UndefinedTable:
+            return None
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def get(self, generation: Union[int, None], key: Any) -> Union[bytes, None]:
+        """
+        :param generation: the generation of the data the caller reads
+        :param key: the key of the query
+        :return: the pickled result (or None if it isn't cached for this generation)
+        """
+        with self._lock:
+            is_new_generation = generation is not None and self._adopt_generation(generation)
+            result = self._results.get(key) if generation is not None and generation == self.generation else None
+            if result is None:
+                self.num_misses = self.num_misses + 1
+            else:
+                self._results.move_to_end(key)
+                self.num_hits = self.num_hits + 1
+
+        if is_new_generation:
+            self._notify_new_generation(generation)
+        return result
+
+    def put(self, generation: Union[int, None], key: Any, result: bytes) -> None:
+        """
+        Caches a result, evicting the least recently used ones to make room for it
+
+        :param generation: the generation of the data the result was read from
+        :param key: the key of the query
+        :param result: the pickled result
+        """
+        if generation is None or len(result) > self.max_bytes:
+            return
+
+        with self._lock:
+            is_new_generation = self._adopt_generation(generation)
+            if generation < self.generation:
+                # Read before the data changed, so it's already stale
+                return
+
+            if key in self._results:
+                self.num_bytes -= len(self._results.pop(key))
+            self._results[key] = result
+            self.num_bytes += len(result)
+
+            while self.num_bytes > self.max_bytes:
+                evicted_key, evicted_result = self._results.popitem(last=False)
+                self.num_bytes -= len(evicted_result)
+                self.num_evictions = self.num_evictions + 1
+
+        if is_new_generation:
+            self._notify_new_generation(generation)
+
+    def clear(self) -> None:
+        """
+        Throws out every cached result
+        """
+        with self._lock:
+            self.clear_unlocked()
+
+    def clear_unlocked(self) -> None:
+        """
+        Throws out every cached result (the lock must already be held)
+        """
+        self._results.clear()
+        self.num_bytes = 0
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        :return: a snapshot of the state of the cache
+        """
+        with self._lock:
+            return {
+                'generation': self.generation,
+                'results': len(self._results),
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+                'evictions': self.num_evictions,
+            }
+
+
+class CachingCursor(object):
+    """
+    A thin wrapper around a cursor that answers the queries it already has a result for (of the same generation) from
+    a QueryResultCache without going to the database, and caches the result of every other query that returns rows.
+
+    Since every result is fetched all at once, only fetchone, fetchmany, fetchall, iteration, description and rowcount
+    come from the result; everything else is the wrapped cursor's.
+    """
+
+    def __init__(self, cursor: extensions.cursor, result_cache: QueryResultCache, generation: Union[int, None]):
+        """
+        :param cursor: the cursor to run the queries that aren't cached with
+        :param result_cache: the cache
+        :param generation: the generation of the data the cursor reads
+        """
+        self._cursor = cursor
+        self._result_cache = result_cache
+        self._generation = generation
+        self._rows = None  # type: Union[List[Any], None]
+        self._row_index = 0
+        self.description = None
+
+    def execute(self, query, vars: Union[Sequence, Dict[str, Any], None] = None) -> None:
+        """
+        Executes the query, unless its result is already cached
+
+        :param query: the query as a string, bytes or Composable
+        :param vars: the parameters to merge into the query, if any
+        """
+        key = self.result_key(query, vars)
+        if not self.load_cached_result(key):
+            self._cursor.execute(query, vars)
+            self.store_result(key)
+
+    def result_key(self, query, vars: Union[Sequence, Dict[str, Any], None] = None) -> Any:
+        """
+        :param query: the query as a string, bytes or Composable
+        :param vars: the parameters to merge into the query, if any
+        :return: the key of the query's result in the cache
+        """
+        # The row factory of the cursor decides what the rows look like (i.e. tuples or DictRows)
+        return self._cursor.row_factory, self._cursor.mogrify(query, vars)
+
+    def load_cached_result(self, key: Any) -> bool:
+        """
+        Makes the cached result of the query (if there is one for this generation) the one that is fetched
+
+        :param key: the key of the query
+        :return: True if there was one
+        """
+        cached_result = self._result_cache.get(self._generation, key)
+        if cached_result is None:
+            return False
+        self.description, self._rows = pickle.loads(cached_result)
+        self._row_index = 0
+        return True
+
+    def store_result(self, key: Any) -> None:
+        """
+        Fetches the whole result of the query the wrapped cursor just executed to be fetched from here, and caches it
+
+        :param key: the key of the query
+        """
+        self.description = self._cursor.description
+        # Statements without a result set have nothing to cache
+        self._rows = self._cursor.fetchall() if self.description is not None else None
+        self._row_index = 0
+        if self._rows is not None:
+            self._result_cache.put(self._generation, key, pickle.dumps((self.description, self._rows),
+                                                                        protocol=pickle.HIGHEST_PROTOCOL))
+
+    @property
+    def rowcount(self) -> int:
+        return len(self._rows) if self._rows is not None else self._cursor.rowcount
+
+    def fetchone(self) -> Any:
+        if self._rows is None:
+            return self._cursor.fetchone()
+        if self._row_index >= len(self._rows):
+            return None
+        self._row_index = self._row_index + 1
+        return self._rows[self._row_index - 1]
+
+    def fetchmany(self, size: Union[int, None] = None) -> List[Any]:
+        if self._rows is None:
+            return self._cursor.fetchmany(size)
+        size = self._cursor.arraysize if size is None else size
+        rows = self._rows[self._row_index:self._row_index + size]
+        self._row_index = self._row_index + len(rows)
+        return rows
+
+    def fetchall(self) -> List[Any]:
+        if self._rows is None:
+            return self._cursor.fetchall()
+        rows = self._rows[self._row_index:]
+        self._row_index = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    @property
+    def wrapped_cursor(self) -> extensions.cursor:
+        """
+        :return: the psycopg2 cursor that runs the queries that aren't cached
+        """
+        return self._cursor
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
 
 
 class PostgresCursor(object, metaclass=ABCMeta):
@@ -106,6 +634,19 @@ class PostgresCursor(object, metaclass=ABCMeta):
     """
 
     _global_conn_manager = None  # type: Union[PostgresConnectionManager, None]
+    _global_conn_manager_lock = threading.Lock()
+
+    # The size of the connection pool, how long to wait for a connection when all are in use and how many threads
+    # can wait at once (subclasses can override these)
+    MAX_CONNECTIONS = 5
+    CONNECTION_TIMEOUT = 30.0
+    MAX_CONNECTION_WAITERS = 50
+
+    # The cache that the cursors made with cache_results share (none until one is set on the class, i.e. by the app)
+    result_cache = None  # type: Union[QueryResultCache, None]
+
+    # What every statement executed by the cursors is recorded to (none until one is set on the class, i.e. by the app)
+    query_metrics: Union[QueryMetrics, None] = None
 
     @staticmethod
     @abstractmethod
@@ -135,23 +676,36 @@ class PostgresCursor(object, metaclass=ABCMeta):
         opening up a connection)
         """
 
-        if cls._global_conn_manager is None:
-            # Create the connection manager by passing in the unpacked credentials_dict
-            conn_manager = PostgresConnectionManager(cls.pg_db_display_name(), **cls.credentials_dict())
-
-            # Log the success method but hide the password
-            credentials_dict_copy = copy.deepcopy(cls.credentials_dict())
-            credentials_dict_copy['password'] = "******"
-            log.info("Connection to Postgres was successful: {}".format(
-                credentials_dict_copy))
-
-            # Save it so we never have to remake it again
-            cls._global_conn_manager = conn_manager
-        else:
-            conn_manager = cls._global_conn_manager
+        # Make sure two threads asking for the first time don't both make one
+        with cls._global_conn_manager_lock:
+            # A forked child (i.e. a gunicorn worker of a preloaded app) needs its own connections (normally the
+            # fork hook below already discarded the parent's)
+            if cls._global_conn_manager is not None and cls._global_conn_manager.pid != os.getpid():
+                cls._global_conn_manager.discard_inherited_connections()
+                cls._global_conn_manager = None
+
+            if cls._global_conn_manager is None:
+                # Create the connection manager by passing in the unpacked credentials_dict
+                conn_manager = PostgresConnectionManager(cls.pg_db_display_name(), maxconn=cls.MAX_CONNECTIONS,
+                                                         timeout=cls.CONNECTION_TIMEOUT,
+                                                         max_waiters=cls.MAX_CONNECTION_WAITERS,
+                                                         **cls.credentials_dict())
+
+                # Log the success method but hide the password
+                credentials_dict_copy = copy.deepcopy(cls.credentials_dict())
+                credentials_dict_copy['password'] = "******"
+                log.info("Connection to Postgres was successful: {}".format(
+                    credentials_dict_copy))
+
+                # Save it so we never have to remake it again
+                cls._global_conn_manager = conn_manager
+            else:
+                conn_manager = cls._global_conn_manager
         return conn_manager
 
-    def __init__(self, dict_cursor: bool = False, server_side_named_cursor: bool = False):
+    def __init__(self, dict_cursor: bool = False, server_side_named_cursor: bool = False,
+                 cursor_factory: Union[type, None] = None, itersize: int = DEFAULT_ITERSIZE, read_only: bool = False,
+                 cache_results: bool = False, connection: Union[extensions.connection, None] = None):
         """
         Creates an instance with a connection manager, and uses it to grab a connection and then a cursor.
 
@@ -161,15 +715,75 @@ class PostgresCursor(object, metaclass=ABCMeta):
         :param dict_cursor: defaults to False, but if True, will make the cursor be usable as a dict instead of
         the usual tuple cursor
         :param server_side_named_cursor: defaults to False, but if True will make the cursor have a name and thus be a
-        server side named cursor that is more limited (only designed for large select statements)
+        server side named cursor that is more limited (only designed for large select statements) and streams the
+        results instead of loading them all into memory
+        :param cursor_factory: defaults to None, but if given will make the cursor an instance of this cursor class
+        instead (i.e. CountingCursor), can't be combined with dict_cursor
+        :param itersize: how many rows a server side named cursor fetches per round trip while iterating over it
+        :param read_only: defaults to False, but if True will run every statement in its own read only transaction
+        (autocommit with a read only session) so that there is no transaction to begin and commit around them, which
+        is all that queries that only read (like the app's) need. Nothing can be written with it.
+        :param cache_results: defaults to False, but if True (and the class has a result_cache) will answer the
+        queries whose result is cached for the current generation of the data from the cache instead, and cache the
+        rest. The generation is checked once when the cursor is made. Only works with a read only cursor.
+        :param connection: defaults to None, but if given will use this connection of the pool (that the caller got
+        with get_connection_manager().get_connection() and returns itself once it's done with it) instead of getting
+        one, so that several cursors one after the other (or even one inside another) can share a connection
         """
+        if dict_cursor and cursor_factory is not None:
+            raise Exception("Can either make a dict cursor or use the given cursor_factory, but not both!")
+        if cache_results and (not read_only or server_side_named_cursor):
+            raise Exception("Can only cache the results of a read only cursor that isn't a server side named cursor!")
+
+        self.read_only = read_only
         self.conn_manager = self.get_connection_manager()
-        self.conn = self.conn_manager.get_connection()
-        self._cursor = self.conn.cursor(name='server' if server_side_named_cursor else None,
-                                        cursor_factory=extras.DictCursor if dict_cursor else None)
+        self.owns_connection = connection is None
+        self.conn = self.conn_manager.get_connection() if self.owns_connection else connection
+        try:
+            self.set_read_only(self.conn, read_only)
+            cursor_factory = extras.DictCursor if dict_cursor else cursor_factory
+            if self.query_metrics is not None:
+                cursor_factory = instrumented_cursor_class(cursor_factory or extensions.cursor)
+            # A server side cursor outside of a transaction has to be held open past the end of its statement
+            self._cursor = self.conn.cursor(name=new_server_side_cursor_name() if server_side_named_cursor else None,
+                                            cursor_factory=cursor_factory,
+                                            withhold=server_side_named_cursor and read_only)
+            if self.query_metrics is not None:
+                self._cursor.query_metrics = self.query_metrics
+            if server_side_named_cursor:
+                self._cursor.itersize = itersize
+            if cache_results and self.result_cache is not None:
+                self._cursor = CachingCursor(self._cursor, self.result_cache,
+                                             self.result_cache.fetch_generation(self._cursor))
+        except Exception:
+            # Don't leak the connection since __exit__ will never run
+            if self.owns_connection:
+                self.conn_manager.return_connection(self.conn)
+            raise
         # psycopg2 stupidly doesn't type hint the cursor() method so I'm going to wrap it with my own property
         # This way auto-complete will work with self.cursor
 
+    @staticmethod
+    def set_read_only(conn: extensions.connection, read_only: bool) -> None:
+        """
+        Puts the connection in read only autocommit mode or back in the regular transactional read write mode. Since
+        a pooled connection keeps its mode, this only costs a round trip when a connection switches modes.
+
+        :param conn: the connection
+        :param read_only: whether to put it in read only mode
+        """
+        if read_only:
+            if not conn.autocommit:
+                conn.autocommit = True
+            if conn.readonly is not True:
+                # In autocommit mode this sets the default of the session for every statement's transaction
+                conn.readonly = True
+        elif conn.autocommit:
+            # Turn off the session's read only default before leaving autocommit mode (where it would only apply to
+            # the transactions psycopg2 begins)
+            conn.readonly = None
+            conn.autocommit = False
+
     @property
     def cursor(self) -> extensions.cursor:
         """
@@ -194,13 +808,19 @@ class PostgresCursor(object, metaclass=ABCMeta):
 
         If there were no errors need to close the cursor, commit to the database and return the connection
         If there were errors, let's rollback
+        (A connection that was given to the cursor is left for whoever gave it to return)
 
         :param exception_type: the type of exception
         :param exception_value: the value of the exception
         :param exception_traceback: the exception traceback
         """
         self.cursor.close()
-        if exception_value is not None:
+        if self.read_only:
+            # Every statement already ended its own transaction, so there's nothing to commit or roll back
+            if exception_value is not None:
+                log.error("Error of type {} with value \"{}\" occurred in a with block involving the read only "
+                          "cursor.".format(exception_type, exception_value))
+        elif exception_value is not None:
             log.error(
                 "Error of type {} with value \"{}\" occurred in a with block involving the cursor, rolling back, "
                 "and not committing anything.".format(
@@ -210,7 +830,33 @@ class PostgresCursor(object, metaclass=ABCMeta):
         else:
             # log.debug("Committing changes from the connection and returning it to the Connection Manager")
             self.conn.commit()
-        self.conn_manager.return_connection(self.conn)
+        if self.owns_connection:
+            self.conn_manager.return_connection(self.conn)
+
+
+def _discard_inherited_conn_managers(cursor_cls: type = PostgresCursor) -> None:
+    """
+    Runs in the child right after a fork: discards the connection managers the child inherited from its parent (for
+    the given PostgresCursor class and all its subclasses) so that the child opens its own connections and never
+    closes the parent's, and replaces the lock in case another thread of the parent was holding it during the fork.
+
+    :param cursor_cls: the PostgresCursor class to start from
+    """
+    if cursor_cls is PostgresCursor:
+        PostgresCursor._global_conn_manager_lock = threading.Lock()
+
+    conn_manager = cursor_cls.__dict__.get('_global_conn_manager')
+    if conn_manager is not None:
+        conn_manager.discard_inherited_connections()
+        cursor_cls._global_conn_manager = None
+
+    for subclass in cursor_cls.__subclasses__():
+        _discard_inherited_conn_managers(subclass)
+
+
+# Fork hooks only exist on posix (on windows every process starts fresh anyway)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_discard_inherited_conn_managers)
 
 
 class LocalhostCursor(PostgresCursor):
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+This module contains the per query instrumentation of the cursors: every statement a cursor with a QueryMetrics
+executes is recorded by the fingerprint of its statement (the statement with its literals taken out, so that every
+execution of the same query counts towards the same one) and the route it was run for, and aggregated in process into
+latency histograms and row counters that can be written out in the Prometheus text format.
+
+Statements that take longer than the slow query threshold are also logged on the "slow_query" logger.
+"""
+import contextvars
+import functools
+import hashlib
+import logging
+import re
+import threading
+from typing import Union, Dict, Tuple, List, Any
+
+SLOW_QUERY_LOGGER_NAME = "slow_query"
+
+slow_query_log = logging.getLogger(SLOW_QUERY_LOGGER_NAME)
+
+# The upper bounds (in seconds) of the buckets of the latency histograms (the last bucket is everything longer)
+DEFAULT_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+# How long a statement can take before it's logged as a slow query by default
+DEFAULT_SLOW_QUERY_SECONDS = 0.25
+
+# How much of a normalized statement is kept in its metrics (and of a slow statement in the slow query log)
+MAX_STATEMENT_LENGTH = 300
+
+# What a route is called when there's no request, or when it didn't match any route
+NO_ROUTE = "none"
+
+# The route that the statements executed in the current context are run for (i.e. set by the app for every request,
+# and copied along into the tasks of an asyncio.run)
+current_route = contextvars.ContextVar("current_route", default=NO_ROUTE)
+
+_STRING_LITERAL_PATTERN = re.compile(r"(?:[EeBbXxUu]&?)?'(?:[^']|'')*'")
+_NUMBER_LITERAL_PATTERN = re.compile(r"(?<![\w\"$])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_REPEATED_ROWS_PATTERN = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_statement(statement: str) -> str:
+    """
+    Normalizes a statement into the shape of its query: takes out every literal (strings and numbers become ?), folds
+    lists of them (and rows of lists of them) into one and collapses all whitespace
+
+    :param statement: the statement as it was sent to postgres
+    :return: the normalized statement
+    """
+    statement = _STRING_LITERAL_PATTERN.sub("?", statement)
+    statement = _NUMBER_LITERAL_PATTERN.sub("?", statement)
+    statement = _LIST_PATTERN.sub("(?)", statement)
+    statement = _REPEATED_ROWS_PATTERN.sub("(?), ...", statement)
+    return _WHITESPACE_PATTERN.sub(" ", statement).strip()
+
+
+def fingerprint_statement(normalized_statement: str) -> str:
+    """
+    :param normalized_statement: a statement normalized with normalize_statement
+    :return: a short hash of it that identifies the query
+    """
+    return hashlib.md5(normalized_statement.encode('utf-8')).hexdigest()[:12]
+
+
+def escape_label_value(value: str) -> str:
+    """
+    :param value: the value of a Prometheus label
+    :return: the value escaped to go in between its double quotes
+    """
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def format_prometheus_metric(name: str, metric_type: str, help_text: str,
+                             samples: List[Tuple[str, Dict[str, str], float]]) -> List[str]:
+    """
+    Formats a metric in the Prometheus text format
+
+    :param name: the name of the metric
+    :param metric_type: counter, gauge or histogram
+    :param help_text: what the metric measures
+    :param samples: a list of tuples of (sample name suffix, labels, value), i.e. ("_bucket", {"le": "0.1"}, 3)
+    :return: the lines of the metric
+    """
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type)]
+    for suffix, labels, value in samples:
+        label_string = ",".join("{}=\"{}\"".format(k, escape_label_value(str(v))) for k, v in labels.items())
+        lines.append("{}{}{} {}".format(name, suffix, "{" + label_string + "}" if label_string else "", value))
+    return lines
+
+
+def format_upper_bound(upper_bound: float) -> str:
+    """
+    :param upper_bound: the upper bound of a histogram bucket
+    :return: it as the le label of the bucket
+    """
+    return "+Inf" if upper_bound == float('inf') else repr(upper_bound)
+
+
+class QueryStats(object):
+    """
+    The aggregated executions of one query (by statement fingerprint) for one route
+    """
+
+    __slots__ = ['count', 'seconds', 'rows', 'bucket_counts', 'slow_count']
+
+    def __init__(self, num_buckets: int):
+        """
+        :param num_buckets: the number of buckets of the latency histogram (including the last, unbounded one)
+        """
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bucket_counts = [0] * num_buckets
+        self.slow_count = 0
+
+
+class QueryMetrics(object):
+    """
+    A thread safe in process aggregation of every statement executed by the cursors it's set on (see
+    PostgresCursor.query_metrics): how many times each query ran for each route, how long it took (as a histogram)
+    and how many rows it returned or wrote.
+    """
+
+    def __init__(self, slow_query_seconds: Union[float, None] = DEFAULT_SLOW_QUERY_SECONDS,
+                 latency_buckets: List[float] = None, metric_prefix: str = "sonata"):
+        """
+        :param slow_query_seconds: statements that take at least this many seconds are logged on the slow query
+        logger (None to never log them)
+        :param latency_buckets: the upper bounds (in seconds) of the buckets of the latency histograms
+        :param metric_prefix: what the names of the metrics start with
+        """
+        self.slow_query_seconds = slow_query_seconds
+        self.latency_buckets = sorted(latency_buckets or DEFAULT_LATENCY_BUCKETS) + [float('inf')]
+        self.metric_prefix = metric_prefix
+        self._lock = threading.Lock()
+        self._stats = {}  # type: Dict[Tuple[str, str], QueryStats]
+        self._statements = {}  # type: Dict[str, str]
+
+    def record(self, statement: Union[str, bytes, None], seconds: float, rows: int,
+               route: Union[str, None] = None) -> None:
+        """
+        Records one execution of a statement
+
+        :param statement: the statement as it was sent to postgres (i.e. the query attribute of the cursor)
+        :param seconds: how long it took
+        :param rows: how many rows it returned or wrote
+        :param route: the route it was run for (defaults to the current_route)
+        """
+        if isinstance(statement, bytes):
+            statement = statement.decode('utf-8', errors='replace')
+        statement = statement or ""
+        route = route if route is not None else current_route.get()
+
+        normalized_statement = normalize_statement(statement)
+        fingerprint = fingerprint_statement(normalized_statement)
+        is_slow = self.slow_query_seconds is not None and seconds >= self.slow_query_seconds
+
+        bucket_index = 0
+        while seconds > self.latency_buckets[bucket_index]:
+            bucket_index = bucket_index + 1
+
+        with self._lock:
+            stats = self._stats.get((route, fingerprint))
+            if stats is None:
+                stats = self._stats[(route, fingerprint)] = QueryStats(len(self.latency_buckets))
+                self._statements.setdefault(fingerprint, normalized_statement[:MAX_STATEMENT_LENGTH])
+            stats.count = stats.count + 1
+            stats.seconds = stats.seconds + seconds
+            stats.rows = stats.rows + rows
+            stats.bucket_counts[bucket_index] = stats.bucket_counts[bucket_index] + 1
+            if is_slow:
+                stats.slow_count = stats.slow_count + 1
+
+        if is_slow:
+            slow_query_log.warning("Slow query ({:.3f} seconds, {} rows) for route {} [{}]: {}".format(
+                seconds, rows, route, fingerprint, statement[:MAX_STATEMENT_LENGTH]))
+
+    def reset(self) -> None:
+        """
+        Forgets everything recorded so far
+        """
+        with self._lock:
+            self._stats.clear()
+            self._statements.clear()
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        :return: a list of dicts of the aggregated executions of every query and route, the slowest in total first
+        """
+        with self._lock:
+            summary = [{
+                'route': route,
+                'fingerprint': fingerprint,
+                'statement': self._statements[fingerprint],
+                'count': stats.count,
+                'seconds': stats.seconds,
+                'rows': stats.rows,
+                'slow_count': stats.slow_count,
+            } for (route, fingerprint), stats in self._stats.items()]
+        summary.sort(key=lambda x: x['seconds'], reverse=True)
+        return summary
+
+    def prometheus_lines(self) -> List[str]:
+        """
+        :return: every metric in the Prometheus text format (a latency histogram, a row counter and a slow query
+        counter per query and route, and an info metric mapping each fingerprint to its normalized statement)
+        """
+        latency_samples = []
+        rows_samples = []
+        slow_samples = []
+        with self._lock:
+            for (route, fingerprint), stats in sorted(self._stats.items()):
+                labels = {'route': route, 'fingerprint': fingerprint}
+                cumulative_count = 0
+                for upper_bound, count in zip(self.latency_buckets, stats.bucket_counts):
+                    cumulative_count += count
+                    latency_samples.append(("_bucket", dict(labels, le=format_upper_bound(upper_bound)),
+                                            cumulative_count))
+                latency_samples.append(("_sum", labels, stats.seconds))
+                latency_samples.append(("_count", labels, stats.count))
+                rows_samples.append(("", labels, stats.rows))
+                slow_samples.append(("", labels, stats.slow_count))
+            statement_samples = [("", {'fingerprint': fingerprint, 'statement': statement}, 1)
+                                 for fingerprint, statement in sorted(self._statements.items())]
+
+        prefix = self.metric_prefix
+        return (format_prometheus_metric(prefix + "_query_duration_seconds", "histogram",
+                                         "How long the queries took, by route and query fingerprint",
+                                         latency_samples) +
+                format_prometheus_metric(prefix + "_query_rows_total", "counter",
+                                         "How many rows the queries returned or wrote, by route and query fingerprint",
+                                         rows_samples) +
+                format_prometheus_metric(prefix + "_slow_queries_total", "counter",
+                                         "How many queries took longer than the slow query threshold",
+                                         slow_samples) +
+                format_prometheus_metric(prefix + "_query_statement_info", "gauge",
+                                         "The normalized statement of each query fingerprint",
+                                         statement_samples))
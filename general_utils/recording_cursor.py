@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+This module contains a cursor that needs no database connection: it only records the SQL that is executed with it so
+that the whole rebuild can be compiled into a single script (and applied later with psql -f), along with the helpers
+to render psycopg2 Composables and parameters to SQL strings without a connection.
+"""
+import logging
+from datetime import datetime
+from typing import Union, Any, Sequence, Dict
+
+from psycopg2 import sql, extensions, extras
+
+from general_utils.time_helpers import count_statement
+
+log = logging.getLogger(__name__)
+
+# The settings the rendered SQL assumes (i.e. strings are quoted with standard conforming strings)
+SCRIPT_HEADER_SETTINGS = [
+    "\\set ON_ERROR_STOP on",
+    "SET client_encoding = 'UTF8';",
+    "SET standard_conforming_strings = on;",
+]
+
+
+def quote_ident(name: str) -> str:
+    """
+    Quotes an identifier the way postgres expects (wrapped in double quotes with double quotes doubled)
+
+    :param name: the identifier
+    :return: the quoted identifier
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_string(value: str) -> str:
+    """
+    Quotes a string as a literal (wrapped in single quotes with single quotes doubled), which is only valid with
+    standard_conforming_strings on (the default since postgres 9.1)
+
+    :param value: the string
+    :return: the quoted literal
+    """
+    if '\x00' in value:
+        raise ValueError("A string literal can't contain NUL characters: {!r}".format(value))
+    return "'" + value.replace("'", "''") + "'"
+
+
+def quote_value(value: Any) -> str:
+    """
+    Renders a python value as a SQL literal without a connection, using the same adapters as psycopg2 would (including
+    the ones we registered for dicts, lists, KeyStructs and MRs) except for strings, which psycopg2 can only quote
+    correctly with a connection.
+
+    :param value: the value to render
+    :return: the SQL literal
+    """
+    if isinstance(value, str):
+        return quote_string(value)
+    elif isinstance(value, tuple):
+        # psycopg2 adapts tuples for use with IN
+        return '(' + ', '.join(quote_value(x) for x in value) + ')'
+
+    adapted = extensions.adapt(value)
+    if isinstance(adapted, extras.Json):
+        return quote_string(adapted.dumps(adapted.adapted))
+
+    quoted = adapted.getquoted()
+    return quoted.decode('utf-8') if isinstance(quoted, bytes) else quoted
+
+
+def render_composable(composable: sql.Composable) -> str:
+    """
+    Renders a psycopg2 Composable to a SQL string without a connection (what as_string does with one)
+
+    :param composable: the Composable (i.e. sql.SQL, sql.Composed, a Field or a SchemaTable)
+    :return: the SQL string
+    """
+    if isinstance(composable, sql.Composed):
+        return ''.join(render_composable(x) for x in composable.seq)
+    elif isinstance(composable, sql.Identifier):
+        return '.'.join(quote_ident(x) for x in composable.strings)
+    elif isinstance(composable, sql.Literal):
+        return quote_value(composable.wrapped)
+    elif isinstance(composable, sql.Placeholder):
+        return '%s' if composable.name is None else '%({})s'.format(composable.name)
+    elif isinstance(composable, sql.SQL):
+        return composable.string
+    else:
+        # Our own Composables (i.e. SQLTypeStruct) don't need a context
+        return composable.as_string(None)
+
+
+def render_sql(query: Union[str, bytes, sql.Composable], params: Union[Sequence, Dict[str, Any], None] = None) -> str:
+    """
+    Renders a query and its parameters to a single SQL string without a connection (what mogrify does with one)
+
+    :param query: the query as a string, bytes or Composable
+    :param params: the parameters to merge into the query, if any
+    :return: the SQL string
+    """
+    if isinstance(query, sql.Composable):
+        query = render_composable(query)
+    elif isinstance(query, bytes):
+        query = query.decode('utf-8')
+
+    # Just like psycopg2, only do % formatting if there are parameters
+    if params is None:
+        return query
+    elif isinstance(params, dict):
+        return query % {k: quote_value(v) for k, v in params.items()}
+    else:
+        return query % tuple(quote_value(x) for x in params)
+
+
+class RecordingConnection(object):
+    """
+    The stand in for the connection of a RecordingCursor (psycopg2.extras.execute_values needs its encoding)
+    """
+    encoding = 'UTF8'
+
+
+class RecordingCursor(object):
+    """
+    A cursor that needs no connection and instead records every statement executed with it (with all parameters
+    rendered) so that they can be written out as a single transactional SQL script.
+
+    Like the PostgresCursor it can be used in a "with" construct, where it writes the script to the given path
+    at the end of the with block only if there were no errors:
+
+    with RecordingCursor("sonata_archives.sql") as cur:
+        cur.execute("<SQL>")
+
+    Since nothing is actually executed, anything that fetches results will throw an error.
+    """
+
+    def __init__(self, script_path: Union[str, None] = None):
+        """
+        Creates a cursor with no recorded statements
+
+        :param script_path: where to write the script at the end of the with block (if None, nothing is written)
+        """
+        self.script_path = script_path
+        self.connection = RecordingConnection()
+        self.statements = []  # type: List[str]
+        self.rowcount = -1
+
+    def __enter__(self) -> 'RecordingCursor':
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if exception_value is not None:
+            log.error("Error of type {} with value \"{}\" occurred in a with block involving the recording cursor, "
+                      "not writing the script.".format(exception_type, exception_value))
+        elif self.script_path is not None:
+            self.write_script(self.script_path)
+
+    def execute(self, query: Union[str, bytes, sql.Composable], params: Union[Sequence, Dict, None] = None) -> None:
+        """
+        Records the query with its parameters rendered into it
+
+        :param query: the query as a string, bytes or Composable
+        :param params: the parameters to merge into the query, if any
+        """
+        self.statements.append(render_sql(query, params))
+        # Nothing is written yet, so this only counts towards the statements of the active profiler
+        count_statement(0)
+
+    def mogrify(self, query: Union[str, bytes, sql.Composable], params: Union[Sequence, Dict, None] = None) -> bytes:
+        """
+        Returns the query with its parameters rendered into it (as bytes, just like a psycopg2 cursor)
+
+        :param query: the query as a string, bytes or Composable
+        :param params: the parameters to merge into the query, if any
+        :return: the rendered query
+        """
+        return render_sql(query, params).encode('utf-8')
+
+    def fetchone(self):
+        raise Exception("A RecordingCursor never executes anything, so there is nothing to fetch!")
+
+    def fetchall(self):
+        raise Exception("A RecordingCursor never executes anything, so there is nothing to fetch!")
+
+    def fetchmany(self, size=None):
+        raise Exception("A RecordingCursor never executes anything, so there is nothing to fetch!")
+
+    def close(self) -> None:
+        pass
+
+    def script(self) -> str:
+        """
+        Builds the script of all recorded statements wrapped in a single transaction (psql stops at the first error,
+        which rolls the whole thing back)
+
+        :return: the script
+        """
+        lines = ["-- Generated at {} with {} statements".format(datetime.now().isoformat(), len(self.statements))]
+        lines.extend(SCRIPT_HEADER_SETTINGS)
+        lines.append("")
+        lines.append("BEGIN;")
+        for statement in self.statements:
+            statement = statement.strip()
+            lines.append("")
+            lines.append(statement if statement.endswith(';') else statement + ';')
+        lines.append("")
+        lines.append("COMMIT;")
+        return '\n'.join(lines) + '\n'
+
+    def write_script(self, script_path: str) -> None:
+        """
+        Writes the script of all recorded statements to the given path
+
+        :param script_path: the path to write to
+        """
+        with open(script_path, 'w', encoding='utf-8') as f:
+            f.write(self.script())
+        log.info("Wrote {} statements to {}".format(len(self.statements), script_path))
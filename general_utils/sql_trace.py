@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+This module contains the SQL trace channel: a dedicated "sql_trace" logger for the statements the rebuild executes.
+
+Statements are handed to the logger unrendered (as a LazySQL) so they are only rendered to text if a handler actually
+emits them, and once configure_sql_trace is called they go through a queue to a background thread that does the
+rendering and writing, so the thread talking to postgres never waits on either. Traces can also be sampled (only
+keeping a fraction of them) and truncated to a maximum length.
+"""
+import atexit
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Union, Sequence, Dict, Any, List
+
+from psycopg2 import sql
+
+from general_utils.recording_cursor import render_sql
+
+SQL_TRACE_LOGGER_NAME = "sql_trace"
+
+sql_trace_log = logging.getLogger(SQL_TRACE_LOGGER_NAME)
+
+# The default max length of a traced statement (longer ones are truncated)
+DEFAULT_MAX_LENGTH = 2000
+
+# How many traces can wait in the queue before tracing starts blocking the thread that traces
+DEFAULT_QUEUE_SIZE = 10000
+
+_settings = {
+    'sample_rate': 1.0,
+    'max_length': DEFAULT_MAX_LENGTH,
+}
+
+_listener = None  # type: Union[QueueListener, None]
+
+
+class LazySQL(object):
+    """
+    A statement (with its parameters) that is only rendered to text when it is converted to a string, which logging
+    only does when a handler formats the record.
+    """
+
+    __slots__ = ['statement', 'params', 'max_length']
+
+    def __init__(self, statement: Union[str, bytes, sql.Composable], params: Union[Sequence, Dict[str, Any], None],
+                 max_length: Union[int, None]):
+        """
+        :param statement: the statement as a string, bytes or Composable
+        :param params: the parameters to merge into the statement, if any
+        :param max_length: the max length of the rendered statement (None for no limit)
+        """
+        self.statement = statement
+        self.params = params
+        self.max_length = max_length
+
+    def __str__(self) -> str:
+        text = render_sql(self.statement, self.params).strip()
+        if self.max_length is not None and len(text) > self.max_length:
+            text = "{}... [{} more characters]".format(text[:self.max_length], len(text) - self.max_length)
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """
+    A filter that only lets through a random fraction of records (or all of them for a sample rate of 1)
+    """
+
+    def __init__(self, sample_rate: float):
+        """
+        :param sample_rate: the fraction of records to let through, between 0 and 1
+        """
+        super().__init__()
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("The sample rate must be between 0 and 1, not {}".format(sample_rate))
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    A QueueHandler that puts records on the queue as they are instead of formatting them first (which is what the
+    standard QueueHandler does in prepare), so that the LazySQL in them is rendered by the listener's thread
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def trace_sql(statement: Union[str, bytes, sql.Composable], params: Union[Sequence, Dict[str, Any], None] = None,
+              level: int = logging.INFO) -> None:
+    """
+    Traces a statement on the sql_trace logger without rendering it (see LazySQL)
+
+    :param statement: the statement as a string, bytes or Composable
+    :param params: the parameters that are merged into the statement, if any
+    :param level: the level to trace at (defaults to INFO)
+    """
+    if sql_trace_log.isEnabledFor(level):
+        sql_trace_log.log(level, "%s", LazySQL(statement, params, _settings['max_length']))
+
+
+def get_sql_trace_settings() -> Dict[str, Any]:
+    """
+    :return: the settings the sql trace was configured with (i.e. to configure it the same way in a worker process)
+    """
+    return dict(_settings)
+
+
+def configure_sql_trace(sample_rate: float = 1.0, max_length: Union[int, None] = DEFAULT_MAX_LENGTH,
+                        handlers: List[logging.Handler] = None, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+    """
+    Sends the sql_trace logger through a queue to a background thread that renders and writes the traces with the
+    given handlers (instead of propagating them to the root logger on the thread that traced them), only keeping
+    the given fraction of them and truncating each to the given length.
+
+    Calling it again replaces the previous configuration (the background thread is stopped at exit, after it has
+    written everything still in the queue).
+
+    :param sample_rate: the fraction of traces to keep, between 0 and 1 (defaults to all of them)
+    :param max_length: the max length of a traced statement (None for no limit)
+    :param handlers: the handlers to write the traces with (defaults to the handlers of the root logger)
+    :param queue_size: how many traces can wait in the queue before tracing blocks
+    """
+    global _listener
+
+    stop_sql_trace()
+
+    _settings['sample_rate'] = sample_rate
+    _settings['max_length'] = max_length
+
+    if handlers is None:
+        handlers = list(logging.getLogger().handlers)
+
+    trace_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = LazyQueueHandler(trace_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    for handler in list(sql_trace_log.handlers):
+        sql_trace_log.removeHandler(handler)
+    sql_trace_log.addHandler(queue_handler)
+    sql_trace_log.propagate = False
+
+    _listener = QueueListener(trace_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_sql_trace() -> None:
+    """
+    Stops the background thread of the sql trace (if there is one) after it has written everything in the queue
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_sql_trace)
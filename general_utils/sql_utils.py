@@ -5,13 +5,21 @@ This module contains the core Composable subclasses that we made to handle Schem
 SchemaTables will always be unquoted and thus directly extend Composable while Fields will always be quoted
 and thus
 """
-from typing import Union, List, Tuple, Dict, Any
+import logging
+import weakref
+from typing import Union, List, Tuple, Dict, Any, Iterator, Sequence
 
 from psycopg2 import sql, extensions
+from psycopg2.extensions import register_adapter, AsIs
 
-from general_utils.postgres_utils import LocalhostCursor
+from general_utils.postgres_utils import LocalhostCursor, CachingCursor, DEFAULT_ITERSIZE, \
+    new_server_side_cursor_name
+from general_utils.recording_cursor import RecordingCursor, render_composable
+from general_utils.sql_trace import trace_sql
 from general_utils.type_helpers import validate_is_int
 
+log = logging.getLogger(__name__)
+
 
 class Field(sql.Identifier):
     """
@@ -190,6 +198,7 @@ class SQLType(object):
     INTEGER_DEFAULT_ZERO = SQLTypeStruct("INTEGER DEFAULT 0")
     DOUBLE_PRECISION = SQLTypeStruct("DOUBLE PRECISION")
     NUMERIC = SQLTypeStruct("NUMERIC")
+    INT4RANGE = SQLTypeStruct("INT4RANGE")
 
     @staticmethod
     def NUMERIC_WITH_PRECISION_SCALE(precision: int, scale: int):
@@ -199,6 +208,20 @@ class SQLType(object):
             return SQLTypeStruct("NUMERIC ({}, {})".format(precision, scale))
 
 
+def as_sql_string(composable: sql.Composable, cursor: Union[extensions.cursor, RecordingCursor]) -> str:
+    """
+    A wrapper for composable.as_string(cursor) that also works with a RecordingCursor (which has no connection to
+    quote things with)
+
+    :param composable: the Composable to render
+    :param cursor: the cursor the Composable will be executed with
+    :return: the SQL string
+    """
+    if isinstance(cursor, RecordingCursor):
+        return render_composable(composable)
+    return composable.as_string(cursor)
+
+
 def get_column_names(schema_table: SchemaTable, cursor: extensions.cursor) -> List[str]:
     """
     Gets a list of all columns (from the information schema) for a given schema and table in the ordinal order
@@ -244,10 +267,55 @@ def get_row_count(schema_table: SchemaTable, cursor: extensions.cursor) -> int:
     return count
 
 
+def table_exists(schema_table: SchemaTable, cursor: extensions.cursor) -> bool:
+    """
+    Given a SchemaTable and a cursor, checks whether the table (or view) exists in the database
+
+    :param schema_table: the SchemaTable object that we want to check for
+    :param cursor: a cursor for where to execute this query
+    :return: True if it exists, False if not
+    """
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (schema_table.as_string(cursor),))
+    return cursor.fetchone()[0]
+
+
+def select_fields_sql(schema_table: SchemaTable, field_list: List[Field],
+                      where_field_value_dict: Union[Dict[Field, Any], None] = None,
+                      keyset_field: Union[Field, None] = None, after: Any = None,
+                      limit: Union[int, None] = None) -> sql.Composable:
+    """
+    Builds a select of only the given fields of a SchemaTable (instead of SELECT * on tables with close to a hundred
+    columns), optionally filtered on the given field values and paged by keyset: ordered by the keyset field and
+    starting after the given value of it, so that every page is a seek on the index of the field instead of an OFFSET
+    that reads and throws away every row before the page
+
+    :param schema_table: the SchemaTable to select from
+    :param field_list: the fields to select, in order
+    :param where_field_value_dict: a dict mapping fields to the values they must equal (optional)
+    :param keyset_field: the field to order (and page) by, which should be unique (optional)
+    :param after: only select the rows whose keyset field is greater than this (None to start at the first row)
+    :param limit: the maximum number of rows to select (None for all of them)
+    :return: the select as a Composable
+    """
+    conditions = [sql.SQL("{} = {}").format(field, sql.Literal(value))
+                  for field, value in (where_field_value_dict or {}).items()]
+    if keyset_field is not None and after is not None:
+        conditions.append(sql.SQL("{} > {}").format(keyset_field, sql.Literal(after)))
+
+    select_sql = sql.SQL("SELECT {fields} FROM {st}").format(fields=sql.SQL(", ").join(field_list), st=schema_table)
+    if len(conditions) > 0:
+        select_sql += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+    if keyset_field is not None:
+        select_sql += sql.SQL(" ORDER BY {}").format(keyset_field)
+    if limit is not None:
+        select_sql += sql.SQL(" LIMIT {}").format(sql.Literal(limit))
+    return select_sql + sql.SQL(";")
+
+
 def fetch_all_records(schema_table: SchemaTable, cursor: extensions.cursor) -> List:
     """
     Given a SchemaTable and a cursor, this simple utility will run a SELECT * on the object and return the full thing in
-    memory. Recommended for use only on small objects!
+    memory. Recommended for use only on small objects! (use stream_all_records for big ones)
 
     :param schema_table: the SchemaTable object that we want to fetch all from
     :param cursor: a cursor for where to execute this query
@@ -259,6 +327,70 @@ def fetch_all_records(schema_table: SchemaTable, cursor: extensions.cursor) -> L
     return cursor.fetchall()
 
 
+def stream_all_records(schema_table: SchemaTable, cursor: extensions.cursor,
+                       batch_size: int = DEFAULT_ITERSIZE) -> Iterator:
+    """
+    A generator version of fetch_all_records that streams the records of the SchemaTable with a server side named
+    cursor (see stream_record_batches), so it is fine for use on big objects too.
+
+    :param schema_table: the SchemaTable object that we want to fetch all from
+    :param cursor: a cursor whose connection (and transaction) to stream the records with
+    :param batch_size: how many records to fetch from the server at a time
+    :return: a generator of the tuple records (or dict records with a dict cursor)
+    """
+    return stream_records(sql.SQL("SELECT * FROM {}").format(schema_table), cursor, batch_size=batch_size)
+
+
+def stream_records(query: Union[str, sql.Composable], cursor: extensions.cursor,
+                   params: Union[Sequence, Dict[str, Any], None] = None, batch_size: int = DEFAULT_ITERSIZE) -> Iterator:
+    """
+    Executes the query and lazily yields its records one by one (see stream_record_batches)
+
+    :param query: the select query to stream the records of
+    :param cursor: a cursor whose connection (and transaction) to stream the records with
+    :param params: the parameters to merge into the query, if any
+    :param batch_size: how many records to fetch from the server at a time
+    :return: a generator of the records
+    """
+    for batch in stream_record_batches(query, cursor, params, batch_size):
+        yield from batch
+
+
+def stream_record_batches(query: Union[str, sql.Composable], cursor: extensions.cursor,
+                          params: Union[Sequence, Dict[str, Any], None] = None,
+                          batch_size: int = DEFAULT_ITERSIZE) -> Iterator[List]:
+    """
+    Executes the query with a server side named cursor (with a unique name, and of the same class as the given cursor,
+    or as the cursor it wraps if it's a CachingCursor) on the given cursor's connection and lazily yields its records in lists of up to batch_size records, so that only
+    one batch is ever held in memory.
+
+    The connection must stay in the same transaction (if it isn't in autocommit mode) until the generator is exhausted
+    or closed (which closes the named cursor).
+
+    :param query: the select query to stream the records of
+    :param cursor: a cursor whose connection (and transaction) to stream the records with
+    :param params: the parameters to merge into the query, if any
+    :param batch_size: how many records to fetch from the server at a time
+    :return: a generator of lists of records
+    """
+    # A streamed result is never cached, so the named cursor is made like the psycopg2 cursor a CachingCursor wraps
+    if isinstance(cursor, CachingCursor):
+        cursor = cursor.wrapped_cursor
+
+    # Outside of a transaction (i.e. with a read only cursor) the named cursor has to be held open past its statement
+    with cursor.connection.cursor(name=new_server_side_cursor_name(), cursor_factory=type(cursor),
+                                  withhold=cursor.connection.autocommit) as named_cursor:
+        named_cursor.itersize = batch_size
+        if getattr(cursor, 'query_metrics', None) is not None:
+            named_cursor.query_metrics = cursor.query_metrics
+        named_cursor.execute(query, params)
+        while True:
+            batch = named_cursor.fetchmany(batch_size)
+            if len(batch) == 0:
+                return
+            yield batch
+
+
 def get_column_count(schema_table: SchemaTable, cursor: extensions.cursor) -> int:
     """
     Given a SchemaTable and a cursor, this simple utility will query the information schema to find out how many
@@ -312,19 +444,22 @@ def get_list_field_type_tuples(schema_table: SchemaTable, cursor: extensions.cur
 
 
 def create_table_from_field_sql_type_tuples(schema_table: SchemaTable,
-                                            list_field_type_tuples: List[Tuple[Field, SQLType]]) -> sql.Composable:
+                                            list_field_type_tuples: List[Tuple[Field, SQLType]],
+                                            if_not_exists: bool = False) -> sql.Composable:
     """
     Takes a schema table and a list of (Field, SQLType) tuples and returns a create table SQL Composable.
 
     :param schema_table: the schema table to use to make the table
     :param list_field_type_tuples: a list of tuples, each containing the field name and the sql type in ordinal order
+    :param if_not_exists: if True, leaves the table alone if it already exists (defaults to False)
     """
 
     list_field_type_sql = [sql.SQL("{field}\t\t{type}").format(field=x[0], type=x[1])
                            for x in list_field_type_tuples]
 
-    return sql.SQL("CREATE TABLE {schema_table} (\n\t{field_types_joined}\n);"
-                   "").format(schema_table=schema_table,
+    return sql.SQL("CREATE TABLE {if_not_exists}{schema_table} (\n\t{field_types_joined}\n);"
+                   "").format(if_not_exists=sql.SQL("IF NOT EXISTS " if if_not_exists else ""),
+                              schema_table=schema_table,
                               field_types_joined=sql.SQL(",\n\t").join(list_field_type_sql))
 
 
@@ -337,6 +472,8 @@ def upsert_sql_from_field_value_dict(schema_table: SchemaTable, field_value_dict
 
     Also we run lstrip and rstrip on any string that is a value.
 
+    (To upsert many rows with the same fields, execute_upsert is faster since it only has the server plan it once)
+
     :param schema_table: the schema table to upsert into
     :param field_value_dict: the dict mapping a Field to a value representing the data we want to upsert
     :param conflict_field_list: a list of fields to use for the on conflict column – note that this is often a single
@@ -345,20 +482,36 @@ def upsert_sql_from_field_value_dict(schema_table: SchemaTable, field_value_dict
     """
 
     # Grab the fields and values (the order will be preserved by grabbing these without changing the dict in between)
-    field_list = field_value_dict.keys()
+    field_list = list(field_value_dict.keys())
 
     # Strip whitespace with rstrip and lstrip if a string (i.e. something that has lstrip and rstrip)
-    val_list = []
-    for x in field_value_dict.values():
-        if hasattr(x, 'rstrip') and hasattr(x, 'lstrip'):
-            x = x.rstrip().lstrip()
-        val_list.append(x)
+    val_list = [strip_whitespace(x) for x in field_value_dict.values()]
 
-    field_value_dict.values()
     val_list = [sql.Literal(x) for x in val_list]  # Convert the values into sql.Literal for insertion
 
+    return upsert_sql_from_field_list(schema_table, field_list, val_list, conflict_field_list)
+
+
+def upsert_sql_from_field_list(schema_table: SchemaTable, field_list: List[Field], val_list: List[sql.Composable],
+                               conflict_field_list: List[Field],
+                               reset_field_list: Union[List[Field], None] = None) -> sql.Composable:
+    """
+    Creates an upsert (see upsert_sql_from_field_value_dict) of the given values (as Composables, i.e. sql.Literals or
+    parameters like $1) into the given fields
+
+    :param schema_table: the schema table to upsert into
+    :param field_list: the fields to upsert into
+    :param val_list: the value for each field as a Composable
+    :param conflict_field_list: a list of fields to use for the on conflict column
+    :param reset_field_list: fields (not in the field list) to reset to their default when the row already exists, so
+    that the upsert overwrites the whole row just like inserting it anew would (optional)
+    :return: the sql as a Composable
+    """
+
     # EXCLUDED is the posgres name of the records that couldn't be inserted due to the conflict
-    exc_fields = [sql.SQL("EXCLUDED.{}").format(x) for x in field_list]
+    set_fields = field_list + list(reset_field_list or [])
+    set_vals = [sql.SQL("EXCLUDED.{}").format(x) for x in field_list] + \
+               [sql.SQL("DEFAULT") for _ in reset_field_list or []]
 
     if len(field_list) == 0:
         raise Exception("Cannot do upsert with an empty field_value_dict!")
@@ -370,25 +523,234 @@ def upsert_sql_from_field_value_dict(schema_table: SchemaTable, field_value_dict
 
     # So the solution is to remove the parentheses if the field list is length 1 and keep them if the field list is
     # longer than 1 (which works on both 9 and 10!)
-    if len(field_list) == 1:
+    if len(set_fields) == 1:
         upsert_sql_template = sql.SQL("INSERT INTO {schema_table} ({joined_fields}) VALUES ({joined_vals}) \n"
                                       "ON CONFLICT ({joined_conf_fields}) \n"
-                                      " DO UPDATE SET {joined_fields} = {joined_exc_fields};")
+                                      " DO UPDATE SET {joined_set_fields} = {joined_set_vals};")
 
     else:  # This is the only one necessary in 9 but breaks in 10 if you have only one field
         upsert_sql_template = sql.SQL("INSERT INTO {schema_table} ({joined_fields}) VALUES ({joined_vals}) \n"
                                       "ON CONFLICT ({joined_conf_fields}) \n"
-                                      " DO UPDATE SET ({joined_fields}) = ({joined_exc_fields});")
+                                      " DO UPDATE SET ({joined_set_fields}) = ({joined_set_vals});")
 
     return upsert_sql_template.format(
         schema_table=schema_table,
         joined_fields=sql.SQL(", ").join(field_list),
         joined_vals=sql.SQL(", ").join(val_list),
         joined_conf_fields=sql.SQL(", ").join(conflict_field_list),
+        joined_set_fields=sql.SQL(", ").join(set_fields),
+        joined_set_vals=sql.SQL(", ").join(set_vals)
+    )
+
+
+class PreparedUpsert(object):
+    """
+    A server-side prepared version of the upsert from upsert_sql_from_field_value_dict for one schema table, ordered
+    field list and conflict field list, with $1, $2... parameters instead of inlined values.
+
+    Every connection PREPAREs it the first time it is used there, so that after that every upsert with the same fields
+    is just an EXECUTE with the values (which the server doesn't have to parse or plan again). Instances are cached
+    per schema table and fields, so always get them with PreparedUpsert.get (or just use execute_upsert).
+    """
+
+    _cache = {}  # type: Dict[Tuple[str, Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]], PreparedUpsert]
+
+    # The names of the statements already prepared on every connection (dropped along with the connection)
+    _prepared_names_by_connection = weakref.WeakKeyDictionary()
+
+    def __init__(self, name: str, schema_table: SchemaTable, field_list: List[Field], conflict_field_list: List[Field],
+                 reset_field_list: Union[List[Field], None] = None):
+        """
+        Creates the prepared upsert (use PreparedUpsert.get instead)
+
+        :param name: the name to prepare the statement with
+        :param schema_table: the schema table to upsert into
+        :param field_list: the fields to upsert into, in the order the values will be given in
+        :param conflict_field_list: a list of fields to use for the on conflict column
+        :param reset_field_list: fields to reset to their default when the row already exists (optional)
+        """
+        self.name = name
+        self.field_list = field_list
+        param_list = [sql.SQL("${}".format(i + 1)) for i in range(len(field_list))]
+        self.prepare_sql = sql.SQL("PREPARE {name} AS {upsert_sql}").format(
+            name=sql.Identifier(name),
+            upsert_sql=upsert_sql_from_field_list(schema_table, field_list, param_list, conflict_field_list,
+                                                  reset_field_list))
+        self.execute_sql = sql.SQL("EXECUTE {name} ({placeholders});").format(
+            name=sql.Identifier(name),
+            placeholders=sql.SQL(", ").join(sql.Placeholder() for _ in field_list))
+
+        # The rendered sql (identifiers are quoted the same for any connection, so they only need rendering once)
+        self._prepare_string = None  # type: Union[str, None]
+        self._execute_string = None  # type: Union[str, None]
+
+    @classmethod
+    def get(cls, schema_table: SchemaTable, field_list: List[Field], conflict_field_list: List[Field],
+            reset_field_list: Union[List[Field], None] = None) -> 'PreparedUpsert':
+        """
+        Gets the cached prepared upsert for the given schema table, fields and conflict fields (creating it if needed)
+
+        :param schema_table: the schema table to upsert into
+        :param field_list: the fields to upsert into, in the order the values will be given in
+        :param conflict_field_list: a list of fields to use for the on conflict column
+        :param reset_field_list: fields to reset to their default when the row already exists (optional)
+        :return: the prepared upsert
+        """
+        reset_field_list = list(reset_field_list or [])
+        key = (schema_table.string, tuple(x.name for x in field_list), tuple(x.name for x in conflict_field_list),
+               tuple(x.name for x in reset_field_list))
+        prepared_upsert = cls._cache.get(key)
+        if prepared_upsert is None:
+            prepared_upsert = cls("upsert_{}".format(len(cls._cache)), schema_table, list(field_list),
+                                  list(conflict_field_list), reset_field_list)
+            cls._cache[key] = prepared_upsert
+        return prepared_upsert
+
+    def execute(self, cursor: extensions.cursor, value_list: List[Any]) -> None:
+        """
+        Executes the upsert with the given values (preparing it on the cursor's connection first if needed)
+
+        :param cursor: the cursor to execute the upsert with
+        :param value_list: the value for each field (in the order of the field list)
+        """
+        if self._execute_string is None:
+            self._prepare_string = as_sql_string(self.prepare_sql, cursor)
+            self._execute_string = as_sql_string(self.execute_sql, cursor)
+
+        prepared_names = self._prepared_names_by_connection.setdefault(cursor.connection, set())
+        if self.name not in prepared_names:
+            trace_sql(self._prepare_string)
+            cursor.execute(self._prepare_string)
+            prepared_names.add(self.name)
+
+        trace_sql(self._execute_string, value_list, level=logging.DEBUG)
+        cursor.execute(self._execute_string, value_list)
+
+
+def execute_upsert(cursor: extensions.cursor, schema_table: SchemaTable, field_value_dict: Dict[Field, Any],
+                   conflict_field_list: List[Field], overwrite_field_list: Union[List[Field], None] = None) -> None:
+    """
+    Upserts the given dict into the schema table just like executing the sql from upsert_sql_from_field_value_dict
+    (including the stripping of whitespace), but with a PreparedUpsert for the schema table and fields so that
+    the server only has to parse and plan it once per connection.
+
+    :param cursor: the cursor to execute the upsert with
+    :param schema_table: the schema table to upsert into
+    :param field_value_dict: the dict mapping a Field to a value representing the data we want to upsert
+    :param conflict_field_list: a list of fields to use for the on conflict column
+    :param overwrite_field_list: if given, the fields of an existing row to overwrite: the ones the dict doesn't
+    specify are reset to their default, so that (like a bulk merge) a value that was taken out of the dict doesn't
+    stay behind in the table
+    """
+    if len(field_value_dict) == 0:
+        raise Exception("Cannot do upsert with an empty field_value_dict!")
+
+    # Put the fields in a canonical order so that dicts with the same fields in a different order share a statement
+    field_value_list = sorted(field_value_dict.items(), key=lambda x: x[0].name)
+    reset_field_list = sorted([x for x in overwrite_field_list or [] if x not in field_value_dict
+                               and x not in conflict_field_list], key=lambda x: x.name)
+
+    prepared_upsert = PreparedUpsert.get(schema_table, [x[0] for x in field_value_list], conflict_field_list,
+                                         reset_field_list)
+    prepared_upsert.execute(cursor, [strip_whitespace(x[1]) for x in field_value_list])
+
+
+def strip_whitespace(value: Any) -> Any:
+    """
+    Runs lstrip and rstrip on a value if it is a string (i.e. something that has lstrip and rstrip)
+
+    :param value: the value to strip
+    :return: the stripped value (or the value unchanged if it is not a string)
+    """
+    if hasattr(value, 'rstrip') and hasattr(value, 'lstrip'):
+        value = value.rstrip().lstrip()
+    return value
+
+
+class SQLDefault(object):
+    """
+    A sentinel for a value that should be filled with the column default, which psycopg2 adapts to the DEFAULT keyword
+    so that it can be used with execute_values (i.e. for rows that don't specify every column)
+    """
+
+    def __repr__(self):
+        return "DEFAULT"
+
+
+DEFAULT = SQLDefault()
+register_adapter(SQLDefault, lambda x: AsIs("DEFAULT"))
+
+
+def create_staging_table_sql(staging_table: Table, schema_table: SchemaTable) -> sql.Composable:
+    """
+    Creates a temporary staging table that has the same columns and defaults as the given schema table (but no
+    constraints) and is dropped at the end of the transaction. Any previous staging table of the same name in the
+    transaction is replaced.
+
+    :param staging_table: the name of the temporary staging table
+    :param schema_table: the schema table whose columns to copy
+    :return: the sql as a Composable
+    """
+    return sql.SQL("DROP TABLE IF EXISTS {staging};\n"
+                   "CREATE TEMPORARY TABLE {staging} (LIKE {schema_table} INCLUDING DEFAULTS) ON COMMIT DROP;"
+                   "").format(staging=staging_table, schema_table=schema_table)
+
+
+def merge_staging_table_sql(schema_table: SchemaTable, staging_table: Table, field_list: List[Field],
+                            conflict_field_list: List[Field]) -> sql.Composable:
+    """
+    Creates a single statement that upserts every row of a staging table into a schema table, i.e. the set-based
+    version of upsert_sql_from_field_value_dict.
+
+    :param schema_table: the schema table to upsert into
+    :param staging_table: the staging table to upsert from (it must not contain duplicate conflict field values)
+    :param field_list: the fields to copy from the staging table
+    :param conflict_field_list: a list of fields to use for the on conflict column
+    :return: the sql as a Composable
+    """
+    exc_fields = [sql.SQL("EXCLUDED.{}").format(x) for x in field_list]
+
+    # Same issue with single fields in Postgres 10 as in upsert_sql_from_field_value_dict
+    if len(field_list) == 1:
+        merge_sql_template = sql.SQL("INSERT INTO {schema_table} ({joined_fields}) \n"
+                                     "SELECT {joined_fields} FROM {staging} \n"
+                                     "ON CONFLICT ({joined_conf_fields}) \n"
+                                     " DO UPDATE SET {joined_fields} = {joined_exc_fields};")
+    else:
+        merge_sql_template = sql.SQL("INSERT INTO {schema_table} ({joined_fields}) \n"
+                                     "SELECT {joined_fields} FROM {staging} \n"
+                                     "ON CONFLICT ({joined_conf_fields}) \n"
+                                     " DO UPDATE SET ({joined_fields}) = ({joined_exc_fields});")
+
+    return merge_sql_template.format(
+        schema_table=schema_table,
+        staging=staging_table,
+        joined_fields=sql.SQL(", ").join(field_list),
+        joined_conf_fields=sql.SQL(", ").join(conflict_field_list),
         joined_exc_fields=sql.SQL(", ").join(exc_fields)
     )
 
 
+def update_from_staging_table_sql(schema_table: SchemaTable, staging_table: Table, field_list: List[Field],
+                                  id_field: Field) -> sql.Composable:
+    """
+    Creates a single statement that sets the given fields of every row of a schema table to the values of the row
+    in a staging table with the same id.
+
+    :param schema_table: the schema table to update
+    :param staging_table: the staging table to take the values from
+    :param field_list: the fields to update
+    :param id_field: the field to join the two tables on
+    :return: the sql as a Composable
+    """
+    return sql.SQL("UPDATE {schema_table} AS t SET {set_fields} \n"
+                   "FROM {staging} AS s WHERE t.{id} = s.{id};"
+                   "").format(schema_table=schema_table,
+                              staging=staging_table,
+                              set_fields=sql.SQL(", ").join(sql.SQL("{f} = s.{f}").format(f=x) for x in field_list),
+                              id=id_field)
+
+
 class TableError(Exception):
     """
     An exception for when the table given as an argument is not as expected
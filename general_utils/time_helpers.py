@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import time
+from contextlib import contextmanager
+from datetime import datetime
 from functools import wraps
-from typing import Callable, Any
+from typing import Callable, Any, Dict, List, Union
 
 import logging
 
@@ -56,6 +58,156 @@ def log_info_execution_time(description: str = None) -> Callable[..., Any]:
     return inner
 
 
+class ExecutionProfiler(object):
+    """
+    Records the wall time, the number of statements executed and the number of rows written for nested spans of work
+    (i.e. a rebuild, each of its phases, each data module and each DataClass).
+
+    Statements are counted by whatever cursor calls count_statement (i.e. the CountingCursor), which only counts
+    towards the spans of the profiler that is currently active:
+
+    profiler = ExecutionProfiler()
+    with profiler.activate():
+        with profiled("phase", "views"):
+            ...
+    """
+
+    _active = None  # type: Union[ExecutionProfiler, None]
+
+    def __init__(self):
+        self.spans = []  # type: List[Dict[str, Any]]
+        self._open_spans = []  # type: List[Dict[str, Any]]
+
+    @classmethod
+    def active(cls) -> Union['ExecutionProfiler', None]:
+        """
+        :return: the profiler that is currently active (or None)
+        """
+        return cls._active
+
+    @contextmanager
+    def activate(self):
+        """
+        A context manager that makes this the active profiler for the duration of the with block
+        """
+        previous = ExecutionProfiler._active
+        ExecutionProfiler._active = self
+        try:
+            yield self
+        finally:
+            ExecutionProfiler._active = previous
+
+    @contextmanager
+    def span(self, kind: str, name: str):
+        """
+        A context manager that records a span for the duration of the with block (the span is recorded even if the
+        block throws an error)
+
+        :param kind: the kind of span (i.e. "phase" or "data_class")
+        :param name: the name of the span
+        :return: the span dict, which is filled in with seconds at the end of the with block
+        """
+        span = self._new_span(kind, name)
+        self._open_spans.append(span)
+        t0 = time.time()
+        try:
+            yield span
+        finally:
+            span['seconds'] = time.time() - t0
+            self._open_spans.remove(span)
+            self.spans.append(span)
+
+    def _new_span(self, kind: str, name: str) -> Dict[str, Any]:
+        """
+        :param kind: the kind of span
+        :param name: the name of the span
+        :return: a new span dict nested in the innermost open span
+        """
+        return {
+            'kind': kind,
+            'name': name,
+            'parent': self._open_spans[-1]['name'] if len(self._open_spans) > 0 else None,
+            'depth': len(self._open_spans),
+            'started_at': datetime.now(),
+            'seconds': 0.0,
+            'statements': 0,
+            'rows': 0,
+        }
+
+    def count_statement(self, rows: int) -> None:
+        """
+        Counts a statement (and the rows it wrote) towards every open span
+
+        :param rows: the number of rows the statement wrote
+        """
+        for span in self._open_spans:
+            span['statements'] += 1
+            span['rows'] += max(rows, 0)
+
+    def add_span(self, kind: str, name: str, started_at: datetime, seconds: float, statements: int,
+                 rows: int) -> None:
+        """
+        Adds a span that was recorded elsewhere (i.e. by another process) as finished within the innermost open span,
+        counting its statements and rows towards every open span
+
+        :param kind: the kind of span
+        :param name: the name of the span
+        :param started_at: when the span started
+        :param seconds: how long the span took
+        :param statements: the number of statements executed in the span
+        :param rows: the number of rows written in the span
+        """
+        span = self._new_span(kind, name)
+        span.update(started_at=started_at, seconds=seconds, statements=statements, rows=rows)
+        for open_span in self._open_spans:
+            open_span['statements'] += statements
+            open_span['rows'] += rows
+        self.spans.append(span)
+
+    def sorted_spans(self) -> List[Dict[str, Any]]:
+        """
+        :return: all finished spans in the order they started
+        """
+        return sorted(self.spans, key=lambda x: (x['started_at'], x['depth']))
+
+    def slowest_spans(self, kind: str, n: int = 10) -> List[Dict[str, Any]]:
+        """
+        :param kind: the kind of span
+        :param n: how many spans to return
+        :return: the n slowest spans of the given kind
+        """
+        return sorted([x for x in self.spans if x['kind'] == kind], key=lambda x: x['seconds'], reverse=True)[:n]
+
+
+@contextmanager
+def profiled(kind: str, name: str):
+    """
+    A context manager that records a span in the active ExecutionProfiler for the duration of the with block (and
+    does nothing if no profiler is active)
+
+    :param kind: the kind of span (i.e. "phase" or "data_class")
+    :param name: the name of the span
+    :return: the span dict (or None if no profiler is active)
+    """
+    profiler = ExecutionProfiler.active()
+    if profiler is None:
+        yield None
+    else:
+        with profiler.span(kind, name) as span:
+            yield span
+
+
+def count_statement(rows: int) -> None:
+    """
+    Counts a statement towards the open spans of the active ExecutionProfiler (if any)
+
+    :param rows: the number of rows the statement wrote
+    """
+    profiler = ExecutionProfiler.active()
+    if profiler is not None:
+        profiler.count_statement(rows)
+
+
 @print_execution_time("Foo")
 def foo():
     """
@@ -2,36 +2,75 @@
 """
 A module designed to rebuild the entire database from the database_design and fill it with data
 """
-import glob
-import importlib
-import inspect
+import argparse
+import json
 import logging
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Dict, List, Tuple, Set, Any, Callable
 
 from psycopg2 import extensions, sql
 from psycopg2.extras import execute_values
 
-from database_design.sonata_data_classes import DataClass
+from database_design.data_modules import import_data_module, get_data_classes, get_owned_ids, \
+    get_owned_table_specs_in_delete_order, compute_data_module_hashes, compute_design_hash, \
+    get_data_class_dependency_graph, get_data_module_names_in_upsert_order, DataClassRegistry
+from database_design.rebuild_table_specs import DataModuleHash, RebuildMetrics, ArchiveGeneration
+from database_design.sonata_data_classes import BulkLoader
 from database_design.sonata_table_specs import Composer, Piece, Sonata, Intro, Expo, Development, \
-    Recap, Coda, sonata_archives_schema, ColumnDisplay
+    Recap, Coda, sonata_archives_schema, ColumnDisplay, SONATA_ARCHIVES_SCHEMA_NAME, create_key_type_sql
 from database_design.sonata_view_specs import ExpositionRecapitulation
-from directories import DATA_DIR, ROOT_DIR
-from general_utils.postgres_utils import LocalhostCursor
-from general_utils.sql_utils import execute_values_insert_query
+from directories import ROOT_DIR
+from general_utils.postgres_utils import LocalhostCursor, CountingCursor
+from general_utils.recording_cursor import RecordingCursor
+from general_utils.sql_trace import trace_sql, configure_sql_trace, get_sql_trace_settings, \
+    DEFAULT_MAX_LENGTH
+from general_utils.sql_utils import execute_values_insert_query, execute_upsert, table_exists, \
+    as_sql_string, SchemaTable
+from general_utils.time_helpers import ExecutionProfiler, profiled, log_info_execution_time
 
 log = logging.getLogger(__name__)
 
 # The function we assume all data modules will have
 DATA_MODULE_UPSERT_ALL = 'upsert_all'
-COMPOSERS_FILE_NAME = 'composers.py'
 
+# The schema a shadow rebuild moves the old database to while it builds the new one under the live name
+RETIRED_SCHEMA_NAME = SONATA_ARCHIVES_SCHEMA_NAME + "_retired"
 
-def create_all_tables(cursor: extensions.cursor, drop_if_exists: bool = True) -> None:
+# How long a shadow rebuild waits on locks before giving up (leaving the old database in place)
+SWAP_LOCK_TIMEOUT = '5s'
+
+# Where the JSON report of the spans the last rebuild was profiled with is written by default
+DEFAULT_REBUILD_REPORT_PATH = os.path.join(ROOT_DIR, 'rebuild_report.json')
+
+
+# The sonata table specs, in the order they are created in
+SONATA_TABLE_SPECS = [
+    ColumnDisplay,
+    Composer,
+    Piece,
+    Sonata,
+    Intro,
+    Expo,
+    Development,
+    Recap,
+    Coda,
+]
+
+
+@log_info_execution_time("Creating all tables")
+def create_all_tables(cursor: extensions.cursor, drop_if_exists: bool = True, defer_constraints: bool = False) -> None:
     """
     This function creates all sonata tables needed to construct the sonata_archives
 
     :param cursor: the postgres cursor to use to upsert the data
     :param drop_if_exists: if true, will wipe out the existing tables and rebuild
+    :param defer_constraints: if true, leaves out the constraints and indexes (other than the PKs on the ids, which
+    the upserts need) so that the data can be loaded without checking every FK row by row. create_all_constraints
+    must then be run after the data is loaded.
     """
 
     log.info('#' * 40)
@@ -40,52 +79,73 @@ def create_all_tables(cursor: extensions.cursor, drop_if_exists: bool = True) ->
     log.info('#' * 40)
     log.info('#' * 40)
 
-    # Create sonata archives schema
-    create_schema_sql = sql.SQL("CREATE SCHEMA IF NOT EXISTS {s};").format(s=sonata_archives_schema)
-    log.info("\n\n" + create_schema_sql.as_string(cursor) + "\n")
-    cursor.execute(create_schema_sql)
-
-    # Loop over all table specs objects twice to both create them and add their constraints
-    sonata_table_specs = [
-        ColumnDisplay,
-        Composer,
-        Piece,
-        Sonata,
-        Intro,
-        Expo,
-        Development,
-        Recap,
-        Coda,
-    ]
-    for table in sonata_table_specs:
-        create_table_sql = table.create_table_sql(drop_if_exists)
-        log.info("\n\n" + create_table_sql.as_string(cursor) + "\n")
-        cursor.execute(create_table_sql)
+    with profiled("phase", "create_schema"):
+        # Create sonata archives schema and all tables in a single round trip
+        create_sql_list = [sql.SQL("CREATE SCHEMA IF NOT EXISTS {s};").format(s=sonata_archives_schema),
+                           create_key_type_sql(drop_if_exists)]
+        create_sql_list.extend(table.create_table_sql(drop_if_exists) for table in SONATA_TABLE_SPECS)
+        for create_sql in create_sql_list:
+            trace_sql(create_sql)
+        cursor.execute(sql.SQL("\n").join(create_sql_list))
 
     # Execute constraint sql only after making all tables (the create scripts should make all PKs that use ID)
     # So this should just be for FKs or compound PKs
-    for table in sonata_table_specs:
-        create_constraint_sql = table.create_constraints_sql()
-        if create_constraint_sql is not None:
-            log.info("\n" + create_constraint_sql.as_string(cursor) + "\n")
-            cursor.execute(create_constraint_sql)
+    if defer_constraints:
+        log.info("Deferring the constraints and indexes until the data is loaded")
+    else:
+        create_all_constraints(cursor)
 
     # The column display table can now be filled, since it only depends on the Fields of the other tables
     # Loop through all tables (excluding the first column display table)
-    for table in sonata_table_specs[1:]:
+    with profiled("phase", "fill_column_display"):
+        data = []
+        for table in SONATA_TABLE_SPECS[1:]:
 
-        # Get all fields in the table (as Field objects)
-        fields = [x[0] for x in table.field_sql_type_list()]
+            # Get all fields in the table (as Field objects)
+            fields = [x[0] for x in table.field_sql_type_list()]
 
-        # For each field in the table, create tuples of type (table_name, field.name, field.display_name)
-        data = [(table.schema_table().table.string, field.name, field.display_name) for field in fields]
+            # For each field in the table, create tuples of type (table_name, field.name, field.display_name)
+            data.extend((table.schema_table().table.string, field.name, field.display_name) for field in fields)
 
-        # Batch insert them
+        # Batch insert them all at once
         insert_query = execute_values_insert_query(ColumnDisplay.schema_table())
-        log.info(insert_query.as_string(cursor))
-        execute_values(cursor, insert_query.as_string(cursor), data)
+        trace_sql(insert_query)
+        execute_values(cursor, as_sql_string(insert_query, cursor), data, page_size=len(data))
+
+    # Finally create the bookkeeping tables that keep track of the rebuilds themselves (the metrics are never dropped
+    # so that they keep the history of all rebuilds)
+    with profiled("phase", "create_bookkeeping_tables"):
+        create_sql_list = [DataModuleHash.create_table_sql(drop_if_exists),
+                           RebuildMetrics.create_table_sql(drop_if_exists=False, if_not_exists=True)]
+        for create_sql in create_sql_list:
+            trace_sql(create_sql)
+        cursor.execute(sql.SQL("\n").join(create_sql_list))
+
+
+@log_info_execution_time("Creating all constraints")
+def create_all_constraints(cursor: extensions.cursor) -> None:
+    """
+    This function creates the constraints and indexes of all sonata tables (should be run only after all tables have
+    been created) as a single script in a single round trip.
 
+    :param cursor: the postgres cursor to use to create the constraints
+    """
+
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("CREATING ALL CONSTRAINTS AND INDEXES")
+    log.info('#' * 40)
+    log.info('#' * 40)
 
+    with profiled("phase", "create_constraints"):
+        constraint_sql_list = [x for table in SONATA_TABLE_SPECS
+                               for x in [table.create_constraints_sql(), table.create_indexes_sql()] if x is not None]
+        for constraint_sql in constraint_sql_list:
+            trace_sql(constraint_sql)
+        cursor.execute(sql.SQL("\n").join(constraint_sql_list))
+
+
+@log_info_execution_time("Creating all views")
 def create_all_views(cursor: extensions.cursor, drop_if_exists: bool = True) -> None:
     """
     This function creates all sonata views (should be run only after all tables have been created).
@@ -105,13 +165,15 @@ def create_all_views(cursor: extensions.cursor, drop_if_exists: bool = True) ->
         ExpositionRecapitulation
     ]
 
-    for view in sonata_view_specs:
-        create_view_sql = view.create_view_sql(cur, drop_if_exists)
-        log.info("\n\n" + create_view_sql.as_string(cursor) + "\n")
-        cursor.execute(create_view_sql)
+    with profiled("phase", "create_views"):
+        for view in sonata_view_specs:
+            create_view_sql = view.create_view_sql(cursor, drop_if_exists)
+            trace_sql(create_view_sql)
+            cursor.execute(create_view_sql)
 
 
-def upsert_all_data(cursor: extensions.cursor) -> None:
+@log_info_execution_time("Upserting all data")
+def upsert_all_data(cursor: extensions.cursor, registry: DataClassRegistry = None) -> Dict[str, Dict[str, List[str]]]:
     """
     This function recursively iterates over and loads all python modules in the 'data' folder and grabs all classes
     defined in them, and runs their upsert_data function.
@@ -120,11 +182,10 @@ def upsert_all_data(cursor: extensions.cursor) -> None:
     is not a subclass of DataClass.
 
     :param cursor: the postgres cursor to use to upsert the data
+    :param registry: the DataClassRegistry of the rebuild, loads it if not given
+    :return: a dict mapping each data module name to the ids it owns (see upsert_data_module)
     """
 
-    # Get all python files recursively under the data dir
-    data_file_full_path_list = glob.glob(os.path.join(DATA_DIR, '**/*.py'), recursive=True)
-
     log.info('#' * 40)
     log.info('#' * 40)
     log.info('#' * 40)
@@ -133,94 +194,702 @@ def upsert_all_data(cursor: extensions.cursor) -> None:
     log.info('#' * 40)
     log.info('#' * 40 + "\n")
 
-    first = True
-    for data_file_full_path in data_file_full_path_list:
+    # Upsert the modules in dependency order (i.e. data.composers first since the pieces link to the composers)
+    owned_ids_by_module = {}
+    with profiled("phase", "upsert_all_data"):
+        for module_name in get_data_module_names_in_upsert_order(registry=registry):
+            data_module = import_data_module(module_name)
+            owned_ids_by_module[module_name] = upsert_data_module(cursor, data_module)
 
-        path_name, file_name = os.path.split(data_file_full_path)
+    return owned_ids_by_module
 
-        # Skip any module specifier files as they don't count
-        if file_name == '__init__.py':
-            continue
 
-        # Make sure that composers is always first since we need that module upserted first
-        # (because it's the only file at root level, it should be, but let's check just in case)
-        if first and file_name != COMPOSERS_FILE_NAME:
-            raise Exception("Encountered file {0} before {1}... "
-                            "Make sure {1} is the only file in the root data directory so it is executed first!"
-                            "".format(file_name, COMPOSERS_FILE_NAME))
-        first = False
-
-        data_module = get_module_from_data_dirname(data_file_full_path)
-
-        log.info('#' * 150)
-        log.info('#' * 150)
-        log.info("LOADED: {}".format(data_module))
-        log.info('#' * 150)
-        log.info('#' * 150)
-
-        # Get a list of all the classes defined in the given module (returns tuples of cls_name, and cls)
-        class_list_tuples = inspect.getmembers(data_module, lambda member:
-                                               inspect.isclass(member) and member.__module__ == data_module.__name__)
-        # Note: Checking member's module necessary to avoid imports
-
-        # Throw errors if no classes or if any classes not a subclass of DataClass,
-        # else run each class's upsert_data to update the db
-        if len(class_list_tuples) == 0:
-            raise Exception("\"{}\" contained no classes! "
-                            "Every module in the data directory must contain at least 1 class"
-                            "".format(data_module))
-
-        for cls_name, cls in class_list_tuples:
-            if issubclass(cls, DataClass):
-                cls.upsert_data(cursor)
-            else:
-                raise Exception("\"{}\" contained the class \"{}\", which was not a subclass of \"DataClass\"!"
-                                "".format(data_module, cls_name))
+@log_info_execution_time("Upserting all data in parallel")
+def upsert_all_data_parallel(num_workers: int, module_names: List[str] = None,
+                             registry: DataClassRegistry = None) -> Dict[str, Dict[str, List[str]]]:
+    """
+    A parallel version of upsert_all_data that builds an explicit dependency DAG between all DataClasses (composers,
+    then the pieces linking to them, then the sonatas and their blocks linking to those) and runs every DataClass's
+    upsert_data on a process pool as soon as everything it depends on has been committed.
+
+    Each worker process has its own LocalhostCursor connection and every DataClass is upserted (and committed) in its
+    own transaction, so unlike upsert_all_data a failure will leave the DataClasses that already finished in place.
+    The final database state is the same as the serial path since every DataClass only writes its own rows.
+
+    Logs the parallelism as the sum of the time spent in every upsert over the wall time of the whole parallel upsert
+    (how many workers were busy on average, which is not a speedup over a serial run), and adds the span every worker
+    profiled for its DataClass to the active profiler (if any).
+
+    :param num_workers: the number of worker processes to use
+    :param module_names: the data modules to upsert, defaults to all data modules
+    :param registry: the DataClassRegistry of the rebuild, loads it if not given
+    :return: a dict mapping each data module name to the ids it owns (see upsert_data_module)
+    """
 
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("UPSERTING ALL DATA IN PARALLEL WITH {} WORKERS".format(num_workers))
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info('#' * 40 + "\n")
 
-def get_module_from_data_dirname(data_file_full_path: str):
+    registry = DataClassRegistry.load() if registry is None else registry
+    if module_names is None:
+        module_names = registry.module_names()
+
+    graph = get_data_class_dependency_graph(module_names, registry)
+    remaining_dependencies = {node: set(dependencies) for node, dependencies in graph.items()}
+    dependents = {node: set() for node in graph}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].add(node)
+
+    t0 = time.time()
+    total_upsert_seconds = 0.0
+    profiler = ExecutionProfiler.active()
+
+    # Use spawn so that no worker inherits a connection from this process
+    with profiled("phase", "upsert_all_data_parallel"), \
+            ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_upsert_worker,
+                                initargs=(logging.getLogger().level, get_sql_trace_settings())) as executor:
+
+        running = {}
+
+        def submit_ready_nodes():
+            for ready_node in [x for x, dependencies in remaining_dependencies.items() if len(dependencies) == 0]:
+                del remaining_dependencies[ready_node]
+                running[executor.submit(_upsert_data_class_in_worker, *ready_node)] = ready_node
+
+        submit_ready_nodes()
+        while len(running) > 0:
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                # Re-raises any exception from the worker (which cancels everything still pending)
+                span = future.result()
+                total_upsert_seconds += span['seconds']
+                if profiler is not None:
+                    profiler.add_span(**span)
+                log.info("UPSERTED: {}.{}".format(*node))
+                for dependent in dependents[node]:
+                    remaining_dependencies[dependent].discard(node)
+            submit_ready_nodes()
+
+        if len(remaining_dependencies) > 0:
+            raise Exception("Dependency cycle between {}".format(sorted(remaining_dependencies)))
+
+    wall_seconds = time.time() - t0
+    log.info("Upserted {} DataClasses in {:.2f} seconds with {} workers (vs. {:.2f} seconds spent upserting), "
+             "a parallelism of {:.2f}".format(len(graph), wall_seconds, num_workers, total_upsert_seconds,
+                                           total_upsert_seconds / wall_seconds if wall_seconds > 0 else 1.0))
+
+    return {module_name: registry.owned_ids(module_name) for module_name in module_names}
+
+
+@log_info_execution_time("Bulk loading all data")
+def upsert_all_data_bulk(cursor: extensions.cursor, module_names: List[str] = None,
+                         registry: DataClassRegistry = None) -> Dict[str, Dict[str, List[str]]]:
     """
-    Given a full path from a data file, this method will convert it into a module imported by the importlib by stripping
-    it down to just the elements beyond the root dir and then joining them with '.'
+    A bulk version of upsert_all_data that gathers the rows of every DataClass into per-table buffers with a BulkLoader
+    and loads each table with a few set-based statements instead of running every DataClass's upsert_data.
 
-    :param data_file_full_path: the string name of the full path
-    :return: the data file as a module
+    :param cursor: the postgres cursor to use to load the data
+    :param module_names: the data modules to load, defaults to all data modules
+    :param registry: the DataClassRegistry of the rebuild, loads it if not given
+    :return: a dict mapping each data module name to the ids it owns (see upsert_data_module)
     """
-    module_element_list = []
 
-    # Pop the last element off the full path until we reach the ROOT_DIR
-    path = data_file_full_path
-    while True:
-        # If path is ROOT_DIR, we have everything
-        if path == ROOT_DIR:
-            break
-        elif path == "":
-            raise Exception(
-                "Error! Root directory {} not present at the base of path {}".format(ROOT_DIR, data_file_full_path))
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("BULK LOADING ALL DATA")
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info('#' * 40 + "\n")
 
-        # Pop off the last element and extension and insert it at the beginning of the list
-        path, last = os.path.split(path)
-        last = os.path.splitext(last)[0]   # remove extension
+    bulk_loader = BulkLoader()
+    owned_ids_by_module = {}
+    with profiled("phase", "gather_bulk_rows"):
+        for module_name in get_data_module_names_in_upsert_order(module_names, registry):
+            data_module = import_data_module(module_name)
+            for cls_name, cls in get_data_classes(data_module):
+                bulk_loader.add_data_class(cls)
+            owned_ids_by_module[module_name] = get_owned_ids(data_module)
 
-        # insert at the beginning since last element popped is actually the earliest dir
-        module_element_list.insert(0, last)
+    log.info("Loading {} rows from {} data modules".format(bulk_loader.row_count, len(owned_ids_by_module)))
+    with profiled("phase", "bulk_load"):
+        bulk_loader.load(cursor)
 
-    module_name = '.'.join(module_element_list)
-    module = importlib.import_module(module_name)
-    return module
+    return owned_ids_by_module
 
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO,
+def _init_upsert_worker(log_level: int, sql_trace_settings: Dict[str, Any]) -> None:
+    """
+    Initializes a worker process of upsert_all_data_parallel (which is spawned so it needs its own logging setup)
+
+    :param log_level: the log level of the parent process
+    :param sql_trace_settings: the settings the parent process configured the sql trace with
+    """
+    logging.basicConfig(level=log_level,
                         format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    configure_sql_trace(**sql_trace_settings)
 
-    with LocalhostCursor() as cur:
-        create_all_tables(cur, drop_if_exists=True)
+
+def _upsert_data_class_in_worker(module_name: str, cls_name: str) -> Dict[str, Any]:
+    """
+    Upserts a single DataClass in a worker process of upsert_all_data_parallel using the worker's own connection
+
+    :param module_name: the name of the data module the DataClass is defined in
+    :param cls_name: the name of the DataClass
+    :return: the span of the upsert as the keyword arguments of ExecutionProfiler.add_span (with how long it took,
+    how many statements it executed and how many rows it wrote)
+    """
+    profiler = ExecutionProfiler()
+    with profiler.activate(), profiler.span("data_class", "{}.{}".format(module_name, cls_name)) as span:
+        cls = getattr(import_data_module(module_name), cls_name)
+        with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+            cls.upsert_data(cur)
+    return {x: span[x] for x in ['kind', 'name', 'started_at', 'seconds', 'statements', 'rows']}
+
+
+def upsert_data_module(cursor: extensions.cursor, data_module) -> Dict[str, List[str]]:
+    """
+    Runs the upsert_data function of every DataClass defined in the given data module.
+
+    :param cursor: the postgres cursor to use to upsert the data
+    :param data_module: the imported data module
+    :return: a dict mapping table name to the list of ids owned by the module in that table
+    """
+    log.info('#' * 150)
+    log.info('#' * 150)
+    log.info("LOADED: {}".format(data_module))
+    log.info('#' * 150)
+    log.info('#' * 150)
+
+    # Throws errors if no classes or if any classes not a subclass of DataClass
+    with profiled("data_module", data_module.__name__):
+        for cls_name, cls in get_data_classes(data_module):
+            with profiled("data_class", "{}.{}".format(data_module.__name__, cls_name)):
+                cls.upsert_data(cursor)
+
+    return get_owned_ids(data_module)
+
+
+def fetch_data_module_hashes(cursor: extensions.cursor) -> Dict[str, Tuple[str, str, Dict[str, List[str]]]]:
+    """
+    Fetches the bookkeeping rows that record the hash of every data module as of the last time it was upserted
+
+    :param cursor: the postgres cursor to use to query
+    :return: a dict mapping module name to a tuple of (source_hash, design_hash, owned_ids)
+    """
+    cursor.execute(sql.SQL("SELECT {mn}, {sh}, {dh}, {oi} FROM {st};").format(mn=DataModuleHash.MODULE_NAME,
+                                                                            sh=DataModuleHash.SOURCE_HASH,
+                                                                            dh=DataModuleHash.DESIGN_HASH,
+                                                                            oi=DataModuleHash.OWNED_IDS,
+                                                                            st=DataModuleHash.schema_table()))
+    return {module_name: (source_hash, design_hash, owned_ids)
+            for module_name, source_hash, design_hash, owned_ids in cursor.fetchall()}
+
+
+def record_data_module_hashes(cursor: extensions.cursor, owned_ids_by_module: Dict[str, Dict[str, List[str]]],
+                              module_hashes: Dict[str, str], design_hash: str) -> None:
+    """
+    Upserts the bookkeeping rows for the given data modules so the next incremental rebuild knows they are current
+
+    :param cursor: the postgres cursor to use to upsert the data
+    :param owned_ids_by_module: a dict mapping each data module name that was upserted to the ids it owns
+    :param module_hashes: a dict mapping data module name to its current hash (see compute_data_module_hashes)
+    :param design_hash: the current hash of the database design (see compute_design_hash)
+    """
+    upserted_at = datetime.now()
+    with profiled("phase", "record_data_module_hashes"):
+        for module_name, owned_ids in owned_ids_by_module.items():
+            execute_upsert(cursor, DataModuleHash.schema_table(), {
+                DataModuleHash.MODULE_NAME: module_name,
+                DataModuleHash.SOURCE_HASH: module_hashes[module_name],
+                DataModuleHash.DESIGN_HASH: design_hash,
+                DataModuleHash.OWNED_IDS: owned_ids,
+                DataModuleHash.UPSERTED_AT: upserted_at,
+            }, conflict_field_list=[DataModuleHash.MODULE_NAME])
+
+
+def delete_owned_rows(cursor: extensions.cursor, owned_ids: Dict[str, Set[str]]) -> None:
+    """
+    Deletes the given owned ids from their tables in an order that respects the FKs (sonatas, then pieces, then
+    composers). Deleting a sonata cascades to all of its blocks.
+
+    :param cursor: the postgres cursor to use to delete the data
+    :param owned_ids: a dict mapping table name to the ids to delete from it
+    """
+    for table_spec in get_owned_table_specs_in_delete_order():
+        ids = owned_ids.get(table_spec.schema_table().table.string)
+        if not ids:
+            continue
+        delete_sql = sql.SQL("DELETE FROM {st} WHERE {id} IN %s;").format(st=table_spec.schema_table(),
+                                                                          id=table_spec.ID)
+        log.info("Deleting {} from {}".format(sorted(ids), table_spec.schema_table().string))
+        cursor.execute(delete_sql, (tuple(sorted(ids)),))
+
+
+def bump_archive_generation(cursor: extensions.cursor) -> None:
+    """
+    Bumps the generation of the archive (creating its table first if a database that was built before it existed
+    doesn't have it yet), which tells the caches of query results that the data changed
+
+    :param cursor: the postgres cursor to use (the new generation becomes visible when it commits)
+    """
+    create_table_sql = ArchiveGeneration.create_table_sql(drop_if_exists=False, if_not_exists=True)
+    format_kwargs = dict(st=ArchiveGeneration.schema_table(), g=ArchiveGeneration.GENERATION,
+                         ba=ArchiveGeneration.BUMPED_AT, now=sql.Literal(datetime.now()))
+    update_sql = sql.SQL("UPDATE {st} SET {g} = {g} + 1, {ba} = {now};").format(**format_kwargs)
+    insert_sql = sql.SQL("INSERT INTO {st} ({g}, {ba}) SELECT 1, {now} "
+                         "WHERE NOT EXISTS (SELECT 1 FROM {st});").format(**format_kwargs)
+
+    # Separate executes so that the rows each statement touched are counted (a multi-statement execute only reports
+    # the rowcount of its last statement)
+    with profiled("phase", "bump_archive_generation"):
+        for statement in [create_table_sql, update_sql, insert_sql]:
+            trace_sql(statement)
+            cursor.execute(statement)
+
+    # Anything this process loaded from the old generation is stale too
+    ColumnDisplay.refresh_display_name_catalog()
+
+
+@log_info_execution_time("Full rebuild")
+def rebuild_database(num_workers: int = 0, bulk: bool = False, shadow: bool = False,
+                     registry: DataClassRegistry = None) -> None:
+    """
+    Fully rebuilds the database by dropping and recreating all tables and views and then upserting all data, recording
+    the hash of every data module along the way so that a later incremental rebuild can pick up from here.
+
+    :param num_workers: if more than 0, upserts the data in parallel with this many worker processes
+    :param bulk: if True, loads the data in bulk with set-based statements instead (can't be combined with num_workers)
+    :param shadow: if True, builds the new database in place of the live one in a single transaction (see
+    shadow_rebuild_database) so that readers never see missing or half-filled tables (can't be combined with
+    num_workers)
+    :param registry: the DataClassRegistry to rebuild from, loads it if not given (and passes it down so that it's only
+    loaded once per rebuild)
+    """
+    if num_workers > 0 and bulk:
+        raise Exception("Can either upsert the data in parallel or load it in bulk, but not both!")
+    if num_workers > 0 and shadow:
+        raise Exception("A shadow rebuild upserts everything in a single transaction, so it can't be parallel!")
+
+    registry = DataClassRegistry.load() if registry is None else registry
+
+    if shadow:
+        shadow_rebuild_database(bulk, registry)
+        return
+
+    # A bulk load is faster without checking every FK row by row, so it adds the constraints after loading the data
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        create_all_tables(cur, drop_if_exists=True, defer_constraints=bulk)
 
     # Need to leave the with block to commit the connection so that the tables exist
-    with LocalhostCursor() as cur:
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
         create_all_views(cur, drop_if_exists=True)
 
-    with LocalhostCursor() as cur:
-        upsert_all_data(cur)
+    if num_workers > 0:
+        owned_ids_by_module = upsert_all_data_parallel(num_workers, registry=registry)
+        with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+            record_data_module_hashes(cur, owned_ids_by_module, compute_data_module_hashes(registry),
+                                      compute_design_hash())
+    elif bulk:
+        with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+            owned_ids_by_module = upsert_all_data_bulk(cur, registry=registry)
+            create_all_constraints(cur)
+            record_data_module_hashes(cur, owned_ids_by_module, compute_data_module_hashes(registry),
+                                      compute_design_hash())
+    else:
+        with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+            owned_ids_by_module = upsert_all_data(cur, registry)
+            record_data_module_hashes(cur, owned_ids_by_module, compute_data_module_hashes(registry),
+                                      compute_design_hash())
+
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        bump_archive_generation(cur)
+
+
+@log_info_execution_time("Shadow rebuild")
+def shadow_rebuild_database(bulk: bool = False, registry: DataClassRegistry = None) -> None:
+    """
+    Fully rebuilds the database without any downtime for the app: the live schema is renamed out of the way and the
+    whole database is built in its place within a single transaction, so until that commits every other connection
+    still sees (and reads) the old schema under the live name, and after it commits they all see the new one.
+
+    If anything fails before the commit, the transaction is rolled back and the live schema is left exactly as it was.
+    Every upsert has to be in the one transaction, which is why a shadow rebuild can't upsert in parallel.
+
+    :param bulk: if True, loads the data in bulk with set-based statements instead
+    :param registry: the DataClassRegistry to rebuild from, loads it if not given
+    """
+
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("SHADOW REBUILD")
+    log.info('#' * 40)
+    log.info('#' * 40)
+
+    # A leftover retired schema is from a shadow rebuild whose drop failed, it's stale either way
+    with profiled("phase", "drop_retired_schema"), LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        drop_schema(cur, RETIRED_SCHEMA_NAME)
+
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        with profiled("phase", "retire_live_schema"):
+            is_live_schema_retired = retire_live_schema(cur)
+
+        build_database(cur, bulk, registry)
+
+        if is_live_schema_retired:
+            with profiled("phase", "carry_over_history"):
+                carry_over_history_from_retired_schema(cur)
+
+        bump_archive_generation(cur)
+
+    # Dropping the old tables waits on any reader still using them, so do it after the new ones were committed
+    with profiled("phase", "drop_retired_schema"), LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        drop_schema(cur, RETIRED_SCHEMA_NAME)
+
+
+def drop_schema(cursor: extensions.cursor, schema_name: str) -> None:
+    """
+    Drops the given schema (and everything in it) if it exists
+
+    :param cursor: the postgres cursor to use
+    :param schema_name: the name of the schema to drop
+    """
+    drop_schema_sql = sql.SQL("DROP SCHEMA IF EXISTS {s} CASCADE;").format(s=sql.Identifier(schema_name))
+    trace_sql(drop_schema_sql)
+    cursor.execute(drop_schema_sql)
+
+
+def schema_exists(cursor: extensions.cursor, schema_name: str) -> bool:
+    """
+    Checks whether the given schema exists
+
+    :param cursor: the postgres cursor to use
+    :param schema_name: the name of the schema
+    :return: True if it exists
+    """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = %s);", (schema_name,))
+    return cursor.fetchone()[0]
+
+
+def retire_live_schema(cursor: extensions.cursor) -> bool:
+    """
+    Renames the live sonata archives schema to the retired schema (if there is a live schema yet), so that the new
+    database can be built under the live name in the same transaction. Renaming a schema only touches the catalog, so
+    it doesn't wait on (or block) the readers of its tables.
+
+    :param cursor: the postgres cursor to use (the rename becomes visible to others when it commits)
+    :return: True if there was a live schema to retire
+    """
+
+    log.info('#' * 40)
+    log.info("RETIRING {}".format(SONATA_ARCHIVES_SCHEMA_NAME))
+    log.info('#' * 40)
+
+    # Only wait a short while for locks so a rebuild stuck behind something never stalls the app's queries behind it
+    cursor.execute(sql.SQL("SET LOCAL lock_timeout = {};").format(sql.Literal(SWAP_LOCK_TIMEOUT)))
+
+    if not schema_exists(cursor, SONATA_ARCHIVES_SCHEMA_NAME):
+        return False
+
+    retire_sql = sql.SQL("ALTER SCHEMA {old} RENAME TO {new};").format(old=sql.Identifier(SONATA_ARCHIVES_SCHEMA_NAME),
+                                                                       new=sql.Identifier(RETIRED_SCHEMA_NAME))
+    trace_sql(retire_sql)
+    cursor.execute(retire_sql)
+    return True
+
+
+def carry_over_history_from_retired_schema(cursor: extensions.cursor) -> None:
+    """
+    Copies what the new database should keep from the retired schema: the metrics of earlier rebuilds, and the
+    generation of the archive (so that bumping it afterwards goes on from the retired one)
+
+    :param cursor: the postgres cursor to use (within the transaction that built the new database)
+    """
+    for table_spec in [RebuildMetrics, ArchiveGeneration]:
+        retired_schema_table = SchemaTable(RETIRED_SCHEMA_NAME, table_spec.schema_table().table)
+        if table_exists(retired_schema_table, cursor):
+            create_table_sql = table_spec.create_table_sql(drop_if_exists=False, if_not_exists=True)
+            copy_sql = sql.SQL("INSERT INTO {st} SELECT * FROM {retired};").format(st=table_spec.schema_table(),
+                                                                                   retired=retired_schema_table)
+            for statement in [create_table_sql, copy_sql]:
+                trace_sql(statement)
+                cursor.execute(statement)
+
+
+def build_database(cursor: extensions.cursor, bulk: bool = False, registry: DataClassRegistry = None) -> None:
+    """
+    Builds the whole database on a single cursor (so in a single transaction): creates all tables and views, upserts
+    all data and records the hash of every data module
+
+    :param cursor: the postgres cursor to use
+    :param bulk: if True, loads the data in bulk with set-based statements (many rows per INSERT) instead
+    :param registry: the DataClassRegistry to build from, loads it if not given
+    """
+    registry = DataClassRegistry.load() if registry is None else registry
+    create_all_tables(cursor, drop_if_exists=True, defer_constraints=bulk)
+    create_all_views(cursor, drop_if_exists=True)
+    if bulk:
+        owned_ids_by_module = upsert_all_data_bulk(cursor, registry=registry)
+        create_all_constraints(cursor)
+    else:
+        owned_ids_by_module = upsert_all_data(cursor, registry)
+    record_data_module_hashes(cursor, owned_ids_by_module, compute_data_module_hashes(registry), compute_design_hash())
+
+
+@log_info_execution_time("Compiling the database")
+def compile_database(script_path: str, bulk: bool = False) -> None:
+    """
+    Compiles the full rebuild into a single transactional SQL script without a database: creates all tables and views
+    and upserts all data with a RecordingCursor that only records the statements, and writes them out to the given
+    path so the script can be applied later with psql -f (i.e. on a server, from a build made without postgres).
+
+    :param script_path: where to write the SQL script
+    :param bulk: if True, loads the data in bulk with set-based statements (many rows per INSERT) instead
+    """
+
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("COMPILING THE DATABASE INTO {}".format(script_path))
+    log.info('#' * 40)
+    log.info('#' * 40)
+
+    with RecordingCursor(script_path) as cur:
+        build_database(cur, bulk)
+        bump_archive_generation(cur)
+
+
+@log_info_execution_time("Incremental rebuild")
+def incremental_rebuild_database(num_workers: int = 0, bulk: bool = False) -> None:
+    """
+    Rebuilds the database by only re-upserting the data modules whose hash (which covers their source and the source
+    of every data module they import) changed since they were last upserted, and deleting the rows owned by modules
+    that were removed (or by classes that were removed from a module).
+
+    If the bookkeeping table is missing or the database_design (or anything else the tables depend on) changed,
+    this falls back on a full rebuild since the tables themselves may need to change.
+
+    :param num_workers: if more than 0, does any full rebuild with this many worker processes
+    :param bulk: if True, loads the changed data modules (or does any full rebuild) in bulk
+    """
+
+    log.info('#' * 40)
+    log.info('#' * 40)
+    log.info("INCREMENTAL REBUILD")
+    log.info('#' * 40)
+    log.info('#' * 40)
+
+    design_hash = compute_design_hash()
+    registry = DataClassRegistry.load()
+
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        if all(table_exists(x.schema_table(), cur) for x in [Composer, Piece, Sonata, DataModuleHash]):
+            stored_hashes = fetch_data_module_hashes(cur)
+        else:
+            stored_hashes = {}
+
+    if len(stored_hashes) == 0 or any(x[1] != design_hash for x in stored_hashes.values()):
+        log.info("No record of a previous build with the current database design, doing a full rebuild")
+        rebuild_database(num_workers, bulk, registry=registry)
+        return
+
+    module_hashes = compute_data_module_hashes(registry)
+    changed_module_names = [x for x in get_data_module_names_in_upsert_order(module_hashes, registry)
+                            if x not in stored_hashes or stored_hashes[x][0] != module_hashes[x]]
+    removed_module_names = [x for x in stored_hashes if x not in module_hashes]
+
+    log.info("{} of {} data modules changed: {}".format(len(changed_module_names), len(module_hashes),
+                                                        changed_module_names))
+    log.info("{} data modules removed: {}".format(len(removed_module_names), removed_module_names))
+
+    with LocalhostCursor(cursor_factory=CountingCursor) as cur:
+        if bulk:
+            owned_ids_by_module = upsert_all_data_bulk(cur, changed_module_names, registry) \
+                if changed_module_names else {}
+        else:
+            owned_ids_by_module = {}
+            with profiled("phase", "upsert_changed_data"):
+                for module_name in changed_module_names:
+                    owned_ids_by_module[module_name] = upsert_data_module(cur, import_data_module(module_name))
+        record_data_module_hashes(cur, owned_ids_by_module, module_hashes, design_hash)
+
+        # Anything that was owned by a changed or removed module that no current module owns anymore is stale
+        # (unchanged modules still own what they owned before)
+        current_owned_ids = {}
+        for module_name in module_hashes:
+            owned_ids = owned_ids_by_module.get(module_name, stored_hashes.get(module_name, (None, None, {}))[2])
+            for table_name, ids in owned_ids.items():
+                current_owned_ids.setdefault(table_name, set()).update(ids)
+
+        stale_owned_ids = {}
+        for module_name in changed_module_names + removed_module_names:
+            if module_name in stored_hashes:
+                for table_name, ids in stored_hashes[module_name][2].items():
+                    stale_ids = set(ids) - current_owned_ids.get(table_name, set())
+                    stale_owned_ids.setdefault(table_name, set()).update(stale_ids)
+
+        with profiled("phase", "delete_stale_data"):
+            delete_owned_rows(cur, stale_owned_ids)
+
+            if len(removed_module_names) > 0:
+                cur.execute(sql.SQL("DELETE FROM {st} WHERE {mn} IN %s;").format(st=DataModuleHash.schema_table(),
+                                                                                 mn=DataModuleHash.MODULE_NAME),
+                            (tuple(removed_module_names),))
+
+        bump_archive_generation(cur)
+
+
+def run_profiled_rebuild(rebuild_mode: str, rebuild_function: Callable[..., None], *args,
+                         report_path: str = DEFAULT_REBUILD_REPORT_PATH, record_metrics: bool = True) -> None:
+    """
+    Runs one of the rebuild functions with an active ExecutionProfiler, so that the wall time, statement count and
+    rows written of the rebuild, each of its phases, each data module and each DataClass are recorded. Afterwards
+    they are written to a JSON report (even if the rebuild failed) and to the rebuild_metrics table.
+
+    :param rebuild_mode: a name for the kind of rebuild (i.e. "full" or "incremental --bulk")
+    :param rebuild_function: the rebuild function (i.e. rebuild_database)
+    :param args: the arguments to call the rebuild function with
+    :param report_path: where to write the JSON report
+    :param record_metrics: if True, also inserts the metrics into the rebuild_metrics table
+    """
+    profiler = ExecutionProfiler()
+    try:
+        with profiler.activate(), profiler.span("rebuild", rebuild_mode):
+            rebuild_function(*args)
+    finally:
+        write_rebuild_report(report_path, profiler, rebuild_mode)
+
+    for span in profiler.sorted_spans():
+        if span['kind'] in ["rebuild", "phase"]:
+            log.info("{}{}: {:.2f} seconds, {} statements, {} rows".format(
+                '  ' * span['depth'], span['name'], span['seconds'], span['statements'], span['rows']))
+
+    if record_metrics:
+        with LocalhostCursor() as cur:
+            record_rebuild_metrics(cur, profiler, rebuild_mode)
+
+
+def get_rebuild_id(profiler: ExecutionProfiler) -> str:
+    """
+    :param profiler: the profiler a rebuild was run with
+    :return: the id of the rebuild (when it started)
+    """
+    return min(x['started_at'] for x in profiler.spans).isoformat()
+
+
+def record_rebuild_metrics(cursor: extensions.cursor, profiler: ExecutionProfiler, rebuild_mode: str) -> None:
+    """
+    Inserts every span of a profiled rebuild into the rebuild_metrics table (creating it first if a database that was
+    built before it existed doesn't have it yet)
+
+    :param cursor: the postgres cursor to use to insert the metrics
+    :param profiler: the profiler the rebuild was run with
+    :param rebuild_mode: the name of the kind of rebuild
+    """
+    create_table_sql = RebuildMetrics.create_table_sql(drop_if_exists=False, if_not_exists=True)
+    trace_sql(create_table_sql)
+    cursor.execute(create_table_sql)
+
+    rebuild_id = get_rebuild_id(profiler)
+    data = [(rebuild_id, rebuild_mode, x['kind'], x['name'], x['parent'], x['depth'], x['started_at'], x['seconds'],
+             x['statements'], x['rows']) for x in profiler.sorted_spans()]
+
+    insert_query = execute_values_insert_query(RebuildMetrics.schema_table())
+    trace_sql(insert_query)
+    execute_values(cursor, as_sql_string(insert_query, cursor), data)
+
+
+def write_rebuild_report(report_path: str, profiler: ExecutionProfiler, rebuild_mode: str) -> None:
+    """
+    Writes every span of a profiled rebuild to a JSON report, along with the slowest data modules and DataClasses
+
+    :param report_path: where to write the JSON report
+    :param profiler: the profiler the rebuild was run with
+    :param rebuild_mode: the name of the kind of rebuild
+    """
+    if len(profiler.spans) == 0:
+        return
+
+    def to_json(span):
+        return dict(span, started_at=span['started_at'].isoformat())
+
+    rebuild_span = next(x for x in profiler.spans if x['kind'] == "rebuild")
+    report = {
+        'rebuild_id': get_rebuild_id(profiler),
+        'rebuild_mode': rebuild_mode,
+        'seconds': rebuild_span['seconds'],
+        'statements': rebuild_span['statements'],
+        'rows': rebuild_span['rows'],
+        'slowest_data_modules': [to_json(x) for x in profiler.slowest_spans("data_module")],
+        'slowest_data_classes': [to_json(x) for x in profiler.slowest_spans("data_class")],
+        'slowest_tables': [to_json(x) for x in profiler.slowest_spans("table")],
+        'spans': [to_json(x) for x in profiler.sorted_spans()],
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    log.info("Wrote the rebuild report to {}".format(report_path))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--incremental', action='store_true',
+                        help="only re-upsert the data modules that changed since the last rebuild")
+    parser.add_argument('--parallel', type=int, default=0, metavar='NUM_WORKERS',
+                        help="upsert all data on a pool of this many worker processes")
+    parser.add_argument('--bulk', action='store_true',
+                        help="load all data in bulk with a few set-based statements per table")
+    parser.add_argument('--shadow', action='store_true',
+                        help="build the new database in a single transaction in place of the live one so the app "
+                             "never sees missing tables")
+    parser.add_argument('--compile', metavar='SCRIPT_PATH',
+                        help="don't connect to postgres, just write the full rebuild as a single transactional SQL "
+                             "script to this path (to apply later with psql -f)")
+    parser.add_argument('--report', metavar='REPORT_PATH', default=DEFAULT_REBUILD_REPORT_PATH,
+                        help="where to write the JSON report of how long every phase, data module and data class "
+                             "took (defaults to %(default)s)")
+    parser.add_argument('--trace-sample-rate', type=float, default=1.0, metavar='RATE',
+                        help="the fraction of executed statements to trace on the sql_trace logger, between 0 and 1 "
+                             "(defaults to all of them)")
+    parser.add_argument('--trace-max-length', type=int, default=DEFAULT_MAX_LENGTH, metavar='NUM_CHARS',
+                        help="truncate traced statements to this many characters, 0 for no limit "
+                             "(defaults to %(default)s)")
+    args = parser.parse_args()
+
+    if not 0 <= args.trace_sample_rate <= 1:
+        parser.error("--trace-sample-rate must be between 0 and 1")
+    configure_sql_trace(sample_rate=args.trace_sample_rate, max_length=args.trace_max_length or None)
+
+    if args.parallel > 0 and args.bulk:
+        parser.error("--parallel and --bulk are two different ways of loading the data, so they can't be combined")
+    if args.parallel > 0 and args.shadow:
+        parser.error("--shadow builds everything in a single transaction, so it can't be combined with --parallel")
+    if args.incremental and args.shadow:
+        parser.error("--shadow rebuilds everything, so it can't be combined with --incremental")
+    if args.compile is not None and (args.incremental or args.shadow or args.parallel > 0):
+        parser.error("--compile can only be combined with --bulk")
+
+    mode = "compile" if args.compile is not None else "incremental" if args.incremental else "full"
+    mode_flags = [x for x, is_set in [("--parallel", args.parallel > 0), ("--bulk", args.bulk),
+                                      ("--shadow", args.shadow)] if is_set]
+    rebuild_mode = " ".join([mode] + mode_flags)
+
+    # The metrics of a compiled script are only written to the report since nothing was loaded yet
+    if args.compile is not None:
+        run_profiled_rebuild(rebuild_mode, compile_database, args.compile, args.bulk,
+                             report_path=args.report, record_metrics=False)
+    elif args.incremental:
+        run_profiled_rebuild(rebuild_mode, incremental_rebuild_database, args.parallel, args.bulk,
+                             report_path=args.report)
+    else:
+        run_profiled_rebuild(rebuild_mode, rebuild_database, args.parallel, args.bulk, args.shadow,
+                             report_path=args.report)
 